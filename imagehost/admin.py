@@ -1,19 +1,79 @@
 from django.contrib import admin
-from .models import Image, UploadToken
+from django.urls import reverse
+from django.utils.html import format_html, format_html_join
+from .models import Blob, Image, ProcessingJob, UploadToken, UsageStats
+from .page_cache import invalidate as invalidate_pages
+from .perceptual import find_similar, stored_hash
 
 
 @admin.register(Image)
 class ImageAdmin(admin.ModelAdmin):
-    list_display = ['original_filename', 'size_kb', 'width', 'height', 'view_count', 'created_at', 'upload_ip']
-    list_filter = ['created_at', 'mime_type']
+    list_display = ['original_filename', 'size_kb', 'variant_savings', 'width', 'height', 'view_count', 'processing_state', 'created_at', 'upload_ip']
+    list_filter = ['created_at', 'mime_type', 'processing_state']
     search_fields = ['original_filename', 'file_hash', 'upload_ip']
-    readonly_fields = ['file_hash', 'width', 'height', 'file_size', 'created_at', 'view_count', 'upload_ip']
+    readonly_fields = ['file_hash', 'blob', 'width', 'height', 'file_size', 'created_at', 'view_count', 'upload_ip', 'processing_state', 'webp_size', 'avif_size', 'similar_images']
     date_hierarchy = 'created_at'
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # Listings show the file name
+        invalidate_pages()
+
     def size_kb(self, obj):
         return f"{obj.size_kb} KB"
     size_kb.short_description = 'Size'
 
+    def variant_savings(self, obj):
+        sizes = [size for size in (obj.webp_size, obj.avif_size) if size]
+        if not sizes or not obj.file_size:
+            return '-'
+        return f"{round(100 * (1 - min(sizes) / obj.file_size))}%"
+    variant_savings.short_description = 'Variant savings'
+
+    def similar_images(self, obj):
+        value = stored_hash(obj) if obj.pk else None
+        if value is None:
+            return '-'
+        matches = find_similar(value, queryset=Image.objects.exclude(id=obj.id))
+        if not matches:
+            return 'None found'
+        return format_html('<ul>{}</ul>', format_html_join(
+            '', '<li><a href="{}">{}</a> (distance {})</li>',
+            (
+                (reverse('admin:imagehost_image_change', args=[img.id]), img, distance)
+                for distance, img in matches
+            )
+        ))
+    similar_images.short_description = 'Similar images'
+
+
+@admin.register(Blob)
+class BlobAdmin(admin.ModelAdmin):
+    list_display = ['name', 'size', 'ref_count', 'created_at']
+    search_fields = ['name', 'file_hash']
+    readonly_fields = ['file_hash', 'name', 'size', 'ref_count', 'created_at']
+
+    def has_add_permission(self, request):
+        # Blobs are created by uploads and removed with their last image
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(ProcessingJob)
+class ProcessingJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'image', 'status', 'attempts', 'locked_at', 'created_at']
+    list_filter = ['status']
+    readonly_fields = ['image', 'attempts', 'error', 'locked_at', 'created_at']
+
+
+@admin.register(UsageStats)
+class UsageStatsAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'image_count', 'total_size_mb', 'total_views', 'updated_at']
+    search_fields = ['user__username', 'user__email']
+    readonly_fields = ['user', 'image_count', 'total_size', 'total_views', 'updated_at']
+
 
 @admin.register(UploadToken)
 class UploadTokenAdmin(admin.ModelAdmin):
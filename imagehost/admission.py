@@ -0,0 +1,200 @@
+"""
+Admission control for uploads
+
+Uploads pass two checks, excess ones get a 429 / 503 with Retry-After:
+
+- a token bucket per API token, or per client IP for guests and logged-in
+  users (UPLOAD_RATE_PER_* uploads per minute, bursts of UPLOAD_BURST_PER_*).
+  admission_control charges it before the view reads the body; only an API
+  token sent as a form field has already made check_api_access parse it.
+- one of MAX_CONCURRENT_COMPRESSIONS slots shared by all workers, taken by
+  the upload view with compression_slot around compressing and storing the
+  new files of an upload. Reading, probing and the duplicate checks run
+  before it, so an upload that only adds duplicates never waits for a slot.
+
+Both live in ADMISSION_STATE_DIR so they hold across gunicorn workers: the
+buckets in JSON shard files updated under an exclusive flock, the slots as
+files locked for as long as an upload holds them. The kernel drops the
+locks of a worker that dies, so a crash never leaks a slot.
+"""
+
+import asyncio
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+
+from . import metrics
+from .uploads import process_later
+
+logger = logging.getLogger(__name__)
+
+# Shard files of the token buckets, spreading clients over several locks
+BUCKET_SHARDS = 64
+
+# Seconds a client is asked to wait when every compression slot is taken
+BUSY_RETRY_AFTER = 5
+
+
+def _state_path(*parts):
+    directory = settings.ADMISSION_STATE_DIR
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, *parts)
+
+
+def take_token(key, rate, burst, now=None):
+    """
+    Take one token from the bucket of key
+    Args:
+        key: Bucket name, kind:id such as 'ip:203.0.113.7'
+        rate: Tokens added per second
+        burst: Bucket capacity
+    Returns:
+        0 if a token was taken, else the seconds until one is available
+    """
+    now = time.time() if now is None else now
+    # Buckets with different limits ('ip:', 'token:') are kept in different files
+    kind = key.split(':', 1)[0]
+    shard = int(hashlib.sha1(key.encode()).hexdigest(), 16) % BUCKET_SHARDS
+    fd = os.open(_state_path(f'buckets-{kind}-{shard:02d}.json'), os.O_RDWR | os.O_CREAT, 0o644)
+    with os.fdopen(fd, 'r+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            buckets = json.loads(f.read() or '{}')
+        except ValueError:
+            buckets = {}
+
+        tokens, updated = buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        buckets[key] = (tokens, now)
+
+        # Buckets that have refilled completely are the same as missing ones
+        buckets = {
+            name: (level, at) for name, (level, at) in buckets.items()
+            if level + (now - at) * rate < burst or name == key
+        }
+        f.seek(0)
+        f.truncate()
+        json.dump(buckets, f)
+    return wait
+
+
+def check_rate(request):
+    """
+    Charge an upload to its token's or client IP's bucket
+    Returns:
+        None if the upload may go on, else a 429 response
+    """
+    from .views import get_client_ip
+
+    if hasattr(request, 'upload_token'):
+        key, reason = f'token:{request.upload_token.id}', 'token'
+        per_minute, burst = settings.UPLOAD_RATE_PER_TOKEN, settings.UPLOAD_BURST_PER_TOKEN
+    else:
+        key, reason = f'ip:{get_client_ip(request)}', 'ip'
+        per_minute, burst = settings.UPLOAD_RATE_PER_IP, settings.UPLOAD_BURST_PER_IP
+    if per_minute <= 0:
+        return None
+
+    try:
+        wait = take_token(key, per_minute / 60, max(1, burst))
+    except OSError as e:
+        # Losing the limiter must not take uploads down with it
+        logger.warning('Upload rate limit unavailable: %s', e)
+        return None
+    if not wait:
+        return None
+
+    metrics.inc('imagehost_admission_rejected_total', reason=reason)
+    response = JsonResponse({'error': 'Too many uploads, please retry later'}, status=429)
+    response['Retry-After'] = str(math.ceil(wait))
+    return response
+
+
+@contextmanager
+def compression_slot(new_uploads):
+    """
+    Hold one of MAX_CONCURRENT_COMPRESSIONS slots shared by all processes
+    while the new files of an upload are compressed and stored. Taking a
+    slot never blocks. Uploads with nothing to compress in the request (no
+    new files, compression disabled, or left to the process_images worker)
+    don't need one.
+    Yields:
+        True if a slot is held or none is needed, False if all are taken
+    """
+    compresses_now = settings.ENABLE_IMAGE_COMPRESSION and not process_later()
+    if settings.MAX_CONCURRENT_COMPRESSIONS <= 0 or not compresses_now or not new_uploads:
+        yield True
+        return
+
+    slot = None
+    try:
+        for index in range(settings.MAX_CONCURRENT_COMPRESSIONS):
+            f = open(_state_path(f'slot-{index}.lock'), 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                f.close()
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    continue
+                raise
+            slot = f
+            break
+    except OSError as e:
+        logger.warning('Compression slots unavailable: %s', e)
+        yield True
+        return
+
+    try:
+        yield slot is not None
+    finally:
+        if slot is not None:
+            slot.close()
+
+
+def busy_response():
+    """503 for an upload finding every compression slot taken"""
+    metrics.inc('imagehost_admission_rejected_total', reason='busy')
+    response = JsonResponse({'error': 'Server busy, please retry later'}, status=503)
+    response['Retry-After'] = str(BUSY_RETRY_AFTER)
+    return response
+
+
+def admission_control(view_func):
+    """
+    Decorator charging uploads to their rate limit (sync or async view),
+    apply inside token_required so the request's API token is known.
+    The compression slot is taken by the view itself, see compression_slot.
+    """
+    if asyncio.iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def async_wrapper(request, *args, **kwargs):
+            error = await sync_to_async(check_rate)(request)
+            if error is not None:
+                return error
+            return await view_func(request, *args, **kwargs)
+        return async_wrapper
+
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        error = check_rate(request)
+        if error is not None:
+            return error
+        return view_func(request, *args, **kwargs)
+    return wrapper
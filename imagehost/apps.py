@@ -5,3 +5,6 @@ class ImagehostConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'imagehost'
     verbose_name = '图片托管'
+
+    def ready(self):
+        from . import signals  # noqa: F401
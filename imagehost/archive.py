@@ -0,0 +1,426 @@
+"""
+Streaming export and import of images with their files
+An archive is an uncompressed (or gzip) tar stream:
+
+    export.json            format version and export parameters
+    batches/000001.jsonl   one Image per line
+    files/<storage name>   the stored files first used by that batch
+    batches/000002.jsonl
+    ...
+
+Each manifest comes right before its files, so both sides work one batch
+at a time in constant memory and the archive can be piped (e.g. over ssh).
+A stored file is written once, with the lowest-id image using it.
+Manifest lines carry the SHA-256 of the stored file (file_hash is the hash
+of the original upload, the stored file may have been compressed since),
+which import verifies.
+
+Import skips images that already exist (same file_hash, created_at and
+owner), so an interrupted import is resumed by running it again, and
+reuses Blobs already present instead of storing their file again.
+Format variants are not exported; they are regenerated by process_images.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import tarfile
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Case, F, Min, Value, When
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .blobs import find_blobs, share_blob
+from .models import PENDING_DIR, Blob, Image, pending_name
+from .page_cache import invalidate as invalidate_pages
+from .perceptual import hash_fields
+from .processing import current_name, enqueue
+from .usage import apply_usage
+from .variants import enabled_formats
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+HEADER_NAME = 'export.json'
+BATCH_DIR = 'batches/'
+FILE_DIR = 'files/'
+
+# Files up to this size are buffered in memory while in flight, larger
+# ones spill to a temporary file
+SPOOL_SIZE = 256 * 1024
+COPY_CHUNK_SIZE = 64 * 1024
+
+# Image columns copied as is
+ROW_FIELDS = (
+    'id', 'original_filename', 'file_size', 'file_hash', 'width', 'height', 'mime_type',
+    'upload_ip', 'is_temporary', 'view_count', 'processing_state', 'phash',
+)
+
+
+@dataclass
+class ArchiveStats:
+    """Counters of one export or import run"""
+
+    images: int = 0
+    files: int = 0
+    bytes: int = 0
+    batches: int = 0
+    skipped: int = 0
+    users: int = 0
+    last_id: int = 0
+    errors: list = field(default_factory=list)
+
+    @property
+    def size_mb(self):
+        return round(self.bytes / (1024 * 1024), 2)
+
+
+def _spool(source):
+    """
+    Copy a file object into a spooled temporary file
+    Returns:
+        (spooled file positioned at 0, size, hex SHA-256)
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    hasher = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = source.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        hasher.update(chunk)
+        spool.write(chunk)
+        size += len(chunk)
+    spool.seek(0)
+    return spool, size, hasher.hexdigest()
+
+
+def _fetch(name):
+    """Read a stored file, runs on the I/O threads"""
+    with default_storage.open(name) as source:
+        return _spool(source)
+
+
+def exportable_images(since_id=0, since=None):
+    """Images to export: newer than since_id / created since `since`, not yet expired"""
+    queryset = Image.objects.filter(id__gt=since_id).exclude(
+        is_temporary=True, expires_at__lt=timezone.now()
+    )
+    if since is not None:
+        queryset = queryset.filter(created_at__gte=since)
+    return queryset
+
+
+def _add_member(tar, name, fileobj, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    tar.addfile(info, fileobj)
+
+
+def export_archive(fileobj, since_id=0, since=None, batch_size=500, workers=8, compress=False, on_batch=None):
+    """
+    Write the images selected by exportable_images to a tar stream
+    Args:
+        fileobj: Writable binary file (need not be seekable)
+        batch_size: Images per manifest
+        workers: Threads reading stored files
+        compress: gzip the stream (stored images rarely shrink much)
+        on_batch: Optional callback receiving each exported batch
+    Returns:
+        ArchiveStats, last_id is the value to pass as since_id next time
+    """
+    stats = ArchiveStats(last_id=since_id)
+    images = exportable_images(since_id, since)
+    now = int(timezone.now().timestamp())
+
+    with tarfile.open(fileobj=fileobj, mode='w|gz' if compress else 'w|') as tar, \
+            ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        header = json.dumps({
+            'format': FORMAT_VERSION,
+            'created_at': timezone.now().isoformat(),
+            'since_id': since_id,
+            'since': since.isoformat() if since else None,
+        }).encode()
+        _add_member(tar, HEADER_NAME, io.BytesIO(header), len(header), now)
+
+        last_id = since_id
+        while True:
+            batch = list(
+                images.filter(id__gt=last_id).select_related('user').order_by('id')[:batch_size]
+            )
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            # The file of a shared blob goes with the first image using it;
+            # in an incremental export that image may be in an earlier archive
+            blob_ids = {image.blob_id for image in batch if image.blob_id}
+            first_use = dict(
+                exportable_images().filter(blob_id__in=blob_ids).order_by().values('blob_id')
+                .annotate(first=Min('id')).values_list('blob_id', 'first')
+            )
+            carriers = [
+                image for image in batch
+                if image.blob_id is None or first_use.get(image.blob_id) == image.id
+            ]
+            fetched = {}
+            for image, future in [(image, pool.submit(_fetch, current_name(image))) for image in carriers]:
+                try:
+                    fetched[image.id] = future.result()
+                except Exception as e:
+                    logger.warning('Could not read %s: %s', image.image.name, e)
+                    stats.errors.append(f'{image.image.name}: {e}')
+
+            lines = []
+            for image in batch:
+                record = {name: getattr(image, name) for name in ROW_FIELDS}
+                record.update(
+                    user=image.user.username if image.user else None,
+                    name=image.image.name,
+                    created_at=image.created_at.isoformat(),
+                    expires_at=image.expires_at.isoformat() if image.expires_at else None,
+                    sha256=fetched[image.id][2] if image.id in fetched else None,
+                )
+                lines.append(json.dumps(record))
+            manifest = ('\n'.join(lines) + '\n').encode()
+            stats.batches += 1
+            _add_member(tar, f'{BATCH_DIR}{stats.batches:06d}.jsonl', io.BytesIO(manifest), len(manifest), now)
+
+            for image in batch:
+                if image.id not in fetched:
+                    continue
+                spool, size, _ = fetched.pop(image.id)
+                with spool:
+                    _add_member(tar, FILE_DIR + image.image.name, spool, size, int(image.created_at.timestamp()))
+                stats.files += 1
+                stats.bytes += size
+
+            stats.images += len(batch)
+            stats.last_id = last_id
+            if on_batch:
+                on_batch(batch)
+
+    return stats
+
+
+class _ImportBatch:
+    """Manifest records of one batch and the files stored for them"""
+
+    def __init__(self, records, pool):
+        self.pool = pool
+        self.records = records
+        self.stored = {}  # sha256 -> future of the storage name
+        self.errors = []
+
+        existing = set(
+            Image.objects.filter(file_hash__in={r['file_hash'] for r in records})
+            .values_list('file_hash', 'created_at', 'user__username')
+        )
+        self.pending = [
+            r for r in records
+            if (r['file_hash'], parse_datetime(r['created_at']), r['user']) not in existing
+        ]
+        self.blobs = find_blobs({r['file_hash'] for r in self.pending})
+        # Files to read from the archive: new content not stored here yet
+        self.wanted = {
+            r['name']: r['sha256'] for r in self.pending
+            if r['sha256'] and r['file_hash'] not in self.blobs
+        }
+        referenced = set(
+            Image.objects.filter(image__in=list(self.wanted)).values_list('image', flat=True)
+        )
+        self.leftovers = set(self.wanted) - referenced
+        # Files still waiting for compression are staged like new uploads
+        self.staged = {r['name'] for r in self.pending if r['processing_state'] == Image.STATE_PENDING}
+
+    def store(self, name, source):
+        """Verify a file member and save it on the I/O threads"""
+        expected = self.wanted.pop(name, None)
+        if expected is None:
+            return False
+        spool, size, digest = _spool(source)
+        if digest != expected:
+            spool.close()
+            self.errors.append(f'{name}: checksum mismatch')
+            return False
+        self.stored[expected] = self.pool.submit(
+            self._save, name, spool, name in self.leftovers, name in self.staged
+        )
+        return size
+
+    @staticmethod
+    def _save(name, spool, leftover, staged):
+        target = pending_name(name) if staged else name
+        with spool:
+            if leftover and default_storage.exists(target):
+                # Written by an import that was interrupted before its commit
+                default_storage.delete(target)
+            saved = default_storage.save(target, File(spool, name=target))
+        return saved[len(PENDING_DIR) + 1:] if staged else saved
+
+    def commit(self, stats):
+        """Create the Images, Blobs and usage of this batch in one transaction"""
+        stored = {}
+        for digest, future in self.stored.items():
+            try:
+                stored[digest] = future.result()
+            except Exception as e:
+                self.errors.append(f'{digest}: {e}')
+        for name in self.wanted:
+            self.errors.append(f'{name}: missing from the archive')
+        # file_hash -> storage name of the files written for this batch
+        stored = {r['file_hash']: stored[r['sha256']] for r in self.pending if r['sha256'] in stored}
+        carried = {r['file_hash'] for r in self.pending if r['sha256']}
+
+        usernames = {r['user'] for r in self.pending if r['user']}
+        with transaction.atomic():
+            users = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+            for username in sorted(usernames - set(users)):
+                user = User(username=username)
+                user.set_unusable_password()
+                user.save()
+                users[username] = user.id
+                stats.users += 1
+
+            owned = set(
+                Image.objects.filter(
+                    user_id__in=users.values(), file_hash__in={r['file_hash'] for r in self.pending}
+                ).values_list('user_id', 'file_hash')
+            )
+            new_blobs = {}
+            shared = Counter()
+            images = []
+            for record in self.pending:
+                file_hash = record['file_hash']
+                user_id = users.get(record['user'])
+                if user_id is not None:
+                    # Each user keeps one copy of a file (unique_user_file_hash)
+                    if (user_id, file_hash) in owned:
+                        stats.skipped += 1
+                        continue
+                    owned.add((user_id, file_hash))
+
+                image = Image(
+                    user_id=user_id,
+                    **{name: record[name] for name in ROW_FIELDS if name != 'id'},
+                    expires_at=parse_datetime(record['expires_at']) if record['expires_at'] else None,
+                )
+                if record['phash'] is not None:
+                    for name, value in hash_fields(record['phash'] & ((1 << 64) - 1)).items():
+                        setattr(image, name, value)
+
+                if file_hash in self.blobs:
+                    share_blob(image, *self.blobs[file_hash])
+                    shared[file_hash] += 1
+                elif file_hash in stored:
+                    if file_hash not in new_blobs:
+                        new_blobs[file_hash] = Blob(
+                            file_hash=file_hash, name=stored[file_hash], size=record['file_size'], ref_count=0
+                        )
+                    image.blob = new_blobs[file_hash]
+                    image.image = image.blob.name
+                    image.blob.ref_count += 1
+                else:
+                    if file_hash not in carried:
+                        # Its file is in an earlier archive (not imported here) or failed
+                        self.errors.append(f"{record['name']}: file neither stored here nor in this batch")
+                    continue
+                images.append((image, parse_datetime(record['created_at'])))
+
+            Blob.objects.bulk_create(new_blobs.values())
+            for file_hash, count in shared.items():
+                Blob.objects.filter(id=self.blobs[file_hash][0].id).update(ref_count=F('ref_count') + count)
+            created = Image.objects.bulk_create([image for image, _ in images])
+            if created:
+                # created_at is auto_now_add, the original time is set afterwards
+                Image.objects.filter(id__in=[image.id for image in created]).update(created_at=Case(
+                    *[When(id=image.id, then=Value(created_at)) for image, created_at in images]
+                ))
+
+            deltas = {}
+            for image in created:
+                delta = deltas.setdefault(image.user_id, [0, 0, 0])
+                delta[0] += 1
+                delta[1] += image.file_size
+                delta[2] += image.view_count
+            apply_usage(deltas)
+            if created:
+                # bulk_create sends no signals, listings must show the imported images
+                invalidate_pages()
+
+            # Variants are not exported, new files are queued once each for
+            # them (and for compression or hashing when still missing)
+            formats = enabled_formats()
+            jobs = {}
+            for image in created:
+                if image.blob.file_hash in new_blobs and image.blob_id not in jobs and (
+                    formats
+                    or image.processing_state == Image.STATE_PENDING
+                    or (settings.PERCEPTUAL_HASH_ENABLED and image.phash is None)
+                ):
+                    jobs[image.blob_id] = image
+            enqueue(jobs.values())
+
+        stats.images += len(created)
+        stats.skipped += len(self.records) - len(self.pending)
+        stats.batches += 1
+        stats.last_id = max([stats.last_id] + [r['id'] for r in self.records])
+        stats.errors.extend(self.errors)
+        return created
+
+
+def import_archive(fileobj, workers=8, on_batch=None):
+    """
+    Import a tar stream written by export_archive
+    Args:
+        fileobj: Readable binary file (need not be seekable), plain or gzip
+        workers: Threads writing files to storage
+        on_batch: Optional callback receiving the Images created per batch
+    Returns:
+        ArchiveStats
+    Raises:
+        ValueError: Not an export archive, or an unsupported format version
+    """
+    stats = ArchiveStats()
+    batch = None
+
+    def finish(batch):
+        created = batch.commit(stats)
+        if on_batch:
+            on_batch(created)
+
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tar, \
+            ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for member in tar:
+            if member.name == HEADER_NAME:
+                header = json.load(tar.extractfile(member))
+                if header.get('format') != FORMAT_VERSION:
+                    raise ValueError(f"Unsupported archive format: {header.get('format')}")
+            elif member.name.startswith(BATCH_DIR):
+                if batch is not None:
+                    finish(batch)
+                records = [json.loads(line) for line in tar.extractfile(member) if line.strip()]
+                batch = _ImportBatch(records, pool)
+            elif member.name.startswith(FILE_DIR) and member.isfile():
+                if batch is None:
+                    raise ValueError("Not an image export archive")
+                size = batch.store(member.name[len(FILE_DIR):], tar.extractfile(member))
+                if size:
+                    stats.files += 1
+                    stats.bytes += size
+        if batch is not None:
+            finish(batch)
+
+    return stats
@@ -0,0 +1,219 @@
+"""
+Native async versions of the upload, list and serve views (ASYNC_VIEWS)
+
+Meant for an ASGI server, e.g. gunicorn with uvicorn workers:
+    gunicorn -k uvicorn.workers.UvicornWorker image_bed.asgi:application
+A slow client then costs a suspended coroutine instead of a whole worker:
+the ASGI handler receives the body before the view runs and file responses
+are streamed with their reads done on threads.
+
+Queries use the async ORM; transactions, storage writes and the session /
+token checks have no async API in Django 4.2 and run through
+sync_to_async. PIL work (probing, perceptual hashing, compression) runs on a bounded thread
+pool of ASYNC_IMAGE_WORKERS per process, so CPU-heavy uploads queue there
+instead of starving the event loop; with UPLOAD_PROCESS_WORKERS > 0 the
+compression itself goes on to the process pool.
+"""
+
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.http import Http404, HttpResponseNotAllowed, JsonResponse
+
+from . import metrics, uploads
+from .admission import admission_control, busy_response, compression_slot
+from .http_utils import async_streaming
+from .models import Image
+from .page_cache import acached_page, astore_page, page_key
+from .pagination import acached_image_count, akeyset_page
+from .token_cache import record_token_use
+from .views import (
+    LIST_PARAMS, check_api_access, get_client_ip, image_response, list_entry, read_upload_files,
+    upload_response,
+)
+
+_image_executor = None
+_image_executor_lock = threading.Lock()
+
+
+def _reset_image_executor():
+    global _image_executor, _image_executor_lock
+    _image_executor = None
+    _image_executor_lock = threading.Lock()
+
+
+# A forked gunicorn worker must create its own threads
+os.register_at_fork(after_in_child=_reset_image_executor)
+
+
+def get_image_executor():
+    """Thread pool running the PIL work of this process"""
+    global _image_executor
+    with _image_executor_lock:
+        if _image_executor is None:
+            _image_executor = ThreadPoolExecutor(
+                max_workers=settings.ASYNC_IMAGE_WORKERS, thread_name_prefix='image-work'
+            )
+        return _image_executor
+
+
+async def run_image_work(func, *args):
+    """Run CPU-bound image work on the image executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_image_executor(), partial(func, *args))
+
+
+def require_methods(*methods):
+    """require_http_methods for async views (Django 4.2's decorator is sync only)"""
+    def decorator(view_func):
+        @wraps(view_func)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return HttpResponseNotAllowed(methods)
+            return await view_func(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def token_required(view_func):
+    """Async views.token_required, also loads request.user for the view"""
+    @wraps(view_func)
+    async def wrapper(request, *args, **kwargs):
+        error = await sync_to_async(check_api_access)(request)
+        if error is not None:
+            return error
+        return await view_func(request, *args, **kwargs)
+
+    return wrapper
+
+
+@require_methods('POST')
+@metrics.timed('upload')
+@token_required
+@admission_control
+async def upload_image(request):
+    """Handle image upload, async version of views.upload_image"""
+    timer = request.timer
+    try:
+        # Parsing the multipart body (which hashes the files) is synchronous
+        with timer.stage('read'):
+            files = await sync_to_async(lambda: request.FILES)()
+        uploaded_files, error = read_upload_files(request, files)
+        if error:
+            return error
+
+        errors = []
+        user = request.user if request.user.is_authenticated else None
+        upload_ip = get_client_ip(request)
+        accepted = await run_image_work(uploads.check_files, uploaded_files, errors, timer)
+
+        with timer.stage('dedup'):
+            existing, stored = await uploads.afind_duplicates(accepted, user)
+        new_uploads, shared_uploads = uploads.split_uploads(accepted, existing, stored)
+        phashes, near_duplicates = {}, set()
+        if settings.NEAR_DUPLICATE_UPLOADS == 'reuse' and new_uploads:
+            phashes = await run_image_work(uploads.perceptual_hashes, new_uploads, timer)
+            new_uploads, near_duplicates = await sync_to_async(uploads.match_near_duplicates)(
+                new_uploads, phashes, user, existing, stored, shared_uploads, timer
+            )
+        uploads.record_dedup(accepted, new_uploads, shared_uploads, near_duplicates)
+
+        with compression_slot(new_uploads) as admitted:
+            if not admitted:
+                return busy_response()
+            compressed = await run_image_work(uploads.compress_new_uploads, new_uploads, timer)
+            new_images = await sync_to_async(uploads.store_new_files)(
+                new_uploads, compressed, phashes, user, upload_ip, errors, timer
+            )
+        new_images += uploads.share_stored_files(shared_uploads, stored, user, upload_ip)
+        with timer.stage('db'):
+            created = await sync_to_async(uploads.save_images)(new_images, existing, errors)
+
+        # Record token usage, buffered so uploads don't serialize on the token row
+        if created and hasattr(request, 'upload_token'):
+            with timer.stage('token'):
+                record_token_use(request.upload_token, count=len(created))
+
+        return upload_response(
+            request, accepted, new_uploads, shared_uploads, created, existing, near_duplicates, errors
+        )
+
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+
+# csrf_exempt's wrapper is sync in Django 4.2, set the flag directly
+upload_image.csrf_exempt = True
+
+
+@require_methods('GET')
+@token_required
+async def list_images(request):
+    """List all uploaded images with pagination, async version of views.list_images"""
+    key = page_key('list_images', request, LIST_PARAMS)
+    response = await acached_page(request, key)
+    if response is not None:
+        return response
+
+    try:
+        per_page = min(max(int(request.GET.get('per_page', 20)), 1), settings.API_MAX_PER_PAGE)
+        images = Image.objects.all()
+
+        if 'cursor' in request.GET:
+            try:
+                page_obj = await akeyset_page(images, per_page, after=request.GET.get('cursor'))
+            except ValueError as e:
+                return JsonResponse({'error': str(e)}, status=400)
+            items = page_obj.object_list
+            pagination = {
+                'per_page': per_page,
+                'next_cursor': page_obj.next_cursor,
+                'has_more': page_obj.has_next,
+            }
+            if request.GET.get('include_total') in ('1', 'true'):
+                pagination['total'] = await acached_image_count()
+        else:
+            page = int(request.GET.get('page', 1))
+            paginator = Paginator(images, per_page)
+            paginator.count = await acached_image_count()
+            page_obj = paginator.get_page(page)
+            items = [img async for img in page_obj.object_list]
+            pagination = {
+                'page': page,
+                'per_page': per_page,
+                'total': paginator.count,
+                'pages': paginator.num_pages
+            }
+
+        return await astore_page(request, key, JsonResponse({
+            'images': [list_entry(request, img) for img in items],
+            'pagination': pagination
+        }))
+
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+
+@metrics.timed('serve')
+async def serve_image(request, image_path):
+    """Serve image file and increment view count, async version of views.serve_image"""
+    try:
+        with request.timer.stage('lookup'):
+            # Credited to the same image as in view_counts.viewed_images
+            image = await Image.objects.filter(image=image_path).order_by('id').afirst()
+
+        if not image:
+            raise Http404("Image not found")
+
+        # Checking and opening the stored file blocks, the body is then read from threads
+        response = await sync_to_async(image_response)(request, image, image_path)
+        return async_streaming(response)
+
+    except Exception as e:
+        raise Http404(str(e))
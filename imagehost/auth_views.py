@@ -12,6 +12,7 @@ from django.views.decorators.http import require_http_methods
 from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
 from django.db import IntegrityError
+from .usage import usage_for
 import re
 
 
@@ -149,18 +150,15 @@ def user_profile(request):
     """Display user profile and their uploaded images"""
     user_images = request.user.images.all()
 
-    # Calculate statistics
-    total_images = user_images.count()
-    total_views = sum(img.view_count for img in user_images)
-    total_size = sum(img.file_size for img in user_images)
-    total_size_mb = round(total_size / (1024 * 1024), 2)
+    # Statistics come from the maintained counters, a single row fetch
+    stats = usage_for(request.user)
 
     context = {
         'user': request.user,
         'images': user_images[:12],  # Show latest 12 images
-        'total_images': total_images,
-        'total_views': total_views,
-        'total_size_mb': total_size_mb,
+        'total_images': stats.image_count,
+        'total_views': stats.total_views,
+        'total_size_mb': stats.total_size_mb,
     }
 
     return render(request, 'auth/profile.html', context)
@@ -0,0 +1,482 @@
+"""
+Offline benchmark suite, run by the run_benchmarks command
+- generate_corpus: deterministic synthetic images in several sizes and
+  formats (opaque, alpha, animated)
+- bench_hash / bench_compress: micro-benchmarks of the upload hot path
+- run_load: concurrent HTTP requests against a local gunicorn started by
+  gunicorn_server, used by the upload, serve and list scenarios
+- bench_cleanup: the expired-image sweep on a seeded backlog
+
+Every benchmark returns a flat dict of numbers so results can be written to
+JSON and compared between commits.
+"""
+
+import http.client
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import timedelta
+from io import BytesIO
+
+from django.conf import settings
+from django.utils import timezone
+from PIL import Image as PILImage
+from PIL import ImageDraw
+
+from .cleanup import sweep_expired
+from .models import Image
+from .pagination import encode_cursor
+
+# Corpus dimensions by size class
+CORPUS_SIZES = {
+    'small': (320, 240),
+    'medium': (1280, 960),
+    'large': (3000, 2250),
+}
+
+# kind -> (PIL format, mode, mime type, extension)
+CORPUS_KINDS = {
+    'jpeg': ('JPEG', 'RGB', 'image/jpeg', 'jpg'),
+    'png': ('PNG', 'RGB', 'image/png', 'png'),
+    'png_alpha': ('PNG', 'RGBA', 'image/png', 'png'),
+    'gif_animated': ('GIF', 'P', 'image/gif', 'gif'),
+    'webp': ('WEBP', 'RGB', 'image/webp', 'webp'),
+}
+
+ANIMATION_FRAMES = 4
+
+# Fields compared by compare_results, with whether higher is better
+COMPARED_FIELDS = {
+    'mean_ms': False,
+    'p50_ms': False,
+    'p99_ms': False,
+    'mb_per_second': True,
+    'requests_per_second': True,
+    'images_per_second': True,
+}
+
+
+@dataclass
+class CorpusFile:
+    path: str
+    kind: str
+    size_class: str
+    mime_type: str
+    size: int
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+
+def _synthetic_image(rng, size, mode):
+    """Shapes over a background plus smooth texture, so it compresses roughly like a photo"""
+    width, height = size
+    img = PILImage.new('RGB', size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        box = [x0, y0, x0 + rng.randrange(1, width // 2 + 2), y0 + rng.randrange(1, height // 2 + 2)]
+        color = tuple(rng.randrange(256) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.ellipse(box, fill=color)
+        else:
+            draw.rectangle(box, fill=color)
+
+    # Low resolution noise scaled up: texture without incompressible pixel noise
+    noise_size = (max(1, width // 8), max(1, height // 8))
+    noise = PILImage.frombytes('L', noise_size, rng.randbytes(noise_size[0] * noise_size[1]))
+    img = PILImage.blend(img, noise.resize(size, PILImage.Resampling.BILINEAR).convert('RGB'), 0.25)
+
+    if mode == 'RGBA':
+        img.putalpha(PILImage.linear_gradient('L').resize(size))
+    return img
+
+
+def generate_corpus(directory, count, seed=0):
+    """
+    Write `count` synthetic images, cycling through every kind and size class
+    The same seed always produces the same files.
+    Returns:
+        List of CorpusFile
+    """
+    os.makedirs(directory, exist_ok=True)
+    kinds = list(CORPUS_KINDS)
+    size_classes = list(CORPUS_SIZES)
+    corpus = []
+    for i in range(count):
+        kind = kinds[i % len(kinds)]
+        size_class = size_classes[(i // len(kinds)) % len(size_classes)]
+        img_format, mode, mime_type, ext = CORPUS_KINDS[kind]
+        rng = random.Random(f'{seed}-{i}')
+        size = CORPUS_SIZES[size_class]
+        path = os.path.join(directory, f'{i:04d}_{kind}_{size_class}.{ext}')
+
+        if img_format == 'GIF':
+            # Noisy full-size frames do not compress in GIF and would exceed MAX_UPLOAD_SIZE
+            size = (size[0] // 2, size[1] // 2)
+            frames = [
+                _synthetic_image(rng, size, 'RGB').convert('P', palette=PILImage.Palette.ADAPTIVE)
+                for _ in range(ANIMATION_FRAMES)
+            ]
+            frames[0].save(path, format='GIF', save_all=True, append_images=frames[1:], duration=100, loop=0)
+        else:
+            _synthetic_image(rng, size, mode).save(path, format=img_format, quality=90)
+        corpus.append(CorpusFile(path, kind, size_class, mime_type, os.path.getsize(path)))
+    return corpus
+
+
+def percentile(values, fraction):
+    """Value at `fraction` of the sorted values (0 for none)"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(durations):
+    """Latency summary of durations in seconds"""
+    return {
+        'runs': len(durations),
+        'mean_ms': round(sum(durations) / len(durations) * 1000, 3) if durations else 0.0,
+        'min_ms': round(min(durations) * 1000, 3) if durations else 0.0,
+        'p50_ms': round(percentile(durations, 0.5) * 1000, 3),
+        'p90_ms': round(percentile(durations, 0.9) * 1000, 3),
+        'p99_ms': round(percentile(durations, 0.99) * 1000, 3),
+    }
+
+
+def _by_size_class(corpus):
+    groups = {}
+    for item in corpus:
+        groups.setdefault(item.size_class, []).append(item)
+    return groups
+
+
+def bench_hash(corpus, repeat=5):
+    """Image.calculate_hash per size class"""
+    results = {}
+    for size_class, items in _by_size_class(corpus).items():
+        contents = []
+        for item in items:
+            with open(item.path, 'rb') as f:
+                contents.append(f.read())
+        durations = []
+        for _ in range(repeat):
+            for data in contents:
+                started = time.perf_counter()
+                Image.calculate_hash(data)
+                durations.append(time.perf_counter() - started)
+        result = summarize(durations)
+        total = sum(len(data) for data in contents) * repeat
+        result['mb_per_second'] = round(total / (1024 * 1024) / sum(durations), 2)
+        results[f'hash.{size_class}'] = result
+    return results
+
+
+def bench_compress(corpus, repeat=1):
+    """Image.compress_image per kind and size class, with the configured quality"""
+    durations = {}
+    ratios = {}
+    for _ in range(repeat):
+        for item in corpus:
+            with open(item.path, 'rb') as f:
+                data = BytesIO(f.read())
+            data.name = item.name
+            started = time.perf_counter()
+            compressed, _ = Image.compress_image(
+                data,
+                quality=settings.COMPRESSION_QUALITY,
+                max_dimension=settings.MAX_IMAGE_DIMENSION,
+                mime_type=item.mime_type,
+            )
+            key = f'compress.{item.kind}.{item.size_class}'
+            durations.setdefault(key, []).append(time.perf_counter() - started)
+            ratios.setdefault(key, []).append(compressed.size / item.size)
+
+    results = {}
+    for key in sorted(durations):
+        result = summarize(durations[key])
+        result['size_ratio'] = round(sum(ratios[key]) / len(ratios[key]), 3)
+        results[key] = result
+    return results
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def gunicorn_server(workers, log_path, startup_timeout=30):
+    """
+    Run gunicorn (sync workers, like the Dockerfile) with this process's environment
+    Yields:
+        Port it listens on, on 127.0.0.1
+    """
+    port = _free_port()
+    with open(log_path, 'ab') as log:
+        process = subprocess.Popen(
+            [
+                sys.executable, '-m', 'gunicorn',
+                '--bind', f'127.0.0.1:{port}',
+                '--workers', str(workers),
+                '--timeout', '120',
+                'image_bed.wsgi:application',
+            ],
+            cwd=settings.BASE_DIR,
+            stdout=log,
+            stderr=log,
+        )
+    try:
+        deadline = time.monotonic() + startup_timeout
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f'gunicorn exited with status {process.returncode}, see {log_path}')
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f'gunicorn did not start within {startup_timeout}s, see {log_path}')
+                time.sleep(0.1)
+        yield port
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def run_load(port, requests, concurrency, keep_bodies=False):
+    """
+    Send requests from `concurrency` threads, each over its own connection
+    Args:
+        requests: List of (method, path, body, headers)
+        keep_bodies: Also return the response bodies, in request order
+    Returns:
+        (summary dict, list of bodies or None)
+    """
+    counter = itertools.count()
+    lock = threading.Lock()
+    durations = []
+    statuses = Counter()
+    bodies = [None] * len(requests) if keep_bodies else None
+    errors = [0]
+
+    def worker():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        local_durations = []
+        local_statuses = Counter()
+        local_errors = 0
+        while True:
+            index = next(counter)
+            if index >= len(requests):
+                break
+            method, path, body, headers = requests[index]
+            started = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                conn.close()
+                continue
+            local_durations.append(time.perf_counter() - started)
+            local_statuses[response.status] += 1
+            if keep_bodies:
+                bodies[index] = data
+        conn.close()
+        with lock:
+            durations.extend(local_durations)
+            statuses.update(local_statuses)
+            errors[0] += local_errors
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(max(1, concurrency))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    result = summarize(durations)
+    result.update(
+        requests=len(requests),
+        concurrency=concurrency,
+        seconds=round(elapsed, 3),
+        requests_per_second=round(len(durations) / elapsed, 2) if elapsed else 0.0,
+        errors=errors[0],
+        non_2xx=sum(count for status, count in statuses.items() if not 200 <= status < 400),
+    )
+    return result, bodies
+
+
+def multipart_body(field, item):
+    """(body, headers) of a multipart/form-data POST with one file"""
+    boundary = uuid.uuid4().hex
+    with open(item.path, 'rb') as f:
+        content = f.read()
+    body = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="{field}"; filename="{item.name}"\r\n'
+        f'Content-Type: {item.mime_type}\r\n\r\n'
+    ).encode() + content + f'\r\n--{boundary}--\r\n'.encode()
+    return body, {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+
+
+def bench_upload(port, corpus, concurrency):
+    """
+    Upload every corpus file once (all distinct, so no deduplication)
+    Returns:
+        (summary dict, URL paths of the stored images)
+    """
+    requests = []
+    for item in corpus:
+        body, headers = multipart_body('images', item)
+        requests.append(('POST', '/api/upload/', body, headers))
+    result, bodies = run_load(port, requests, concurrency, keep_bodies=True)
+    result['mb_per_second'] = round(
+        sum(item.size for item in corpus) / (1024 * 1024) / result['seconds'], 2
+    ) if result['seconds'] else 0.0
+
+    paths = []
+    for body in bodies:
+        try:
+            for entry in json.loads(body)['results']:
+                paths.append('/' + entry['url'].split('/', 3)[3])
+        except (TypeError, ValueError, KeyError, IndexError):
+            continue
+    return result, paths
+
+
+def bench_serve(port, paths, count, concurrency):
+    """GET stored images and their default thumbnail, round robin"""
+    results = {}
+    requests = [('GET', paths[i % len(paths)], None, {}) for i in range(count)]
+    results['serve'] = run_load(port, requests, concurrency)[0]
+
+    thumbnail_requests = [
+        ('GET', f"/t/{settings.THUMBNAIL_DEFAULT_SIZE}/{path[len(settings.MEDIA_URL):]}", None, {})
+        for path in (paths[i % len(paths)] for i in range(count))
+    ]
+    results['serve_thumbnail'] = run_load(port, thumbnail_requests, concurrency)[0]
+    return results
+
+
+def seed_images(count, file_name, expired=False):
+    """
+    Insert `count` image rows pointing at one stored file
+    Rows are spread over the last days so pagination order is realistic;
+    expired rows are temporary images past their expiry.
+    """
+    now = timezone.now()
+    rng = random.Random(count)
+    batch = []
+    for i in range(count):
+        created_at = now - timedelta(seconds=rng.randrange(7 * 86400))
+        batch.append(Image(
+            image=file_name(i),
+            original_filename=f'seed-{i}.png',
+            file_size=68,
+            file_hash=f'{i:064x}',
+            width=1,
+            height=1,
+            mime_type='image/png',
+            is_temporary=expired,
+            expires_at=now - timedelta(hours=1) if expired else None,
+            created_at=created_at,
+        ))
+        if len(batch) == 1000:
+            _insert(batch)
+            batch = []
+    _insert(batch)
+
+
+def _insert(images):
+    created = Image.objects.bulk_create(images)
+    # created_at is auto_now_add, set the spread afterwards
+    for image in created:
+        Image.objects.filter(id=image.id).update(created_at=image.created_at)
+
+
+def bench_list(port, count, concurrency, depth, per_page=20):
+    """List images on the first page and `depth` rows deep (page number and cursor)"""
+    deep = Image.objects.order_by('-created_at', '-id')[depth - 1:depth].first()
+    pages = {
+        'list.page_first': f'/api/images/?per_page={per_page}',
+        'list.page_deep': f'/api/images/?per_page={per_page}&page={depth // per_page + 1}',
+        'list.cursor_first': f'/api/images/?per_page={per_page}&cursor=',
+    }
+    if deep is not None:
+        pages['list.cursor_deep'] = f'/api/images/?per_page={per_page}&cursor={encode_cursor(deep)}'
+
+    results = {}
+    for key, path in pages.items():
+        results[key] = run_load(port, [('GET', path, None, {})] * count, concurrency)[0]
+        results[key]['depth'] = 0 if key.endswith('_first') else depth
+    return results
+
+
+# Smallest valid PNG (1x1), written for every seeded expired image
+TINY_PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c63000100000500010d0a2db40000000049454e44ae426082'
+)
+
+
+def bench_cleanup(rows, batch_size, file_workers):
+    """Seed `rows` expired images with their own files and sweep them"""
+    directory = os.path.join(settings.MEDIA_ROOT, 'benchmark')
+    os.makedirs(directory, exist_ok=True)
+    for i in range(rows):
+        with open(os.path.join(directory, f'{i:07d}.png'), 'wb') as f:
+            f.write(TINY_PNG)
+    seed_images(rows, lambda i: f'benchmark/{i:07d}.png', expired=True)
+
+    stats = sweep_expired(batch_size=batch_size, max_seconds=0, file_workers=file_workers)
+    return {
+        'cleanup': {
+            'images': stats.images,
+            'files': stats.files,
+            'batches': stats.batches,
+            'errors': len(stats.errors),
+            'seconds': round(stats.elapsed, 3),
+            'images_per_second': round(stats.images_per_second, 2),
+        }
+    }
+
+
+def compare_results(current, baseline):
+    """
+    Relative change of the compared fields between two result files
+    Returns:
+        List of (benchmark, field, baseline value, current value, change in
+        percent, whether it got better)
+    """
+    rows = []
+    for key, result in current['results'].items():
+        previous = baseline.get('results', {}).get(key)
+        if not previous:
+            continue
+        for field_name, higher_is_better in COMPARED_FIELDS.items():
+            old, new = previous.get(field_name), result.get(field_name)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            rows.append((key, field_name, old, new, round(change, 1), (change > 0) == higher_is_better))
+    return rows
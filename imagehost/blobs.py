@@ -0,0 +1,161 @@
+"""
+Content-addressed file storage with reference counting
+Every distinct file (by SHA-256) is stored once, as a Blob. Each Image
+uploaded with that content points at the Blob and holds one reference.
+Deleting an Image releases its reference; the file, its format variants and
+its thumbnails are removed only when no Image refers to it any more.
+
+Images stored before blobs existed have no Blob and own their file; the
+reconcile_blobs command attaches them.
+"""
+
+from collections import Counter, defaultdict
+
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+
+from .models import Blob, Image, pending_name
+from .thumbnails import delete_thumbnails
+from .variants import delete_variants
+
+# Fields copied from an existing Image when its file is shared
+SHARED_FIELDS = (
+    'file_hash', 'file_size', 'width', 'height', 'mime_type',
+    'processing_state', 'webp_size', 'avif_size',
+    'phash', 'phash_0', 'phash_1', 'phash_2', 'phash_3',
+)
+
+
+def find_blobs(file_hashes):
+    """
+    Look up stored files by hash
+    Returns:
+        Mapping of file hash -> (Blob, an Image already using it)
+    """
+    blobs = {blob.id: blob for blob in Blob.objects.filter(file_hash__in=file_hashes, ref_count__gt=0)}
+    found = {}
+    for image in Image.objects.filter(blob_id__in=blobs).order_by('blob_id', 'id'):
+        if image.file_hash not in found:
+            found[image.file_hash] = (blobs[image.blob_id], image)
+    return found
+
+
+async def afind_blobs(file_hashes):
+    """find_blobs with the async ORM"""
+    blobs = {blob.id: blob async for blob in Blob.objects.filter(file_hash__in=file_hashes, ref_count__gt=0)}
+    found = {}
+    async for image in Image.objects.filter(blob_id__in=blobs).order_by('blob_id', 'id'):
+        if image.file_hash not in found:
+            found[image.file_hash] = (blobs[image.blob_id], image)
+    return found
+
+
+def share_blob(image, blob, sibling):
+    """Point an unsaved Image at an existing stored file instead of storing a copy"""
+    image.blob = blob
+    image.image = blob.name
+    for field in SHARED_FIELDS:
+        setattr(image, field, getattr(sibling, field))
+
+
+def attach_blob(image):
+    """
+    Take a reference for an Image about to be saved, inside its transaction
+    Images prepared by share_blob add a reference to their Blob; images
+    with a newly stored file get a new Blob.
+    Raises:
+        ValueError: The shared file was released in the meantime
+    """
+    if image.blob_id:
+        if not Blob.objects.filter(id=image.blob_id, ref_count__gt=0).update(ref_count=F('ref_count') + 1):
+            raise ValueError("Stored file was just deleted, please upload again")
+        return
+
+    try:
+        with transaction.atomic():
+            image.blob = Blob.objects.create(
+                file_hash=image.file_hash, name=image.image.name, size=image.file_size, ref_count=1
+            )
+    except IntegrityError:
+        # The same content was stored concurrently by another request; this
+        # image keeps its own copy and stays outside the blob store
+        image.blob = None
+
+
+def release_blobs(images):
+    """
+    Drop the references of deleted images
+    Returns:
+        Names of the files no longer referenced, for remove_files once
+        the transaction has committed
+    """
+    freed = []
+    counts = Counter()
+    for image in images:
+        if image.blob_id is None:
+            freed.append(image.image.name)
+        else:
+            counts[image.blob_id] += 1
+    if not counts:
+        return freed
+
+    by_decrement = defaultdict(list)
+    for blob_id, count in counts.items():
+        by_decrement[count].append(blob_id)
+    with transaction.atomic():
+        for count, blob_ids in by_decrement.items():
+            Blob.objects.filter(id__in=blob_ids).update(ref_count=F('ref_count') - count)
+        unreferenced = Blob.objects.filter(id__in=counts, ref_count__lte=0)
+        freed.extend(unreferenced.values_list('name', flat=True))
+        unreferenced.delete()
+    return freed
+
+
+def remove_files(name):
+    """
+    Remove a stored file, its format variants and thumbnails
+    Returns:
+        Whether the file existed (always True with S3, which deletes in the background)
+    """
+    existed = default_storage.delete_many([name, pending_name(name)]) > 0
+    delete_variants(name)
+    delete_thumbnails(name)
+    return existed
+
+
+@transaction.atomic
+def reconcile():
+    """
+    Attach images stored before blobs existed and recount all references
+    Returns:
+        (blobs created, reference counts corrected, names of unreferenced
+        files to remove)
+    """
+    created = set()
+    legacy = Image.objects.filter(blob__isnull=True).order_by('id').only('id', 'image', 'file_hash', 'file_size')
+    for image in legacy.iterator():
+        blob = Blob.objects.filter(file_hash=image.file_hash).first()
+        if blob is None:
+            blob = Blob.objects.create(file_hash=image.file_hash, name=image.image.name, size=image.file_size)
+            created.add(blob.id)
+        # An older copy of content stored elsewhere keeps its own file
+        if blob.name == image.image.name:
+            Image.objects.filter(id=image.id).update(blob=blob)
+
+    counts = dict(
+        Image.objects.filter(blob__isnull=False).values('blob_id')
+        .annotate(refs=Count('id')).order_by().values_list('blob_id', 'refs')
+    )
+    corrected = 0
+    freed = []
+    for blob in Blob.objects.all().iterator():
+        refs = counts.get(blob.id, 0)
+        if refs == 0:
+            blob.delete()
+            if not Image.objects.filter(image=blob.name).exists():
+                freed.append(blob.name)
+        elif refs != blob.ref_count:
+            Blob.objects.filter(id=blob.id).update(ref_count=refs)
+            corrected += blob.id not in created
+    return len(created), corrected, freed
@@ -0,0 +1,214 @@
+"""
+Expired image sweeper
+Expired images are taken in (expires_at, id) order a batch at a time. Each
+batch is deleted with one DELETE, one usage update and one blob release in
+a short transaction, and the files no longer referenced (original, variants,
+thumbnails) are removed on a thread pool while the next batch is deleted. A run stops when no expired
+images are left or its time budget is spent; the rest is picked up by the
+next run.
+
+With STORAGE_LAYOUT=bucketed, fully expired tmp/<hour>/ buckets are dropped
+first with one range DELETE and one prefix removal each, which also takes
+their cached thumbnails.
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from .blobs import release_blobs, remove_files
+from .metrics import record_cleanup
+from .models import Blob, Image, ProcessingJob, TEMP_BUCKET_DIR, TEMP_BUCKET_FORMAT, pending_name
+from .page_cache import invalidate as invalidate_pages
+from .signals import batch_deletion
+from .thumbnails import delete_thumbnail_prefix
+from .usage import apply_usage, record_deletes
+
+logger = logging.getLogger(__name__)
+
+
+class SweepStats:
+    """Counters of one sweeper run"""
+
+    def __init__(self):
+        self.images = 0
+        self.files = 0
+        self.bytes = 0
+        self.batches = 0
+        self.buckets = 0
+        self.errors = []
+        self.finished = False
+        self.elapsed = 0.0
+
+    @property
+    def images_per_second(self):
+        return self.images / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def size_mb(self):
+        return round(self.bytes / (1024 * 1024), 2)
+
+
+def expired_images(now=None):
+    """Temporary images whose expiry time has passed"""
+    return Image.objects.filter(
+        is_temporary=True,
+        expires_at__isnull=False,
+        expires_at__lt=now or timezone.now(),
+    )
+
+
+def delete_batch(now, limit):
+    """
+    Delete up to `limit` expired images in one transaction
+    Returns:
+        (deleted Image instances, names of the files to remove)
+    Rows locked by another sweeper are skipped (PostgreSQL).
+    """
+    freed = []
+    with transaction.atomic():
+        images = list(
+            expired_images(now)
+            .select_for_update(skip_locked=True)
+            .order_by('expires_at', 'id')
+            .only('id', 'image', 'file_hash', 'file_size', 'view_count', 'user_id', 'blob_id')[:limit]
+        )
+        if images:
+            with batch_deletion():
+                Image.objects.filter(id__in=[image.id for image in images]).delete()
+            record_deletes(images)
+            freed = release_blobs(images)
+    return images, freed
+
+
+def expired_buckets(now):
+    """(name, start of hour) of the tmp/ buckets whose whole hour has expired, oldest first"""
+    names = sorted(default_storage.list_dirs(TEMP_BUCKET_DIR))
+    buckets = []
+    for name in names:
+        try:
+            start = datetime.strptime(name, TEMP_BUCKET_FORMAT).replace(tzinfo=dt_timezone.utc)
+        except ValueError:
+            continue
+        if start + timedelta(hours=1) <= now:
+            buckets.append((name, start))
+    return buckets
+
+
+def drop_bucket(name, start, now):
+    """
+    Delete a fully expired hour bucket: its rows in one DELETE, then its directory
+    Returns:
+        (images, bytes, files) removed, or None if the bucket still holds an
+        image that must be kept (made permanent or given a later expiry); its
+        expired images are then left to the row by row sweep.
+    """
+    prefix = f'{TEMP_BUCKET_DIR}/{name}/'
+    with transaction.atomic():
+        rows = expired_images(now).filter(
+            expires_at__gte=start,
+            expires_at__lt=start + timedelta(hours=1),
+            image__startswith=prefix,
+        )
+        totals = list(
+            rows.order_by().values('user_id')
+            .annotate(images=Count('id'), size=Sum('file_size'), views=Sum('view_count'))
+        )
+        ProcessingJob.objects.filter(image__in=rows).delete()
+        # Bypasses the per-row signal handlers; usage is updated below and
+        # the files go with the directory
+        rows._raw_delete(rows.db)
+        if Image.objects.filter(image__startswith=prefix).exists():
+            transaction.set_rollback(True)
+            return None
+        # Every image sharing a file in this bucket is gone with it
+        Blob.objects.filter(name__startswith=prefix).delete()
+        apply_usage(
+            {t['user_id']: (-t['images'], -t['size'], -t['views']) for t in totals},
+            create=False,
+        )
+
+    files = default_storage.delete_prefix(prefix) + default_storage.delete_prefix(pending_name(prefix))
+    delete_thumbnail_prefix(prefix)
+    return (
+        sum(t['images'] for t in totals),
+        sum(t['size'] for t in totals),
+        files,
+    )
+
+
+def sweep_expired(batch_size=500, max_seconds=0, max_rate=0, file_workers=8, on_batch=None):
+    """
+    Delete expired images within a time and rate budget
+    Args:
+        batch_size: Rows deleted per transaction
+        max_seconds: Stop starting new batches after this long (0 = no limit)
+        max_rate: Maximum images deleted per second (0 = no limit)
+        file_workers: Threads removing files
+        on_batch: Optional callback receiving each deleted batch
+    Returns:
+        SweepStats
+    """
+    stats = SweepStats()
+    now = timezone.now()
+    started = time.monotonic()
+    deadline = started + max_seconds if max_seconds else None
+
+    def collect(futures):
+        for name, future in futures:
+            try:
+                if future.result():
+                    stats.files += 1
+            except OSError as e:
+                logger.warning('Could not remove files of %s: %s', name, e)
+                stats.errors.append(f'{name}: {e}')
+
+    for name, start in expired_buckets(now):
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        dropped = drop_bucket(name, start, now)
+        if dropped:
+            stats.buckets += 1
+            stats.images += dropped[0]
+            stats.bytes += dropped[1]
+            stats.files += dropped[2]
+
+    previous = []
+    with ThreadPoolExecutor(max_workers=max(1, file_workers)) as pool:
+        while deadline is None or time.monotonic() < deadline:
+            images, freed = delete_batch(now, batch_size)
+            if not images:
+                stats.finished = True
+                break
+
+            stats.batches += 1
+            stats.images += len(images)
+            stats.bytes += sum(image.file_size for image in images)
+            if on_batch:
+                on_batch(images)
+
+            # Remove this batch's files while the previous batch is awaited,
+            # so at most two batches of files are in flight
+            current = [(name, pool.submit(remove_files, name)) for name in freed]
+            collect(previous)
+            previous = current
+
+            if max_rate:
+                ahead = stats.images / max_rate - (time.monotonic() - started)
+                if deadline is not None:
+                    ahead = min(ahead, deadline - time.monotonic())
+                if ahead > 0:
+                    time.sleep(ahead)
+        collect(previous)
+
+    stats.elapsed = time.monotonic() - started
+    if stats.images:
+        invalidate_pages()
+    record_cleanup(stats)
+    return stats
@@ -0,0 +1,179 @@
+"""
+HTTP helpers for serving image files: ETags and byte ranges
+"""
+
+import re
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+RANGE_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+# More ranges than this in one request is treated as abuse and ignored
+MAX_RANGES = 16
+
+CHUNK_SIZE = 64 * 1024
+
+
+def image_etag(image):
+    """Strong ETag for an image, the stored file never changes in place"""
+    return f'"{image.file_hash[:32]}-{image.file_size:x}"'
+
+
+def parse_range_header(header, size):
+    """
+    Parse a bytes Range header
+    Args:
+        header: Value of the Range header
+        size: Size of the file in bytes
+    Returns:
+        None if the header should be ignored (invalid or too many ranges),
+        [] if no range is satisfiable, else a list of (start, end) pairs
+        with inclusive ends.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec:
+        return None
+
+    parts = spec.split(',')
+    if len(parts) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for part in parts:
+        match = RANGE_RE.match(part)
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if first == '':
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length == 0:
+                continue
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            if start >= size:
+                continue
+            end = min(int(last), size - 1) if last else size - 1
+        ranges.append((start, end))
+    return ranges
+
+
+def if_range_matches(request, etag, last_modified):
+    """Check the If-Range precondition, ranges are only honoured if it holds"""
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    date = parse_http_date_safe(if_range)
+    return date is not None and date >= last_modified
+
+
+def _read_range(file_obj, start, end):
+    file_obj.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        data = file_obj.read(min(CHUNK_SIZE, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+
+def _stream_ranges(file_obj, ranges, content_type, size, boundary):
+    try:
+        if boundary is None:
+            start, end = ranges[0]
+            yield from _read_range(file_obj, start, end)
+            return
+        for start, end in ranges:
+            yield _part_header(boundary, content_type, start, end, size)
+            yield from _read_range(file_obj, start, end)
+            yield b'\r\n'
+        yield f'--{boundary}--\r\n'.encode()
+    finally:
+        file_obj.close()
+
+
+def _part_header(boundary, content_type, start, end, size):
+    return (
+        f'--{boundary}\r\n'
+        f'Content-Type: {content_type}\r\n'
+        f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'
+    ).encode()
+
+
+def range_response(file_obj, ranges, content_type, size):
+    """
+    Build a 206 response for one or more ranges, or 416 if none is satisfiable
+    The file object is closed once the response has been streamed.
+    """
+    if not ranges:
+        file_obj.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(
+            _stream_ranges(file_obj, ranges, content_type, size, None),
+            status=206, content_type=content_type
+        )
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = end - start + 1
+        return response
+
+    boundary = uuid.uuid4().hex
+    length = sum(
+        len(_part_header(boundary, content_type, start, end, size)) + (end - start + 1) + 2
+        for start, end in ranges
+    ) + len(f'--{boundary}--\r\n')
+    response = StreamingHttpResponse(
+        _stream_ranges(file_obj, ranges, content_type, size, boundary),
+        status=206, content_type=f'multipart/byteranges; boundary={boundary}'
+    )
+    response['Content-Length'] = length
+    return response
+
+
+def set_validators(response, etag, last_modified):
+    """Attach ETag and Last-Modified to a response"""
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+_END = object()
+
+
+async def aiterate(iterator):
+    """Consume a blocking iterator of chunks (file reads, S3 bodies) from threads"""
+    iterator = iter(iterator)
+    try:
+        while True:
+            chunk = await sync_to_async(next, thread_sensitive=False)(iterator, _END)
+            if chunk is _END:
+                return
+            yield chunk
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            await sync_to_async(close, thread_sensitive=False)()
+
+
+def async_streaming(response):
+    """
+    Make a streaming response async for the ASGI handler
+    Django 4.2 would otherwise read a synchronous iterator whole into memory
+    before sending it.
+    """
+    if response.streaming and not response.is_async:
+        response.streaming_content = aiterate(response.streaming_content)
+    return response
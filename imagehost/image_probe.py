@@ -0,0 +1,69 @@
+"""
+Header-only image probing
+Identifies the real format from magic bytes and reads dimensions without
+decoding any pixel data, so bad or oversized uploads are rejected cheaply.
+"""
+
+from collections import namedtuple
+
+from django.conf import settings
+from PIL import Image as PILImage
+
+ImageInfo = namedtuple('ImageInfo', ['mime_type', 'format', 'width', 'height', 'frames'])
+
+# (magic bytes, offset) -> (PIL format, mime type)
+MAGIC_NUMBERS = [
+    (b'\xff\xd8\xff', 0, 'JPEG', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 0, 'PNG', 'image/png'),
+    (b'GIF87a', 0, 'GIF', 'image/gif'),
+    (b'GIF89a', 0, 'GIF', 'image/gif'),
+    (b'WEBP', 8, 'WEBP', 'image/webp'),
+]
+
+
+def sniff_format(head):
+    """Return (PIL format, mime type) from the first bytes of a file, or (None, None)"""
+    for magic, offset, img_format, mime_type in MAGIC_NUMBERS:
+        if head[offset:offset + len(magic)] == magic:
+            if img_format == 'WEBP' and head[:4] != b'RIFF':
+                continue
+            return img_format, mime_type
+    return None, None
+
+
+def probe_image(image_file):
+    """
+    Read format, dimensions and frame count from the image header
+    Args:
+        image_file: File-like object, its position is restored to 0
+    Returns:
+        ImageInfo
+    Raises:
+        ValueError: Unsupported format, unreadable header or too many pixels
+    """
+    image_file.seek(0)
+    head = image_file.read(16)
+    image_file.seek(0)
+
+    img_format, mime_type = sniff_format(head)
+    if img_format is None or mime_type not in settings.ALLOWED_IMAGE_TYPES:
+        raise ValueError("Invalid file type")
+
+    try:
+        # open() only parses the header, pixels are decoded on load()
+        with PILImage.open(image_file, formats=[img_format]) as img:
+            width, height = img.size
+            frames = img.n_frames if getattr(img, 'is_animated', False) else 1
+    except PILImage.DecompressionBombError:
+        raise ValueError("Image dimensions too large")
+    except Exception:
+        raise ValueError("Invalid or corrupted image")
+    finally:
+        image_file.seek(0)
+
+    if width <= 0 or height <= 0:
+        raise ValueError("Invalid or corrupted image")
+    if width * height * frames > settings.MAX_IMAGE_PIXELS:
+        raise ValueError("Image dimensions too large")
+
+    return ImageInfo(mime_type, img_format, width, height, frames)
@@ -0,0 +1,160 @@
+"""
+Django management command to measure SQLite lock contention
+Runs the same mixed workload (image lookups, view count updates and inserts)
+from several processes against a scratch database, once with SQLite's
+defaults (rollback journal) and once with SQLITE_PRAGMAS (WAL), and reports
+throughput, latency and "database is locked" failures for each.
+The configured database is not touched.
+"""
+
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+SCHEMA = """
+CREATE TABLE image (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    file_hash TEXT NOT NULL UNIQUE,
+    file_size INTEGER NOT NULL,
+    view_count INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL
+)
+"""
+
+
+def _connect(path, pragmas, timeout):
+    conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    for name, value in pragmas:
+        conn.execute(f'PRAGMA {name} = {value}')
+    return conn
+
+
+def _prepare(path, pragmas, rows):
+    conn = _connect(path, pragmas, 30)
+    conn.execute(SCHEMA)
+    conn.execute('BEGIN')
+    conn.executemany(
+        'INSERT INTO image (file_hash, file_size, created_at) VALUES (?, ?, ?)',
+        ((f'seed-{i}', 1024, time.time()) for i in range(rows)),
+    )
+    conn.execute('COMMIT')
+    conn.close()
+
+
+def _worker(args):
+    """Run the workload until the deadline, returns per-operation stats"""
+    path, pragmas, timeout, deadline, write_ratio, rows, seed = args
+    rng = random.Random(seed)
+    conn = _connect(path, pragmas, timeout)
+    stats = {'read': [], 'write': [], 'locked': 0}
+
+    while time.time() < deadline:
+        is_write = rng.random() < write_ratio
+        started = time.perf_counter()
+        try:
+            if not is_write:
+                conn.execute('SELECT * FROM image WHERE id = ?', (rng.randint(1, rows),)).fetchone()
+            elif rng.random() < 0.5:
+                conn.execute('UPDATE image SET view_count = view_count + 1 WHERE id = ?', (rng.randint(1, rows),))
+            else:
+                conn.execute(
+                    'INSERT INTO image (file_hash, file_size, created_at) VALUES (?, ?, ?)',
+                    (f'{seed}-{rng.getrandbits(64):x}', 1024, time.time()),
+                )
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            stats['locked'] += 1
+            continue
+        stats['write' if is_write else 'read'].append(time.perf_counter() - started)
+
+    conn.close()
+    return stats
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Command(BaseCommand):
+    help = 'Compare SQLite lock contention with default settings and with SQLITE_PRAGMAS (WAL)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=8,
+            help='Number of concurrent processes (like gunicorn workers)',
+        )
+        parser.add_argument(
+            '--seconds',
+            type=float,
+            default=10,
+            help='Duration of each run',
+        )
+        parser.add_argument(
+            '--write-ratio',
+            type=float,
+            default=0.2,
+            help='Fraction of operations that write (default: 0.2)',
+        )
+        parser.add_argument(
+            '--rows',
+            type=int,
+            default=10000,
+            help='Number of rows in the scratch table',
+        )
+        parser.add_argument(
+            '--timeout',
+            type=float,
+            default=1.0,
+            help='Seconds a connection waits for a lock before failing',
+        )
+
+    def handle(self, *args, **options):
+        modes = [
+            ('default (rollback journal)', [('journal_mode', 'DELETE'), ('synchronous', 'FULL')]),
+            ('SQLITE_PRAGMAS (WAL)', [p for p in settings.SQLITE_PRAGMAS if p[0] != 'busy_timeout']),
+        ]
+
+        for label, pragmas in modes:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, 'benchmark.sqlite3')
+                _prepare(path, pragmas, options['rows'])
+
+                deadline = time.time() + options['seconds']
+                jobs = [
+                    (path, pragmas, options['timeout'], deadline,
+                     options['write_ratio'], options['rows'], seed)
+                    for seed in range(options['processes'])
+                ]
+                with Pool(options['processes']) as pool:
+                    results = pool.map(_worker, jobs)
+
+            reads = [t for r in results for t in r['read']]
+            writes = [t for r in results for t in r['write']]
+            locked = sum(r['locked'] for r in results)
+
+            self.stdout.write(self.style.SUCCESS(f'\n{label}:'))
+            self.stdout.write(f"  - {round((len(reads) + len(writes)) / options['seconds'])} ops/s")
+            self.stdout.write(
+                f'  - Reads: {len(reads)}, p50 {_percentile(reads, 0.5) * 1000:.2f} ms, '
+                f'p99 {_percentile(reads, 0.99) * 1000:.2f} ms'
+            )
+            self.stdout.write(
+                f'  - Writes: {len(writes)}, p50 {_percentile(writes, 0.5) * 1000:.2f} ms, '
+                f'p99 {_percentile(writes, 0.99) * 1000:.2f} ms'
+            )
+            if locked:
+                self.stdout.write(self.style.ERROR(f'  - {locked} "database is locked" errors'))
+            else:
+                self.stdout.write('  - No "database is locked" errors')
@@ -1,12 +1,14 @@
 """
 Django management command to clean up expired temporary images
-This command should be run periodically via cron
+This command should be run periodically via cron. Each run works within a
+time budget and holds a lock file, so it is safe to run every minute.
 """
 
-import os
+import fcntl
+
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.utils import timezone
-from imagehost.models import Image
+from imagehost.cleanup import expired_images, sweep_expired
 
 
 class Command(BaseCommand):
@@ -18,62 +20,89 @@ class Command(BaseCommand):
             action='store_true',
             help='Show what would be deleted without actually deleting',
         )
-
-    def handle(self, *args, **options):
-        dry_run = options['dry_run']
-
-        # Find expired images
-        now = timezone.now()
-        expired_images = Image.objects.filter(
-            is_temporary=True,
-            expires_at__isnull=False,
-            expires_at__lt=now
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.CLEANUP_BATCH_SIZE,
+            help='Images deleted per transaction (default: CLEANUP_BATCH_SIZE)',
+        )
+        parser.add_argument(
+            '--max-seconds',
+            type=float,
+            default=settings.CLEANUP_MAX_SECONDS,
+            help='Time budget of this run, 0 for no limit (default: CLEANUP_MAX_SECONDS)',
+        )
+        parser.add_argument(
+            '--max-rate',
+            type=float,
+            default=settings.CLEANUP_MAX_RATE,
+            help='Maximum images deleted per second, 0 for no limit (default: CLEANUP_MAX_RATE)',
+        )
+        parser.add_argument(
+            '--file-workers',
+            type=int,
+            default=settings.CLEANUP_FILE_WORKERS,
+            help='Threads removing files (default: CLEANUP_FILE_WORKERS)',
         )
 
-        count = expired_images.count()
-
-        if count == 0:
-            self.stdout.write(self.style.SUCCESS('No expired images found.'))
-            return
-
-        if dry_run:
-            self.stdout.write(
-                self.style.WARNING(f'[DRY RUN] Would delete {count} expired images:')
-            )
-            for img in expired_images:
-                self.stdout.write(f'  - {img.original_filename} (expired at {img.expires_at})')
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            self.dry_run(options['batch_size'])
             return
 
-        # Delete expired images
-        deleted_files = 0
-        deleted_records = 0
-        errors = []
-
-        for img in expired_images:
+        # Skip this run if the previous one is still going
+        with open(settings.CLEANUP_LOCK_FILE, 'a') as lock:
             try:
-                # Delete physical file
-                if img.image and os.path.exists(img.image.path):
-                    os.remove(img.image.path)
-                    deleted_files += 1
-                    self.stdout.write(f'Deleted file: {img.image.path}')
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.stdout.write(self.style.WARNING('Another cleanup is running, skipping.'))
+                return
 
-                # Delete database record
-                img.delete()
-                deleted_records += 1
+            on_batch = None
+            if options['verbosity'] >= 2:
+                def on_batch(images):
+                    for image in images:
+                        self.stdout.write(f'Deleted: {image.image.name}')
 
-            except Exception as e:
-                error_msg = f'Error deleting {img.original_filename}: {str(e)}'
-                errors.append(error_msg)
-                self.stdout.write(self.style.ERROR(error_msg))
+            stats = sweep_expired(
+                batch_size=options['batch_size'],
+                max_seconds=options['max_seconds'],
+                max_rate=options['max_rate'],
+                file_workers=options['file_workers'],
+                on_batch=on_batch,
+            )
+
+        if not stats.images:
+            self.stdout.write(self.style.SUCCESS('No expired images found.'))
+            return
 
         # Summary
-        self.stdout.write(self.style.SUCCESS(
-            f'\nCleanup completed:'
-        ))
-        self.stdout.write(f'  - Deleted {deleted_files} files')
-        self.stdout.write(f'  - Deleted {deleted_records} database records')
+        self.stdout.write(self.style.SUCCESS('\nCleanup completed:'))
+        self.stdout.write(f'  - Deleted {stats.images} database records in {stats.batches} batches')
+        if stats.buckets:
+            self.stdout.write(f'  - Dropped {stats.buckets} expired storage buckets')
+        self.stdout.write(f'  - Deleted {stats.files} files ({stats.size_mb} MB)')
+        self.stdout.write(f'  - {stats.elapsed:.2f}s, {stats.images_per_second:.1f} images/s')
+        if not stats.finished:
+            self.stdout.write(self.style.WARNING('  - Time budget reached, the rest is left for the next run'))
 
-        if errors:
-            self.stdout.write(self.style.ERROR(f'  - {len(errors)} errors occurred'))
+        if stats.errors:
+            self.stdout.write(self.style.ERROR(f'  - {len(stats.errors)} errors occurred'))
+            for error in stats.errors[:20]:
+                self.stdout.write(self.style.ERROR(f'    {error}'))
         else:
             self.stdout.write(self.style.SUCCESS('  - No errors'))
+
+    def dry_run(self, batch_size):
+        expired = expired_images().order_by('expires_at', 'id')
+        count = expired.count()
+        if count == 0:
+            self.stdout.write(self.style.SUCCESS('No expired images found.'))
+            return
+
+        self.stdout.write(
+            self.style.WARNING(f'[DRY RUN] Would delete {count} expired images:')
+        )
+        rows = expired.values_list('original_filename', 'expires_at').iterator(chunk_size=batch_size)
+        for original_filename, expires_at in rows:
+            self.stdout.write(f'  - {original_filename} (expired at {expires_at})')
@@ -0,0 +1,85 @@
+"""
+Django management command to compute missing perceptual hashes
+New images get theirs from the process_images worker; run this once after
+upgrading to index existing images for near-duplicate lookup.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import connections
+from imagehost.models import Image
+from imagehost.perceptual import dhash, hash_fields
+
+
+class Command(BaseCommand):
+    help = 'Compute perceptual hashes for images that have none'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=settings.IMAGE_PROCESSING_WORKERS,
+            help='Number of worker processes (default: IMAGE_PROCESSING_WORKERS)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=200,
+            help='Files hashed per batch',
+        )
+
+    def handle(self, *args, **options):
+        hashed = failed = 0
+        batch_size = max(1, options['batch_size'])
+
+        # Worker processes must not inherit the parent's database connection
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=max(1, options['workers'])) as pool:
+            last_id = 0
+            while True:
+                # One image per stored file, images sharing it are updated together
+                batch = list(
+                    # process_images hashes pending uploads once they are compressed
+                    Image.objects.filter(phash__isnull=True, id__gt=last_id)
+                    .exclude(processing_state=Image.STATE_PENDING)
+                    .order_by('id').only('id', 'image', 'blob_id')[:batch_size]
+                )
+                if not batch:
+                    break
+                last_id = batch[-1].id
+
+                files = {image.image.name: image for image in batch}
+                hashes = {}
+                with ExitStack() as local_files:
+                    futures = {}
+                    for name in files:
+                        try:
+                            path = local_files.enter_context(default_storage.local_file(name))
+                            futures[name] = pool.submit(dhash, path)
+                        except Exception as e:
+                            hashes[name] = e
+                    for name, future in futures.items():
+                        try:
+                            hashes[name] = future.result()
+                        except Exception as e:
+                            hashes[name] = e
+
+                for name, image in files.items():
+                    if isinstance(hashes[name], Exception):
+                        failed += 1
+                        self.stdout.write(self.style.ERROR(f'Failed: {name}: {hashes[name]}'))
+                        continue
+                    fields = hash_fields(hashes[name])
+                    if image.blob_id:
+                        hashed += Image.objects.filter(blob_id=image.blob_id).update(**fields)
+                    else:
+                        hashed += Image.objects.filter(id=image.id).update(**fields)
+
+        self.stdout.write(self.style.SUCCESS('\nPerceptual hashes computed:'))
+        self.stdout.write(f'  - Updated {hashed} images')
+        if failed:
+            self.stdout.write(self.style.ERROR(f'  - {failed} failures'))
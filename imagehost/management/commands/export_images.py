@@ -0,0 +1,93 @@
+"""
+Django management command to export images and their files to an archive
+The archive is a tar stream written batch by batch (see imagehost/archive.py),
+so it can go straight to another host:
+
+    python manage.py export_images -o - | ssh new-host 'docker compose exec -T web python manage.py import_images -i -'
+
+Pass the printed last id as --since-id to export only newer images later.
+"""
+
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from imagehost.archive import export_archive
+
+
+class Command(BaseCommand):
+    help = 'Export images and their files to a tar archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-o', '--output',
+            required=True,
+            help='Archive path, or - for stdout',
+        )
+        parser.add_argument(
+            '--since-id',
+            type=int,
+            default=0,
+            help='Only export images with a larger id (the last id of a previous export)',
+        )
+        parser.add_argument(
+            '--since',
+            help='Only export images created at or after this time (ISO 8601)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Images per manifest batch',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=8,
+            help='Threads reading stored files',
+        )
+        parser.add_argument(
+            '--gzip',
+            action='store_true',
+            help='Compress the archive (stored images rarely shrink much)',
+        )
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError(f"Invalid --since: {options['since']}")
+
+        # The archive may be on stdout, report on stderr then
+        out = self.stderr if options['output'] == '-' else self.stdout
+
+        on_batch = None
+        if options['verbosity'] >= 2:
+            def on_batch(images):
+                out.write(f'Exported {len(images)} images up to id {images[-1].id}')
+
+        kwargs = dict(
+            since_id=options['since_id'],
+            since=since,
+            batch_size=max(1, options['batch_size']),
+            workers=options['workers'],
+            compress=options['gzip'],
+            on_batch=on_batch,
+        )
+        if options['output'] == '-':
+            stats = export_archive(sys.stdout.buffer, **kwargs)
+        else:
+            with open(options['output'], 'wb') as archive:
+                stats = export_archive(archive, **kwargs)
+
+        out.write(self.style.SUCCESS('\nExport completed:'))
+        out.write(f'  - Exported {stats.images} images in {stats.batches} batches')
+        out.write(f'  - Wrote {stats.files} files ({stats.size_mb} MB)')
+        out.write(f'  - Last id: {stats.last_id} (use --since-id {stats.last_id} for the next export)')
+        if stats.errors:
+            out.write(self.style.ERROR(f'  - {len(stats.errors)} files could not be read:'))
+            for error in stats.errors:
+                out.write(f'    {error}')
+        else:
+            out.write('  - No errors')
@@ -0,0 +1,58 @@
+"""
+Django management command to import an archive written by export_images
+Images already present are skipped, so an interrupted import is resumed by
+running the same command again. Files whose content is already stored here
+are not written again. Import incremental archives in the order they were
+exported.
+"""
+
+import sys
+import tarfile
+
+from django.core.management.base import BaseCommand, CommandError
+from imagehost.archive import import_archive
+
+
+class Command(BaseCommand):
+    help = 'Import images and their files from an export_images archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-i', '--input',
+            required=True,
+            help='Archive path, or - for stdin (plain or gzip)',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=8,
+            help='Threads writing files to storage',
+        )
+
+    def handle(self, *args, **options):
+        on_batch = None
+        if options['verbosity'] >= 2:
+            def on_batch(images):
+                self.stdout.write(f'Imported {len(images)} images')
+
+        try:
+            if options['input'] == '-':
+                stats = import_archive(sys.stdin.buffer, workers=options['workers'], on_batch=on_batch)
+            else:
+                with open(options['input'], 'rb') as archive:
+                    stats = import_archive(archive, workers=options['workers'], on_batch=on_batch)
+        except (ValueError, tarfile.TarError) as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS('\nImport completed:'))
+        self.stdout.write(f'  - Imported {stats.images} images in {stats.batches} batches')
+        self.stdout.write(f'  - Stored {stats.files} files ({stats.size_mb} MB)')
+        self.stdout.write(f'  - Skipped {stats.skipped} images already present')
+        if stats.users:
+            self.stdout.write(f'  - Created {stats.users} users (without password, reset it in the admin)')
+        if stats.errors:
+            self.stdout.write(self.style.ERROR(f'  - {len(stats.errors)} errors:'))
+            for error in stats.errors:
+                self.stdout.write(f'    {error}')
+        else:
+            self.stdout.write('  - No errors')
@@ -0,0 +1,158 @@
+"""
+Django management command to count image views from nginx access logs
+Nginx serves /i/ straight from disk, so most views never reach Django.
+This command should be run periodically via cron, e.g. every minute.
+"""
+
+import json
+import os
+import re
+from collections import Counter
+from urllib.parse import unquote
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from imagehost.view_counts import apply_view_counts, viewed_images
+
+# Matches the request and status of the "main" log_format in nginx/nginx.conf
+LOG_LINE_RE = re.compile(rb'"GET (?P<path>[^ ?"]+)(?:\?[^ "]*)? HTTP/[0-9.]+" (?P<status>\d{3}) ')
+
+# Statuses that count as a view (full response or browser revalidation)
+COUNTED_STATUSES = {b'200', b'304'}
+
+# Maximum number of paths in a single image lookup query
+LOOKUP_BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = 'Count image views from nginx access logs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--log-file',
+            default=settings.NGINX_ACCESS_LOG,
+            help='Path of the nginx access log (default: NGINX_ACCESS_LOG)',
+        )
+        parser.add_argument(
+            '--state-file',
+            default=settings.ACCESS_LOG_STATE_FILE,
+            help='Where the read position is remembered between runs',
+        )
+        parser.add_argument(
+            '--batch-lines',
+            type=int,
+            default=50000,
+            help='Number of log lines aggregated before counts are written',
+        )
+        parser.add_argument(
+            '--from-start',
+            action='store_true',
+            help='Ignore the saved position and read the whole log again',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show the counts without updating the database or the position',
+        )
+
+    def handle(self, *args, **options):
+        log_file = options['log_file']
+        self.state_file = options['state_file']
+        self.batch_lines = options['batch_lines']
+        self.dry_run = options['dry_run']
+
+        if not os.path.exists(log_file):
+            raise CommandError(f'Access log not found: {log_file}')
+
+        state = {} if options['from_start'] else self.load_state()
+        current_inode = os.stat(log_file).st_ino
+        self.total_lines = 0
+        self.total_views = 0
+
+        # The log was rotated since the last run: finish the old file first
+        if state.get('inode') and state['inode'] != current_inode:
+            rotated = f'{log_file}.1'
+            if os.path.exists(rotated) and os.stat(rotated).st_ino == state['inode']:
+                self.stdout.write(f'Finishing rotated log: {rotated}')
+                self.ingest(rotated, state['inode'], state.get('offset', 0))
+            state = {}
+
+        offset = state.get('offset', 0)
+        if offset > os.path.getsize(log_file):
+            # Truncated in place (copytruncate)
+            offset = 0
+
+        self.ingest(log_file, current_inode, offset)
+
+        self.stdout.write(self.style.SUCCESS('\nIngestion completed:'))
+        self.stdout.write(f'  - Read {self.total_lines} log lines')
+        self.stdout.write(f'  - Counted {self.total_views} image views')
+
+    def ingest(self, path, inode, offset):
+        """Read complete lines from offset and apply counts batch by batch"""
+        media_prefix = settings.MEDIA_URL.encode()
+        hits = Counter()
+        lines = 0
+
+        with open(path, 'rb') as log:
+            log.seek(offset)
+            for line in log:
+                # Leave a partially written last line for the next run
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                lines += 1
+
+                match = LOG_LINE_RE.search(line)
+                if (match and match.group('status') in COUNTED_STATUSES
+                        and match.group('path').startswith(media_prefix)):
+                    hits[match.group('path')[len(media_prefix):]] += 1
+
+                if lines >= self.batch_lines:
+                    self.apply(hits, inode, offset, lines)
+                    hits = Counter()
+                    lines = 0
+
+        self.apply(hits, inode, offset, lines)
+
+    def apply(self, hits, inode, offset, lines):
+        """Write one batch of counts, then remember how far we got"""
+        self.total_lines += lines
+        if hits:
+            counts = self.resolve(hits)
+            self.total_views += sum(counts.values())
+            if self.dry_run:
+                for image_id, count in counts.items():
+                    self.stdout.write(f'  - image {image_id}: +{count}')
+            else:
+                apply_view_counts(counts)
+
+        if not self.dry_run:
+            self.save_state({'inode': inode, 'offset': offset})
+
+    def resolve(self, hits):
+        """Map image paths to the ids of the images credited, unknown paths are dropped"""
+        by_name = Counter()
+        for raw_path, count in hits.items():
+            by_name[unquote(raw_path.decode('utf-8', 'replace'))] += count
+
+        counts = Counter()
+        names = list(by_name)
+        for start in range(0, len(names), LOOKUP_BATCH_SIZE):
+            for name, image_id in viewed_images(names[start:start + LOOKUP_BATCH_SIZE]):
+                counts[image_id] += by_name[name]
+        return counts
+
+    def load_state(self):
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self, state):
+        # Write then rename so a crash never leaves a half-written state file
+        tmp_file = f'{self.state_file}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_file, self.state_file)
@@ -0,0 +1,111 @@
+"""
+Django management command to compress queued images in the background
+Compresses uploads stored by IMAGE_PROCESSING_MODE=async and generates the
+WebP/AVIF variants and perceptual hashes of new images. Run it as a
+long-lived worker (see the worker service in docker-compose.yml) or from
+cron with --once.
+"""
+
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import connections
+from imagehost.models import Image
+from imagehost.processing import (
+    claim_jobs, complete_job, current_name, fail_job, process_file, publish_file,
+)
+from imagehost.variants import enabled_formats, variant_name
+
+
+class Command(BaseCommand):
+    help = 'Compress queued images and generate their format variants'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=settings.IMAGE_PROCESSING_WORKERS,
+            help='Number of worker processes (default: IMAGE_PROCESSING_WORKERS)',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Process the current queue and exit',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1.0,
+            help='Seconds to wait when the queue is empty',
+        )
+        parser.add_argument(
+            '--max-attempts',
+            type=int,
+            default=3,
+            help='Give up on an image after this many failures',
+        )
+
+    def handle(self, *args, **options):
+        workers = max(1, options['workers'])
+        variant_formats = enabled_formats()
+        processed = failed = 0
+
+        # Worker processes must not inherit the parent's database connection
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while True:
+                jobs = claim_jobs(limit=workers * 2)
+                if not jobs:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+
+                futures = []
+                for job in jobs:
+                    name = job.image.image.name
+                    # With S3 the worker processes a downloaded copy, the
+                    # result and its variants are uploaded when it is closed
+                    files = ExitStack()
+                    try:
+                        source = current_name(job.image)
+                        path = files.enter_context(default_storage.local_file(
+                            source, write_back=[variant_name(source, fmt) for fmt in variant_formats]
+                        ))
+                    except Exception as e:
+                        fail_job(job, str(e), options['max_attempts'])
+                        failed += 1
+                        self.stdout.write(self.style.ERROR(f'Failed: {name}: {e}'))
+                        continue
+                    futures.append((job, source, files, pool.submit(
+                        process_file,
+                        path,
+                        job.image.mime_type,
+                        job.image.processing_state == Image.STATE_PENDING,
+                        variant_formats,
+                        settings.COMPRESSION_QUALITY,
+                        settings.MAX_IMAGE_DIMENSION,
+                        settings.PERCEPTUAL_HASH_ENABLED and job.image.phash is None,
+                    )))
+
+                for job, source, files, future in futures:
+                    try:
+                        with files:
+                            fields = future.result()
+                        publish_file(source, job.image.image.name, fields)
+                        complete_job(job, fields)
+                        processed += 1
+                        self.stdout.write(f'Processed: {job.image.image.name}')
+                    except Exception as e:
+                        fail_job(job, str(e), options['max_attempts'])
+                        failed += 1
+                        self.stdout.write(self.style.ERROR(f'Failed: {job.image.image.name}: {e}'))
+
+        self.stdout.write(self.style.SUCCESS('\nProcessing completed:'))
+        self.stdout.write(f'  - Processed {processed} images')
+        if failed:
+            self.stdout.write(self.style.ERROR(f'  - {failed} failures'))
@@ -0,0 +1,27 @@
+"""
+Django management command to cap the thumbnail cache size
+Least recently used thumbnails are removed first. Run it periodically via cron.
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from imagehost.thumbnails import prune_thumbnails
+
+
+class Command(BaseCommand):
+    help = 'Remove least recently used thumbnails until the cache fits its size limit'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-bytes',
+            type=int,
+            default=settings.THUMBNAIL_CACHE_MAX_BYTES,
+            help='Cache size limit in bytes (default: THUMBNAIL_CACHE_MAX_BYTES)',
+        )
+
+    def handle(self, *args, **options):
+        removed, freed, remaining = prune_thumbnails(options['max_bytes'])
+
+        self.stdout.write(self.style.SUCCESS('Thumbnail cache pruned:'))
+        self.stdout.write(f'  - Removed {removed} files ({round(freed / (1024 * 1024), 2)} MB)')
+        self.stdout.write(f'  - Cache size {round(remaining / (1024 * 1024), 2)} MB')
@@ -0,0 +1,22 @@
+"""
+Django management command to rebuild the blob store references
+Run it once after upgrading to attach existing images to blobs, and to
+repair reference counts after manual database edits.
+"""
+
+from django.core.management.base import BaseCommand
+from imagehost.blobs import reconcile, remove_files
+
+
+class Command(BaseCommand):
+    help = 'Attach images to shared stored files and recompute reference counts'
+
+    def handle(self, *args, **options):
+        created, corrected, freed = reconcile()
+        for name in freed:
+            remove_files(name)
+
+        self.stdout.write(self.style.SUCCESS('Blobs reconciled:'))
+        self.stdout.write(f'  - Created {created} blobs')
+        self.stdout.write(f'  - Corrected {corrected} reference counts')
+        self.stdout.write(f'  - Removed {len(freed)} unreferenced files')
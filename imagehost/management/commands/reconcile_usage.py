@@ -0,0 +1,16 @@
+"""
+Django management command to rebuild the usage counters
+The counters are kept up to date incrementally; run this after manual
+database edits or to repair drift, e.g. nightly via cron.
+"""
+
+from django.core.management.base import BaseCommand
+from imagehost.usage import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Recompute per-user and global usage statistics from the image table'
+
+    def handle(self, *args, **options):
+        written = reconcile()
+        self.stdout.write(self.style.SUCCESS(f'Reconciled {written} usage rows.'))
@@ -0,0 +1,262 @@
+"""
+Django management command to run the benchmark suite
+Runs offline in a temporary directory: the command starts itself again
+with MEDIA_ROOT and DATABASE_URL pointing at a scratch SQLite database, so
+the configured database and images are never touched. Scenarios:
+- micro: calculate_hash and compress_image on a synthetic corpus
+- upload, serve, list: concurrent HTTP requests against a local gunicorn
+- cleanup: cleanup_expired_images on a seeded backlog
+Results are written to JSON; pass an earlier file as --compare to see the
+change between commits.
+"""
+
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import django
+import PIL
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from imagehost import benchmarks
+
+SCENARIOS = ('micro', 'upload', 'serve', 'list', 'cleanup')
+
+# Set in the isolated run, points at its temporary directory
+ROOT_ENV = 'IMAGEHOST_BENCHMARK_ROOT'
+
+
+class Command(BaseCommand):
+    help = 'Benchmark hashing, compression, upload, serve, list and cleanup in a scratch environment'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-o', '--output',
+            default='benchmark.json',
+            help='Where the JSON results are written (default: benchmark.json)',
+        )
+        parser.add_argument(
+            '--scenarios',
+            default=','.join(SCENARIOS),
+            help=f"Comma-separated scenarios to run (default: {','.join(SCENARIOS)})",
+        )
+        parser.add_argument(
+            '--compare',
+            help='Earlier results file to compare with',
+        )
+        parser.add_argument(
+            '--corpus-size',
+            type=int,
+            default=15,
+            help='Number of synthetic images (cycles through 5 kinds x 3 sizes)',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Seed of the synthetic corpus',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Repetitions of each micro-benchmark',
+        )
+        parser.add_argument(
+            '--gunicorn-workers',
+            type=int,
+            default=4,
+            help='gunicorn workers for the HTTP scenarios (the Dockerfile uses 4)',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=8,
+            help='Concurrent HTTP clients',
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=1000,
+            help='Requests per serve and list benchmark',
+        )
+        parser.add_argument(
+            '--list-rows',
+            type=int,
+            default=20000,
+            help='Image rows seeded for the list scenario',
+        )
+        parser.add_argument(
+            '--cleanup-rows',
+            type=int,
+            default=5000,
+            help='Expired images seeded for the cleanup scenario',
+        )
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            help='Keep the temporary directory (corpus, database, gunicorn log)',
+        )
+
+    def handle(self, *args, **options):
+        scenarios = [name for name in options['scenarios'].split(',') if name]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+        if not os.environ.get(ROOT_ENV):
+            self.run_isolated(options)
+            return
+
+        root = os.environ[ROOT_ENV]
+        call_command('migrate', run_syncdb=True, verbosity=0)
+        corpus = benchmarks.generate_corpus(os.path.join(root, 'corpus'), options['corpus_size'], options['seed'])
+        self.stdout.write(f'Corpus: {len(corpus)} images, {sum(i.size for i in corpus) / (1024 * 1024):.1f} MB')
+
+        results = {}
+        if 'micro' in scenarios:
+            self.stdout.write('Running micro-benchmarks...')
+            results.update(benchmarks.bench_hash(corpus, options['repeat']))
+            results.update(benchmarks.bench_compress(corpus, max(1, options['repeat'] // 5)))
+
+        if {'upload', 'serve', 'list'} & set(scenarios):
+            log_path = os.path.join(root, 'gunicorn.log')
+            with benchmarks.gunicorn_server(options['gunicorn_workers'], log_path) as port:
+                # serve and list need stored images, they come from the uploads
+                self.stdout.write('Running HTTP scenarios...')
+                results['upload'], paths = benchmarks.bench_upload(port, corpus, options['concurrency'])
+                if 'serve' in scenarios and paths:
+                    results.update(benchmarks.bench_serve(
+                        port, paths, options['requests'], options['concurrency']
+                    ))
+                if 'list' in scenarios and paths:
+                    stored = paths[0][len(settings.MEDIA_URL):]
+                    benchmarks.seed_images(options['list_rows'], lambda i: stored)
+                    results.update(benchmarks.bench_list(
+                        port, options['requests'], options['concurrency'],
+                        depth=max(1, options['list_rows'] // 2),
+                    ))
+            if 'upload' not in scenarios:
+                del results['upload']
+
+        if 'cleanup' in scenarios:
+            self.stdout.write('Running cleanup...')
+            results.update(benchmarks.bench_cleanup(
+                options['cleanup_rows'], settings.CLEANUP_BATCH_SIZE, settings.CLEANUP_FILE_WORKERS
+            ))
+
+        report = {'meta': self.metadata(options, scenarios), 'results': results}
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+        self.print_results(results)
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            self.print_comparison(benchmarks.compare_results(report, baseline), baseline['meta'])
+        self.stdout.write(self.style.SUCCESS(f"\nResults written to {options['output']}"))
+
+    def run_isolated(self, options):
+        """Start this command again against a scratch database and MEDIA_ROOT"""
+        root = tempfile.mkdtemp(prefix='imagehost-benchmark-')
+        env = dict(
+            os.environ,
+            **{
+                ROOT_ENV: root,
+                'MEDIA_ROOT': os.path.join(root, 'media'),
+                'THUMBNAIL_ROOT': os.path.join(root, 'media', '_thumbs'),
+                'DATABASE_URL': f"sqlite:///{os.path.join(root, 'db.sqlite3')}",
+                'CLEANUP_LOCK_FILE': os.path.join(root, 'cleanup.lock'),
+                'METRICS_FILE': os.path.join(root, 'metrics.json'),
+                'PAGE_CACHE_GENERATION_FILE': os.path.join(root, 'page_generation'),
+                # bench_list repeats the same requests, measure the queries rather than cache hits
+                'PAGE_CACHE_ENABLED': 'False',
+                'ADMISSION_STATE_DIR': os.path.join(root, 'admission'),
+                # Measure the upload pipeline, not the admission limits
+                'UPLOAD_RATE_PER_IP': '0',
+                'MAX_CONCURRENT_COMPRESSIONS': '0',
+                'ACCESS_LOG_STATE_FILE': os.path.join(root, 'access_log_state.json'),
+                'STORAGE_BACKEND': 'filesystem',
+                'IMAGE_SERVE_MODE': 'django',
+                'DEBUG': 'False',
+                'FORCE_HTTPS': 'False',
+                'ALLOWED_HOSTS': '127.0.0.1,localhost',
+                'REQUIRE_AUTH': 'False',
+                'ALLOW_GUEST_UPLOAD': 'True',
+            },
+        )
+        argv = [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), 'run_benchmarks']
+        for name in ('output', 'scenarios', 'compare', 'corpus_size', 'seed', 'repeat', 'gunicorn_workers',
+                     'concurrency', 'requests', 'list_rows', 'cleanup_rows'):
+            if options[name] is not None:
+                value = os.path.abspath(options[name]) if name in ('output', 'compare') else options[name]
+                argv += [f"--{name.replace('_', '-')}", str(value)]
+        try:
+            status = subprocess.call(argv, env=env)
+        finally:
+            if options['keep']:
+                self.stdout.write(f'Kept {root}')
+            else:
+                shutil.rmtree(root, ignore_errors=True)
+        if status:
+            raise CommandError(f'Benchmark run failed with status {status}')
+
+    def metadata(self, options, scenarios):
+        try:
+            commit = subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return {
+            'commit': commit,
+            'created_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'pillow': PIL.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'scenarios': scenarios,
+            'options': {
+                name: options[name] for name in (
+                    'corpus_size', 'seed', 'repeat', 'gunicorn_workers', 'concurrency',
+                    'requests', 'list_rows', 'cleanup_rows',
+                )
+            },
+            'settings': {
+                name: getattr(settings, name) for name in (
+                    'ENABLE_IMAGE_COMPRESSION', 'COMPRESSION_QUALITY', 'MAX_IMAGE_DIMENSION',
+                    'IMAGE_PROCESSING_MODE', 'UPLOAD_PROCESS_WORKERS', 'IMAGE_VARIANT_FORMATS',
+                    'STORAGE_LAYOUT', 'CLEANUP_BATCH_SIZE', 'CLEANUP_FILE_WORKERS',
+                )
+            },
+        }
+
+    def print_results(self, results):
+        self.stdout.write(self.style.SUCCESS('\nBenchmark results:'))
+        for key, result in sorted(results.items()):
+            line = f"  - {key}: p50 {result.get('p50_ms', 0)} ms, p99 {result.get('p99_ms', 0)} ms"
+            if 'requests_per_second' in result:
+                line += f", {result['requests_per_second']} req/s"
+                if result.get('errors') or result.get('non_2xx'):
+                    line += f", {result['errors']} errors, {result['non_2xx']} non-2xx"
+            if 'mb_per_second' in result:
+                line += f", {result['mb_per_second']} MB/s"
+            if 'size_ratio' in result:
+                line += f", size x{result['size_ratio']}"
+            if key == 'cleanup':
+                line = f"  - cleanup: {result['images']} images in {result['seconds']}s, " \
+                       f"{result['images_per_second']} images/s"
+            self.stdout.write(line)
+
+    def print_comparison(self, rows, baseline_meta):
+        self.stdout.write(self.style.SUCCESS(f"\nCompared with {baseline_meta.get('commit') or 'baseline'}:"))
+        for key, field, old, new, change, better in rows:
+            style = self.style.SUCCESS if better else self.style.ERROR
+            line = f'  - {key} {field}: {old} -> {new} ({change:+.1f}%)'
+            self.stdout.write(style(line) if abs(change) >= 5 else line)
@@ -0,0 +1,297 @@
+"""
+Request timing and Prometheus-style metrics
+
+Counters and histograms are accumulated in a per-process CounterBuffer and
+merged into METRICS_FILE under a file lock every METRICS_FLUSH_INTERVAL
+seconds, so the /metrics endpoint of any gunicorn worker (and the numbers
+recorded by management commands) report the totals of all processes.
+
+RequestTimer measures the stages of a request; the timed decorator sends
+them as a Server-Timing header and records them in imagehost_stage_seconds.
+"""
+
+import asyncio
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+
+from .view_counts import CounterBuffer
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+RATIO_BUCKETS = (0.1, 0.25, 0.5, 0.75, 0.9, 1, 1.25, 1.5, 2, 5)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    'imagehost_stage_seconds': (
+        'histogram', 'Time spent in each stage of a request', TIME_BUCKETS),
+    'imagehost_request_seconds': (
+        'histogram', 'Total time of instrumented requests', TIME_BUCKETS),
+    'imagehost_received_bytes_total': (
+        'counter', 'Bytes of uploaded files received', None),
+    'imagehost_sent_bytes_total': (
+        'counter', 'Bytes of image files sent', None),
+    'imagehost_compression_input_bytes_total': (
+        'counter', 'Bytes of images before compression', None),
+    'imagehost_compression_output_bytes_total': (
+        'counter', 'Bytes of images after compression', None),
+    'imagehost_compression_ratio': (
+        'histogram', 'Compressed size divided by original size', RATIO_BUCKETS),
+    'imagehost_dedup_total': (
+        'counter', 'Uploaded files by deduplication result', None),
+    'imagehost_admission_rejected_total': (
+        'counter', 'Uploads turned away by rate limits (ip, token) or a full compression cap (busy)', None),
+    'imagehost_cleanup_runs_total': (
+        'counter', 'Expired image sweeps', None),
+    'imagehost_cleanup_images_total': (
+        'counter', 'Expired images deleted', None),
+    'imagehost_cleanup_files_total': (
+        'counter', 'Files removed by the expired image sweep', None),
+    'imagehost_cleanup_bytes_total': (
+        'counter', 'Bytes of expired images deleted', None),
+    'imagehost_cleanup_seconds_total': (
+        'counter', 'Time spent sweeping expired images', None),
+}
+
+
+def _format_float(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _labels(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def merge_into_file(pending, path=None):
+    """
+    Add pending samples to the metrics file
+    Args:
+        pending: Mapping of (sample name, labels) -> increment
+    The file is rewritten atomically while holding an exclusive lock on
+    path + '.lock', so concurrent processes never lose each other's counts.
+    """
+    path = path or settings.METRICS_FILE
+    with open(f'{path}.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        samples = read_samples(path)
+        for key, value in pending.items():
+            samples[key] = samples.get(key, 0) + value
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                json.dump([[name, list(labels), value] for (name, labels), value in samples.items()], tmp)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def read_samples(path=None):
+    """Samples stored in the metrics file as {(sample name, labels): value}"""
+    try:
+        with open(path or settings.METRICS_FILE) as f:
+            rows = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return {(name, tuple(tuple(pair) for pair in labels)): value for name, labels, value in rows}
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    """Get the process-wide metrics buffer"""
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = CounterBuffer(
+                    merge_into_file,
+                    flush_interval=settings.METRICS_FLUSH_INTERVAL,
+                    max_buffer=10000,
+                    name='metrics-flusher',
+                )
+    return _buffer
+
+
+def inc(name, value=1, **labels):
+    """Add to a counter"""
+    if settings.METRICS_ENABLED and value:
+        get_buffer().add((name, _labels(labels)), value)
+
+
+def observe(name, value, **labels):
+    """Record a value in a histogram"""
+    if not settings.METRICS_ENABLED:
+        return
+    buckets = METRICS[name][2]
+    labels = _labels(labels)
+    buffer = get_buffer()
+    # Buckets are cumulative: every bucket at or above the value counts it
+    # (the others are added with 0 so every series has all buckets)
+    first = bisect_left(buckets, value)
+    for i, le in enumerate(buckets):
+        buffer.add((f'{name}_bucket', labels + (('le', _format_float(le)),)), int(i >= first))
+    buffer.add((f'{name}_bucket', labels + (('le', '+Inf'),)))
+    buffer.add((f'{name}_sum', labels), value)
+    buffer.add((f'{name}_count', labels))
+
+
+def record_compression(mime_type, input_bytes, output_bytes):
+    """Record one compressed image"""
+    if not input_bytes:
+        return
+    inc('imagehost_compression_input_bytes_total', input_bytes, format=mime_type)
+    inc('imagehost_compression_output_bytes_total', output_bytes, format=mime_type)
+    observe('imagehost_compression_ratio', output_bytes / input_bytes, format=mime_type)
+
+
+def record_cleanup(stats):
+    """Record one expired image sweep (a SweepStats)"""
+    inc('imagehost_cleanup_runs_total')
+    inc('imagehost_cleanup_images_total', stats.images)
+    inc('imagehost_cleanup_files_total', stats.files)
+    inc('imagehost_cleanup_bytes_total', stats.bytes)
+    inc('imagehost_cleanup_seconds_total', stats.elapsed)
+
+
+def render():
+    """
+    All metrics in the Prometheus text exposition format
+    This process's pending samples are flushed first so they are included.
+    """
+    if _buffer is not None:
+        _buffer.flush()
+    samples = read_samples()
+
+    families = {}
+    for (name, labels), value in samples.items():
+        family = name
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                family = name[:-len(suffix)]
+        families.setdefault(family, []).append((name, labels, value))
+
+    def sort_key(sample):
+        name, labels, _ = sample
+        le = dict(labels).get('le')
+        bound = float('inf') if le in (None, '+Inf') else float(le)
+        return [pair for pair in labels if pair[0] != 'le'], name, bound
+
+    lines = []
+    for family in sorted(families):
+        if family in METRICS:
+            metric_type, help_text, _ = METRICS[family]
+            lines.append(f'# HELP {family} {help_text}')
+            lines.append(f'# TYPE {family} {metric_type}')
+        for name, labels, value in sorted(families[family], key=sort_key):
+            label_text = ','.join(
+                '{}="{}"'.format(key, val.replace('\\', '\\\\').replace('"', '\\"')) for key, val in labels
+            )
+            lines.append(f'{name}{{{label_text}}} {_format_float(value)}' if label_text
+                         else f'{name} {_format_float(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+class RequestTimer:
+    """
+    Durations of the stages of one request
+    Stages entered several times (once per uploaded file) are summed.
+    """
+
+    def __init__(self, view):
+        self.view = view
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name, seconds):
+        """Add time measured elsewhere (upload handler, compression workers)"""
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def split(self, name, part, seconds):
+        """
+        Report seconds spent inside stage `name` as stage `part`
+        Only what `name` actually measured is taken out of it: the work may
+        have run before the stage was entered (e.g. outside any stage).
+        """
+        self.stages[name] = max(0.0, self.stages.get(name, 0.0) - seconds)
+        self.add(part, seconds)
+
+    def header(self, total):
+        entries = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in self.stages.items()]
+        entries.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(entries)
+
+    def finish(self, response):
+        """Add the Server-Timing header and record the stages"""
+        total = time.perf_counter() - self.started
+        if settings.SERVER_TIMING:
+            response['Server-Timing'] = self.header(total)
+        for name, seconds in self.stages.items():
+            observe('imagehost_stage_seconds', seconds, view=self.view, stage=name)
+        observe('imagehost_request_seconds', total, view=self.view, status=response.status_code)
+
+
+class _NullTimer:
+    """Stand-in when metrics are disabled"""
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def add(self, name, seconds):
+        pass
+
+    def split(self, name, part, seconds):
+        pass
+
+
+def timed(view):
+    """Decorator giving a view (sync or async) request.timer and reporting it on the response"""
+    def start(request):
+        if not (settings.METRICS_ENABLED or settings.SERVER_TIMING):
+            request.timer = _NullTimer()
+            return None
+        request.timer = RequestTimer(view)
+        return request.timer
+
+    def decorator(view_func):
+        if asyncio.iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def async_wrapper(request, *args, **kwargs):
+                timer = start(request)
+                response = await view_func(request, *args, **kwargs)
+                if timer is not None:
+                    timer.finish(response)
+                return response
+            return async_wrapper
+
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            timer = start(request)
+            response = view_func(request, *args, **kwargs)
+            if timer is not None:
+                timer.finish(response)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,40 @@
+"""
+Middleware
+"""
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from whitenoise.middleware import WhiteNoiseMiddleware as BaseWhiteNoiseMiddleware
+
+from .http_utils import async_streaming
+
+
+class WhiteNoiseMiddleware(BaseWhiteNoiseMiddleware):
+    """
+    WhiteNoise that can also run in async mode
+    WhiteNoise itself is sync only, so under ASGI Django would run every
+    request through a thread just to call it. Here only static files are
+    served from a thread; other requests go straight to the async views.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return async_streaming(await sync_to_async(self.serve)(static_file, request))
+        return await self.get_response(request)
@@ -1,23 +1,65 @@
 import os
 import hashlib
 import uuid
-from datetime import datetime, timedelta
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
 from django.db import models
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.utils import timezone
 from PIL import Image as PILImage
 from io import BytesIO
 from django.core.files.uploadedfile import InMemoryUploadedFile
 
+from .storage import PENDING_DIR
+
+
+# Directory of the hour buckets of temporary images (STORAGE_LAYOUT=bucketed)
+TEMP_BUCKET_DIR = 'tmp'
+TEMP_BUCKET_FORMAT = '%Y%m%d%H'
+
+
+def pending_name(name):
+    """Storage name of an image's file while it waits for processing"""
+    return f"{PENDING_DIR}/{name}"
+
+
+def temp_bucket(expires_at):
+    """Name of the hour bucket an image expiring at `expires_at` belongs to"""
+    return expires_at.astimezone(dt_timezone.utc).strftime(TEMP_BUCKET_FORMAT)
+
 
 def generate_filename(instance, filename):
     """Generate unique filename based on hash and timestamp"""
     ext = os.path.splitext(filename)[1].lower()
+    if settings.STORAGE_LAYOUT == 'bucketed':
+        if instance.is_temporary and instance.expires_at:
+            return f"{TEMP_BUCKET_DIR}/{temp_bucket(instance.expires_at)}/{uuid.uuid4().hex[:8]}{ext}"
+        digest = instance.file_hash or uuid.uuid4().hex
+        return f"{digest[:2]}/{digest[2:4]}/{digest}{ext}"
+
     timestamp = datetime.now().strftime('%Y%m%d')
     unique_id = uuid.uuid4().hex[:8]
     return f"{timestamp}/{unique_id}{ext}"
 
 
+class Blob(models.Model):
+    """
+    One stored file, shared by every Image with the same content
+    ref_count is the number of Image rows pointing at it; the file is
+    removed when the last of them is deleted (see imagehost.blobs).
+    """
+
+    file_hash = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255, help_text="Storage name of the file")
+    size = models.IntegerField(help_text="File size in bytes")
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.ref_count} refs)"
+
+
 class Image(models.Model):
     """Image model for storing uploaded images"""
 
@@ -35,7 +77,15 @@ class Image(models.Model):
     image = models.ImageField(upload_to=generate_filename, max_length=255)
     original_filename = models.CharField(max_length=255)
     file_size = models.IntegerField(help_text="File size in bytes")
-    file_hash = models.CharField(max_length=64, unique=True, db_index=True)
+    file_hash = models.CharField(max_length=64, db_index=True)
+    blob = models.ForeignKey(
+        Blob,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name='images',
+        help_text="Shared stored file. Null for images stored before blobs were introduced."
+    )
 
     # Image properties
     width = models.IntegerField()
@@ -61,12 +111,49 @@ class Image(models.Model):
     # Statistics
     view_count = models.IntegerField(default=0)
 
+    # Background processing (IMAGE_PROCESSING_MODE=async)
+    STATE_PENDING = 'pending'
+    STATE_READY = 'ready'
+    STATE_FAILED = 'failed'
+    PROCESSING_STATE_CHOICES = [
+        (STATE_PENDING, 'Pending'),
+        (STATE_READY, 'Ready'),
+        (STATE_FAILED, 'Failed'),
+    ]
+    processing_state = models.CharField(
+        max_length=20,
+        choices=PROCESSING_STATE_CHOICES,
+        default=STATE_READY,
+        help_text="Pending images are stored as uploaded until the worker compresses them"
+    )
+
+    # Modern-format variants stored next to the file, null until generated
+    webp_size = models.IntegerField(null=True, blank=True, help_text="Size of the WebP variant in bytes")
+    avif_size = models.IntegerField(null=True, blank=True, help_text="Size of the AVIF variant in bytes")
+
+    # Perceptual hash (dHash) for near-duplicate lookup, split into indexed
+    # 16-bit chunks (see imagehost.perceptual)
+    phash = models.BigIntegerField(null=True, blank=True, help_text="64-bit dHash, null until computed")
+    phash_0 = models.IntegerField(null=True, blank=True, db_index=True)
+    phash_1 = models.IntegerField(null=True, blank=True, db_index=True)
+    phash_2 = models.IntegerField(null=True, blank=True, db_index=True)
+    phash_3 = models.IntegerField(null=True, blank=True, db_index=True)
+
     class Meta:
         ordering = ['-created_at']
         indexes = [
             models.Index(fields=['-created_at']),
+            models.Index(fields=['-created_at', '-id']),  # keyset pagination
             models.Index(fields=['file_hash']),
         ]
+        constraints = [
+            # Each user keeps one copy of a given file; guests may upload the same file again
+            models.UniqueConstraint(
+                fields=['user', 'file_hash'],
+                condition=models.Q(user__isnull=False),
+                name='unique_user_file_hash'
+            ),
+        ]
 
     def __str__(self):
         return f"{self.original_filename} ({self.created_at})"
@@ -76,6 +163,22 @@ class Image(models.Model):
         """Get full URL for the image"""
         return f"{settings.MEDIA_URL}{self.image.name}"
 
+    @property
+    def thumbnail_url(self):
+        """URL of the default-size thumbnail, used by gallery and profile pages"""
+        return self.thumbnail_url_for(settings.THUMBNAIL_DEFAULT_SIZE)
+
+    def thumbnail_url_for(self, size):
+        """URL of a resized variant, size must be one of THUMBNAIL_SIZES"""
+        return f"/t/{size}/{self.image.name}"
+
+    @property
+    def stored_name(self):
+        """Storage name of the file currently holding the image (see PENDING_DIR)"""
+        if self.processing_state == self.STATE_PENDING:
+            return pending_name(self.image.name)
+        return self.image.name
+
     @property
     def full_url(self):
         """Get absolute URL for the image - requires request context or domain setting"""
@@ -87,23 +190,28 @@ class Image(models.Model):
         """Get file size in KB"""
         return round(self.file_size / 1024, 2)
 
+    def variant_size(self, fmt):
+        """Size of the variant in the given format (webp, avif), None if there is none"""
+        return getattr(self, f'{fmt}_size', None)
+
     def increment_view_count(self):
-        """Increment view count"""
+        """Increment view count immediately with an atomic update"""
+        Image.objects.filter(pk=self.pk).update(view_count=models.F('view_count') + 1)
         self.view_count += 1
-        self.save(update_fields=['view_count'])
 
-    def set_as_temporary(self, hours=24):
+    def set_as_temporary(self, hours=24, save=True):
         """Set image as temporary with expiration time"""
         self.is_temporary = True
-        self.expires_at = datetime.now() + timedelta(hours=hours)
-        self.save(update_fields=['is_temporary', 'expires_at'])
+        self.expires_at = timezone.now() + timedelta(hours=hours)
+        if save:
+            self.save(update_fields=['is_temporary', 'expires_at'])
 
     @property
     def is_expired(self):
         """Check if temporary image has expired"""
         if not self.is_temporary or not self.expires_at:
             return False
-        return datetime.now() > self.expires_at
+        return timezone.now() > self.expires_at
 
     @staticmethod
     def calculate_hash(file_content):
@@ -111,11 +219,38 @@ class Image(models.Model):
         return hashlib.sha256(file_content).hexdigest()
 
     @staticmethod
-    def compress_image(image_file, quality=85, max_dimension=4096):
-        """Compress image if needed"""
+    def calculate_file_hash(uploaded_file):
+        """Calculate SHA256 hash of an uploaded file, reusing the hash from upload if present"""
+        if getattr(uploaded_file, 'sha256', None):
+            return uploaded_file.sha256
+        hasher = hashlib.sha256()
+        for chunk in uploaded_file.chunks():
+            hasher.update(chunk)
+        uploaded_file.seek(0)
+        return hasher.hexdigest()
+
+    @staticmethod
+    def compressed_format(mime_type):
+        """Output format used by compress_image for an input mime type"""
+        return 'JPEG' if mime_type in ['image/jpeg', 'image/jpg'] else 'PNG'
+
+    @staticmethod
+    def compress_image(image_file, quality=85, max_dimension=4096, mime_type=None, timings=None):
+        """
+        Compress image if needed
+        Args:
+            timings: Optional dict, seconds spent decoding and encoding are added to it
+        """
+        mime_type = mime_type or image_file.content_type
         try:
+            started = time.perf_counter()
             img = PILImage.open(image_file)
 
+            # Let the JPEG decoder downscale while decoding instead of after
+            if img.format == 'JPEG' and max(img.size) > max_dimension:
+                img.draft('RGB', (max_dimension, max_dimension))
+            img.load()
+
             # Convert RGBA to RGB if needed
             if img.mode in ('RGBA', 'LA', 'P'):
                 background = PILImage.new('RGB', img.size, (255, 255, 255))
@@ -129,10 +264,14 @@ class Image(models.Model):
                 img.thumbnail((max_dimension, max_dimension), PILImage.Resampling.LANCZOS)
 
             # Compress
+            decoded = time.perf_counter()
             output = BytesIO()
-            img_format = 'JPEG' if image_file.content_type in ['image/jpeg', 'image/jpg'] else 'PNG'
+            img_format = Image.compressed_format(mime_type)
             img.save(output, format=img_format, quality=quality, optimize=True)
             output.seek(0)
+            if timings is not None:
+                timings['decode'] = timings.get('decode', 0.0) + decoded - started
+                timings['encode'] = timings.get('encode', 0.0) + time.perf_counter() - decoded
 
             return InMemoryUploadedFile(
                 output, 'ImageField',
@@ -145,6 +284,72 @@ class Image(models.Model):
             raise ValueError(f"Image processing failed: {str(e)}")
 
 
+class ProcessingJob(models.Model):
+    """Queued background compression of an uploaded image"""
+
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    image = models.OneToOneField(Image, on_delete=models.CASCADE, related_name='processing_job')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return f"Job {self.id} for image {self.image_id} ({self.status})"
+
+
+class UsageStats(models.Model):
+    """
+    Denormalized upload statistics, one row per user plus one global row
+    (user is null). Maintained by imagehost.usage, rebuilt by the
+    reconcile_usage command.
+    """
+
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='usage_stats',
+        help_text="Null for the global row covering all images"
+    )
+    image_count = models.IntegerField(default=0)
+    total_size = models.BigIntegerField(default=0, help_text="Total file size in bytes")
+    total_views = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'usage stats'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user'],
+                condition=models.Q(user__isnull=True),
+                name='unique_global_usage_stats'
+            ),
+        ]
+
+    def __str__(self):
+        owner = self.user.username if self.user_id else 'All users'
+        return f"{owner}: {self.image_count} images"
+
+    @property
+    def total_size_mb(self):
+        """Get total size in MB"""
+        return round(self.total_size / (1024 * 1024), 2)
+
+
 class UploadToken(models.Model):
     """API Token model for authentication"""
 
@@ -169,8 +374,8 @@ class UploadToken(models.Model):
         """Generate a random token"""
         return hashlib.sha256(uuid.uuid4().bytes).hexdigest()
 
-    def record_use(self):
+    def record_use(self, count=1):
         """Record token usage"""
-        self.upload_count += 1
-        self.last_used = datetime.now()
+        self.upload_count += count
+        self.last_used = timezone.now()
         self.save(update_fields=['upload_count', 'last_used'])
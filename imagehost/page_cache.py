@@ -0,0 +1,131 @@
+"""
+Cached gallery pages and list_images responses
+
+Rendered pages are kept in the 'pages' cache under a key made of the view,
+the request parameters the body depends on and a generation. Uploads,
+deletions, expiry and finished processing replace the generation, which
+makes every cached page unreachable at once instead of tracking which pages
+an image appears on; stale entries age out after PAGE_CACHE_TTL.
+
+The generation lives in PAGE_CACHE_GENERATION_FILE rather than in the cache:
+with locmem every gunicorn worker has a cache of its own, and
+cleanup_expired_images and process_images run in separate processes, but all
+of them see a new file as soon as it is written.
+
+Cached pages carry an ETag of their content, so browsers revalidate them
+with a bodyless 304.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+
+logger = logging.getLogger(__name__)
+
+
+def get_generation():
+    """Current generation of the image listings"""
+    try:
+        with open(settings.PAGE_CACHE_GENERATION_FILE) as f:
+            return f.read().strip() or '0'
+    except FileNotFoundError:
+        return '0'
+
+
+def bump_generation():
+    """Start a new generation, written atomically so readers never see a partial value"""
+    path = settings.PAGE_CACHE_GENERATION_FILE
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                tmp.write(uuid.uuid4().hex)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    except OSError as e:
+        logger.warning('Could not update page cache generation %s: %s', path, e)
+
+
+def invalidate():
+    """Drop all cached pages once the current transaction commits"""
+    transaction.on_commit(bump_generation)
+
+
+def get_cache():
+    return caches['pages']
+
+
+def page_key(view, request, params):
+    """
+    Cache key of a page
+    Args:
+        view: View name
+        request: Django request object (host and scheme end up in image URLs)
+        params: Query parameters the page depends on
+    """
+    parts = [view, request.scheme, request.get_host()]
+    parts += [f'{name}={request.GET.get(name)!r}' for name in params]
+    digest = hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+    return f'imagehost:page:{get_generation()}:{digest}'
+
+
+def _page_response(request, content, content_type, etag):
+    response = HttpResponse(content, content_type=content_type)
+    response['ETag'] = etag
+    # Listings depend on credentials, only the browser may keep them and it must revalidate
+    response['Cache-Control'] = 'private, no-cache'
+    return get_conditional_response(request, etag=etag, response=response)
+
+
+def _entry(response):
+    etag = f'"{hashlib.md5(response.content).hexdigest()}"'
+    return response.content, response['Content-Type'], etag
+
+
+def cached_page(request, key):
+    """The cached page for key (a 304 if the client already has it), or None"""
+    if not settings.PAGE_CACHE_ENABLED:
+        return None
+    entry = get_cache().get(key)
+    return None if entry is None else _page_response(request, *entry)
+
+
+def store_page(request, key, response):
+    """
+    Cache a rendered page
+    Returns:
+        The response to send, with its ETag (errors are passed through uncached)
+    """
+    if not settings.PAGE_CACHE_ENABLED or response.status_code != 200:
+        return response
+    entry = _entry(response)
+    get_cache().set(key, entry, settings.PAGE_CACHE_TTL)
+    return _page_response(request, *entry)
+
+
+async def acached_page(request, key):
+    """cached_page with the async cache API"""
+    if not settings.PAGE_CACHE_ENABLED:
+        return None
+    entry = await get_cache().aget(key)
+    return None if entry is None else _page_response(request, *entry)
+
+
+async def astore_page(request, key, response):
+    """store_page with the async cache API"""
+    if not settings.PAGE_CACHE_ENABLED or response.status_code != 200:
+        return response
+    entry = _entry(response)
+    await get_cache().aset(key, entry, settings.PAGE_CACHE_TTL)
+    return _page_response(request, *entry)
@@ -0,0 +1,119 @@
+"""
+Keyset (cursor) pagination over images
+Pages are addressed by an opaque cursor holding the (created_at, id) of the
+last row seen, so every page is a single index range scan whatever its depth,
+and no COUNT(*) is needed to render it.
+"""
+
+import base64
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from .models import Image
+from .page_cache import get_generation
+
+IMAGE_COUNT_CACHE_KEY = 'imagehost:image_count'
+
+
+def encode_cursor(image):
+    """Opaque cursor pointing at an image's position in (-created_at, -id) order"""
+    raw = f"{image.created_at.isoformat()}|{image.pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor into (created_at, id)
+    Raises:
+        ValueError: Malformed cursor
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, pk = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(pk)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+class KeysetPage:
+    """One page of images with cursors to its neighbours"""
+
+    def __init__(self, items, has_next, has_previous):
+        self.object_list = items
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.next_cursor = encode_cursor(items[-1]) if has_next and items else None
+        self.previous_cursor = encode_cursor(items[0]) if has_previous and items else None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def _keyset_rows(queryset, per_page, after=None, before=None):
+    """The query for a page: per_page + 1 rows, the extra one tells whether more exist"""
+    if before:
+        created_at, pk = decode_cursor(before)
+        return (
+            queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk))
+            .order_by('created_at', 'id')[:per_page + 1]
+        )
+
+    queryset = queryset.order_by('-created_at', '-id')
+    if after:
+        created_at, pk = decode_cursor(after)
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    return queryset[:per_page + 1]
+
+
+def _keyset_result(rows, per_page, after=None, before=None):
+    if before:
+        has_previous = len(rows) > per_page
+        items = rows[:per_page][::-1]
+        return KeysetPage(items, has_next=True, has_previous=has_previous)
+    return KeysetPage(rows[:per_page], has_next=len(rows) > per_page, has_previous=bool(after))
+
+
+def keyset_page(queryset, per_page, after=None, before=None):
+    """
+    Fetch the page following cursor `after`, or preceding cursor `before`
+    Only per_page + 1 rows are read; the extra row tells whether more exist.
+    """
+    rows = list(_keyset_rows(queryset, per_page, after, before))
+    return _keyset_result(rows, per_page, after, before)
+
+
+async def akeyset_page(queryset, per_page, after=None, before=None):
+    """keyset_page with the async ORM"""
+    rows = [row async for row in _keyset_rows(queryset, per_page, after, before)]
+    return _keyset_result(rows, per_page, after, before)
+
+
+def _image_count_key():
+    # Follows the page cache generation so cached pages never store an old total
+    return f'{IMAGE_COUNT_CACHE_KEY}:{get_generation()}'
+
+
+def cached_image_count():
+    """Total number of images, cached for IMAGE_COUNT_CACHE_TTL seconds or until images change"""
+    key = _image_count_key()
+    count = cache.get(key)
+    if count is None:
+        count = Image.objects.count()
+        cache.set(key, count, settings.IMAGE_COUNT_CACHE_TTL)
+    return count
+
+
+async def acached_image_count():
+    """cached_image_count with the async cache and ORM"""
+    key = _image_count_key()
+    count = await cache.aget(key)
+    if count is None:
+        count = await Image.objects.acount()
+        await cache.aset(key, count, settings.IMAGE_COUNT_CACHE_TTL)
+    return count
@@ -0,0 +1,116 @@
+"""
+Perceptual hashes and near-duplicate lookup
+Each image gets a 64-bit difference hash (dHash): the image is reduced to
+9x8 grey pixels and every bit records whether a pixel is darker than its
+right neighbour, so re-encoded, resized or lightly edited copies differ in
+only a few bits.
+
+Lookup uses multi-index hashing: the hash is also stored as four indexed
+16-bit chunks. Two hashes within Hamming distance 3 share at least one
+chunk exactly, so candidates come from four index lookups and only those
+are compared bit by bit. Larger distances are supported but may miss
+matches that share no chunk.
+"""
+
+from django.conf import settings
+from django.db.models import Q
+from PIL import Image as PILImage
+
+from .models import Image
+
+HASH_SIZE = 8
+CHUNKS = 4
+CHUNK_BITS = 64 // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# Upper bound on candidates compared for one lookup (e.g. plain images
+# all hash to zero chunks)
+MAX_CANDIDATES = 5000
+
+
+def dhash(image_file):
+    """
+    Compute the 64-bit dHash of an image
+    Args:
+        image_file: Path or file-like object
+    Returns:
+        Unsigned 64-bit int
+    """
+    with PILImage.open(image_file) as img:
+        # JPEG can decode straight to a reduced size, much cheaper than a full decode
+        img.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+        small = img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), PILImage.BOX)
+    pixels = small.tobytes()
+
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    return value
+
+
+def hash_fields(value):
+    """Image field values for a hash (stored signed to fit a BigIntegerField)"""
+    fields = {'phash': value - (1 << 64) if value >= (1 << 63) else value}
+    for i in range(CHUNKS):
+        fields[f'phash_{i}'] = (value >> (CHUNK_BITS * (CHUNKS - 1 - i))) & CHUNK_MASK
+    return fields
+
+
+def stored_hash(image):
+    """Unsigned hash of an Image, or None if not computed yet"""
+    if image.phash is None:
+        return None
+    return image.phash & ((1 << 64) - 1)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def find_similar(value, max_distance=None, queryset=None, limit=20):
+    """
+    Find images whose perceptual hash is close to `value`
+    Args:
+        value: Unsigned hash to compare with
+        max_distance: Maximum differing bits (default: NEAR_DUPLICATE_MAX_DISTANCE)
+        queryset: Images to search (default: all)
+        limit: Maximum number of results
+    Returns:
+        List of (distance, Image), closest first
+    """
+    if max_distance is None:
+        max_distance = settings.NEAR_DUPLICATE_MAX_DISTANCE
+    if queryset is None:
+        queryset = Image.objects.all()
+
+    chunks = hash_fields(value)
+    match_any_chunk = Q()
+    for i in range(CHUNKS):
+        match_any_chunk |= Q(**{f'phash_{i}': chunks[f'phash_{i}']})
+
+    matches = []
+    for image in queryset.filter(match_any_chunk)[:MAX_CANDIDATES]:
+        distance = hamming(value, stored_hash(image))
+        if distance <= max_distance:
+            matches.append((distance, image))
+    matches.sort(key=lambda match: (match[0], -match[1].id))
+    return matches[:limit]
+
+
+def near_duplicate(value, user=None):
+    """
+    Existing image an upload with hash `value` can reuse, or None
+    The uploader's own images come first, then the closest image whose
+    stored file can be shared.
+    """
+    matches = find_similar(value, queryset=Image.objects.select_related('blob'))
+    if user is not None and user.is_authenticated:
+        for _, image in matches:
+            if image.user_id == user.id:
+                return image
+    for _, image in matches:
+        if image.blob_id and image.blob.ref_count > 0:
+            return image
+    return None
@@ -0,0 +1,281 @@
+"""
+Image processing outside the request thread
+- compress_uploads fans the compression of a multi-file upload out to a
+  process pool (UPLOAD_PROCESS_WORKERS)
+- In async mode uploads are stored as received under PENDING_DIR and a
+  ProcessingJob is queued; the process_images command compresses them and
+  moves the result to the image's final name
+- The same jobs generate WebP/AVIF variants (IMAGE_VARIANT_FORMATS)
+"""
+
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .metrics import record_compression
+from .models import Blob, Image, ProcessingJob, pending_name
+from .page_cache import invalidate as invalidate_pages
+from .perceptual import dhash, hash_fields
+from .usage import record_resize
+from .variants import VARIANT_MIME_TYPES, generate_variants, variant_name
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(images):
+    """Queue images for background compression"""
+    return ProcessingJob.objects.bulk_create([ProcessingJob(image=image) for image in images])
+
+
+def claim_jobs(limit, stale_after=600):
+    """
+    Claim up to limit pending jobs
+    Jobs are claimed with a conditional UPDATE so several workers can share
+    the table. Jobs left running longer than stale_after seconds (a crashed
+    worker) are claimed again.
+    """
+    now = timezone.now()
+    candidates = ProcessingJob.objects.filter(
+        Q(status=ProcessingJob.STATUS_PENDING) |
+        Q(status=ProcessingJob.STATUS_RUNNING, locked_at__lt=now - timedelta(seconds=stale_after))
+    ).values_list('id', 'status', 'locked_at')[:limit]
+
+    claimed = []
+    for job_id, status, locked_at in candidates:
+        updated = ProcessingJob.objects.filter(
+            id=job_id, status=status, locked_at=locked_at
+        ).update(status=ProcessingJob.STATUS_RUNNING, locked_at=now, attempts=F('attempts') + 1)
+        if updated:
+            claimed.append(job_id)
+
+    return list(ProcessingJob.objects.filter(id__in=claimed).select_related('image'))
+
+
+def current_name(image):
+    """
+    Storage name of the file holding an image right now
+    A pending image is read from PENDING_DIR, or from its final name once
+    the worker has moved it there (and for uploads stored before PENDING_DIR).
+    """
+    name = image.stored_name
+    if name != image.image.name and not default_storage.exists(name):
+        return image.image.name
+    return name
+
+
+def publish_file(source, name, fields):
+    """
+    Move a processed upload and the variants kept for it to the final name
+    Variants go first so nginx finds them as soon as the file appears.
+    Runs before complete_job, serve_image falls back to the final name meanwhile.
+    """
+    if source == name:
+        return
+    for fmt in VARIANT_MIME_TYPES:
+        if fields.get(f'{fmt}_size'):
+            default_storage.move(variant_name(source, fmt), variant_name(name, fmt))
+    default_storage.move(source, name)
+
+
+def process_file(path, mime_type, compress, variant_formats, quality, max_dimension, perceptual_hash=False):
+    """
+    Compress the file at path in place and generate its format variants
+    Runs in a worker process, so it only touches the filesystem.
+    Returns:
+        Dict of Image fields to update
+    """
+    fields = {}
+    if compress:
+        fields.update(compress_in_place(path, mime_type, quality, max_dimension))
+    if variant_formats:
+        for fmt, size in generate_variants(path, variant_formats, quality).items():
+            fields[f'{fmt}_size'] = size
+    if perceptual_hash:
+        fields.update(hash_fields(dhash(path)))
+    return fields
+
+
+def compress_in_place(path, mime_type, quality, max_dimension):
+    """
+    Compress the file at path and atomically replace it
+    Returns:
+        Dict with file_size, width, height and mime_type of the new file
+    """
+    with open(path, 'rb') as f:
+        compressed_file, (width, height) = Image.compress_image(
+            f, quality=quality, max_dimension=max_dimension, mime_type=mime_type
+        )
+
+    # Write next to the original so os.replace is an atomic rename
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            for chunk in compressed_file.chunks():
+                tmp.write(chunk)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return {
+        'file_size': compressed_file.size,
+        'width': width,
+        'height': height,
+        'mime_type': compressed_file.content_type,
+    }
+
+
+def _sharing_images(image):
+    """The image and every other image sharing its stored file"""
+    if image.blob_id:
+        return Image.objects.filter(blob_id=image.blob_id)
+    return Image.objects.filter(id=image.id)
+
+
+def complete_job(job, fields):
+    """Record a processed image (and the images sharing its file) and drop its job"""
+    with transaction.atomic():
+        images = _sharing_images(job.image)
+        if 'file_size' in fields:
+            record_compression(job.image.mime_type, job.image.file_size, fields['file_size'])
+            for image in images.only('id', 'user_id', 'file_size'):
+                record_resize(image, fields['file_size'])
+            Blob.objects.filter(id=job.image.blob_id).update(size=fields['file_size'])
+        images.update(processing_state=Image.STATE_READY, **fields)
+        job.delete()
+        # Listings show the compressed size and dimensions
+        invalidate_pages()
+
+
+def fail_job(job, error, max_attempts):
+    """Retry a failed job later, or give up after max_attempts"""
+    if job.attempts < max_attempts:
+        ProcessingJob.objects.filter(id=job.id).update(
+            status=ProcessingJob.STATUS_PENDING, locked_at=None, error=error
+        )
+        return
+
+    # The original upload is served as is, from its final name
+    name = job.image.image.name
+    try:
+        if default_storage.exists(pending_name(name)):
+            default_storage.move(pending_name(name), name)
+    except Exception:
+        logger.exception('Could not move %s out of the pending directory', name)
+
+    with transaction.atomic():
+        ProcessingJob.objects.filter(id=job.id).update(status=ProcessingJob.STATUS_FAILED, error=error)
+        _sharing_images(job.image).filter(
+            processing_state=Image.STATE_PENDING
+        ).update(processing_state=Image.STATE_FAILED)
+
+
+def compress_upload(data, name, mime_type, quality, max_dimension):
+    """
+    Compress the raw bytes of an upload, runs in a pool worker
+    Returns:
+        (compressed bytes, file name, mime type, width, height, decode/encode timings)
+    """
+    image_file = BytesIO(data)
+    image_file.name = name
+    timings = {}
+    compressed_file, (width, height) = Image.compress_image(
+        image_file, quality=quality, max_dimension=max_dimension, mime_type=mime_type, timings=timings
+    )
+    return compressed_file.read(), compressed_file.name, compressed_file.content_type, width, height, timings
+
+
+_upload_pool = None
+_upload_pool_lock = threading.Lock()
+
+
+def _reset_upload_pool():
+    global _upload_pool, _upload_pool_lock
+    _upload_pool = None
+    _upload_pool_lock = threading.Lock()
+
+
+# A forked gunicorn worker must create its own pool
+os.register_at_fork(after_in_child=_reset_upload_pool)
+
+
+def get_upload_pool():
+    """Process pool shared by all requests of this process"""
+    global _upload_pool
+    with _upload_pool_lock:
+        if _upload_pool is None:
+            _upload_pool = ProcessPoolExecutor(max_workers=settings.UPLOAD_PROCESS_WORKERS)
+        return _upload_pool
+
+
+def compress_uploads(uploads, timings=None):
+    """
+    Compress the files of one upload request
+    Args:
+        uploads: List of (uploaded file, mime type)
+        timings: Optional dict receiving the decode/encode seconds summed over files
+    Returns:
+        One entry per upload, either (file, width, height, mime type) or the
+        exception raised while compressing it
+    With UPLOAD_PROCESS_WORKERS > 0 and several files, compression runs on a
+    process pool; at most UPLOAD_PROCESS_WORKERS files are in flight so the
+    request never holds more than that many extra copies in memory.
+    """
+    global _upload_pool
+    quality = settings.COMPRESSION_QUALITY
+    max_dimension = settings.MAX_IMAGE_DIMENSION
+    workers = settings.UPLOAD_PROCESS_WORKERS
+
+    if workers <= 0 or len(uploads) < 2:
+        outcomes = []
+        for image_file, mime_type in uploads:
+            try:
+                compressed_file, (width, height) = Image.compress_image(
+                    image_file, quality=quality, max_dimension=max_dimension, mime_type=mime_type,
+                    timings=timings
+                )
+                outcomes.append((compressed_file, width, height, compressed_file.content_type))
+            except Exception as e:
+                outcomes.append(e)
+        return outcomes
+
+    pool = get_upload_pool()
+    outcomes = []
+    for start in range(0, len(uploads), workers):
+        futures = []
+        for image_file, mime_type in uploads[start:start + workers]:
+            image_file.seek(0)
+            futures.append(pool.submit(
+                compress_upload, image_file.read(), image_file.name, mime_type, quality, max_dimension
+            ))
+            image_file.seek(0)
+
+        for future in futures:
+            try:
+                data, name, mime_type, width, height, file_timings = future.result()
+                if timings is not None:
+                    for stage, seconds in file_timings.items():
+                        timings[stage] = timings.get(stage, 0.0) + seconds
+                outcomes.append((ContentFile(data, name=name), width, height, mime_type))
+            except BrokenProcessPool as e:
+                # A worker died (e.g. killed for memory), start a fresh pool next time
+                with _upload_pool_lock:
+                    _upload_pool = None
+                outcomes.append(ValueError(f"Image processing failed: {e}"))
+            except Exception as e:
+                outcomes.append(e)
+    return outcomes
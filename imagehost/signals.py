@@ -0,0 +1,78 @@
+"""
+Model signal handlers
+"""
+
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from image_bed.database import configure_sqlite_connection
+
+from .blobs import release_blobs, remove_files
+from .models import Image, UploadToken
+from .page_cache import invalidate as invalidate_pages
+from .token_cache import invalidate_token
+from .usage import record_deletes
+
+_state = threading.local()
+
+
+@contextmanager
+def batch_deletion():
+    """
+    Skip the per-image post_delete work in this thread
+    For bulk deletions whose caller updates usage and releases blobs once
+    per batch (see imagehost.cleanup).
+    """
+    _state.batch = True
+    try:
+        yield
+    finally:
+        _state.batch = False
+
+
+def _in_batch_deletion():
+    return getattr(_state, 'batch', False)
+
+
+@receiver(post_delete, sender=Image)
+def release_image_file(sender, instance, **kwargs):
+    """Release the image's stored file, removing it with its last reference"""
+    if _in_batch_deletion():
+        return
+    freed = release_blobs([instance])
+    if freed:
+        transaction.on_commit(lambda: [remove_files(name) for name in freed])
+
+
+@receiver(post_delete, sender=Image)
+def update_usage_on_delete(sender, instance, **kwargs):
+    """Subtract a deleted image from its owner's and the global counters"""
+    if _in_batch_deletion():
+        return
+    record_deletes([instance])
+
+
+@receiver(post_delete, sender=Image)
+def invalidate_pages_on_delete(sender, instance, **kwargs):
+    """Drop cached gallery / list pages that may show a deleted image"""
+    if _in_batch_deletion():
+        return
+    invalidate_pages()
+
+
+@receiver(post_save, sender=UploadToken)
+@receiver(post_delete, sender=UploadToken)
+def invalidate_cached_token(sender, instance, **kwargs):
+    """Drop a token from the cache when it is edited, deactivated or deleted"""
+    invalidate_token(instance.token)
+
+
+@receiver(connection_created)
+def tune_sqlite_connection(sender, connection, **kwargs):
+    """Switch new SQLite connections to WAL and apply SQLITE_PRAGMAS"""
+    configure_sqlite_connection(connection, settings.SQLITE_PRAGMAS)
@@ -0,0 +1,327 @@
+"""
+Storage backends for image files
+Every code path that reads, writes or removes stored images goes through
+default_storage, selected by STORAGE_BACKEND:
+- 'filesystem': files under MEDIA_ROOT (one host, nginx can serve /i/ itself)
+- 's3': an S3-compatible bucket (AWS, MinIO, ...) shared by all web nodes
+
+On top of Django's Storage API both backends provide:
+- is_local: whether files live on this host's disk
+- local_file(name, write_back=()): a local path to process a file in place
+- stream(name): file contents as chunks, for serving
+- move(name, new_name): rename a file
+- delete_many(names): remove several files (in the background for S3)
+- delete_prefix(prefix): remove every file under a directory
+- list_dirs(prefix): subdirectories of a directory
+
+Thumbnails are a per-host cache and always stay on local disk.
+"""
+
+import atexit
+import logging
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, Storage
+from django.utils.deconstruct import deconstructible
+
+logger = logging.getLogger(__name__)
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# S3 DeleteObjects accepts at most this many keys per request
+S3_DELETE_BATCH = 1000
+
+# Async uploads are stored under this directory until process_images has
+# compressed them, so the final name only ever holds the processed file and
+# can be cached for a year (nginx never serves this directory)
+PENDING_DIR = '_pending'
+
+
+@deconstructible
+class FileSystemImageStorage(FileSystemStorage):
+    """Images under MEDIA_ROOT on the local disk"""
+
+    is_local = True
+    public_url = ''
+
+    @contextmanager
+    def local_file(self, name, write_back=()):
+        """The file itself, changes are made in place"""
+        yield self.path(name)
+
+    def stream(self, name):
+        """
+        Read a file in chunks
+        Returns:
+            (iterator of chunks, file size)
+        """
+        file_obj = self.open(name)
+
+        def chunks():
+            with file_obj:
+                yield from file_obj.chunks(STREAM_CHUNK_SIZE)
+
+        return chunks(), file_obj.size
+
+    def move(self, name, new_name):
+        """Rename a file, replacing new_name if it exists"""
+        new_path = self.path(new_name)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        os.replace(self.path(name), new_path)
+
+    def delete_many(self, names):
+        """Remove files, returns how many existed"""
+        removed = 0
+        for name in names:
+            try:
+                os.remove(self.path(name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def delete_prefix(self, prefix):
+        """Remove a directory and everything in it, returns the number of files"""
+        path = self.path(prefix)
+        files = sum(len(filenames) for _, _, filenames in os.walk(path))
+        shutil.rmtree(path, ignore_errors=True)
+        return files
+
+    def list_dirs(self, prefix):
+        try:
+            return self.listdir(prefix)[0]
+        except FileNotFoundError:
+            return []
+
+
+@deconstructible
+class S3ImageStorage(Storage):
+    """
+    Images in an S3-compatible bucket
+    One boto3 client per process keeps a pool of S3_MAX_CONNECTIONS
+    connections; files above S3_MULTIPART_THRESHOLD are uploaded and
+    downloaded in parallel parts, and deletions are batched on background
+    threads so requests never wait for them.
+    """
+
+    is_local = False
+
+    def __init__(self, bucket=None, endpoint_url=None, region=None, access_key=None,
+                 secret_key=None, public_url=None):
+        self.bucket = bucket or settings.S3_BUCKET
+        self.endpoint_url = endpoint_url or settings.S3_ENDPOINT_URL or None
+        self.region = region or settings.S3_REGION or None
+        self.access_key = access_key or settings.S3_ACCESS_KEY_ID or None
+        self.secret_key = secret_key or settings.S3_SECRET_ACCESS_KEY or None
+        self.public_url = (public_url or settings.S3_PUBLIC_URL).rstrip('/')
+        if not self.bucket:
+            raise ImproperlyConfigured("STORAGE_BACKEND=s3 requires S3_BUCKET")
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """Clients and threads are per process (also used in forked gunicorn workers)"""
+        self._lock = threading.Lock()
+        self._client = None
+        self._transfer_config = None
+        self._delete_pool = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    try:
+                        import boto3
+                        from boto3.s3.transfer import TransferConfig
+                        from botocore.config import Config
+                    except ImportError:
+                        raise ImproperlyConfigured("STORAGE_BACKEND=s3 requires boto3 (pip install boto3)")
+                    config = Config(
+                        max_pool_connections=settings.S3_MAX_CONNECTIONS,
+                        retries={'max_attempts': 5, 'mode': 'standard'},
+                        # MinIO and most S3-compatible servers want path-style URLs
+                        s3={'addressing_style': 'path' if self.endpoint_url else 'auto'},
+                    )
+                    self._transfer_config = TransferConfig(
+                        multipart_threshold=settings.S3_MULTIPART_THRESHOLD,
+                        multipart_chunksize=settings.S3_MULTIPART_CHUNKSIZE,
+                        max_concurrency=settings.S3_TRANSFER_CONCURRENCY,
+                        use_threads=True,
+                    )
+                    self._client = boto3.session.Session().client(
+                        's3',
+                        endpoint_url=self.endpoint_url,
+                        region_name=self.region,
+                        aws_access_key_id=self.access_key,
+                        aws_secret_access_key=self.secret_key,
+                        config=config,
+                    )
+        return self._client
+
+    @property
+    def transfer_config(self):
+        self.client
+        return self._transfer_config
+
+    def _extra_args(self, name):
+        if name.startswith(f'{PENDING_DIR}/'):
+            # Replaced by the compressed file, which move() gives the final headers
+            cache_control = 'no-cache'
+        else:
+            # Final names never change content, see STORAGE_LAYOUT
+            cache_control = 'public, max-age=31536000'
+        return {
+            'ContentType': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+            'CacheControl': cache_control,
+        }
+
+    def _save(self, name, content):
+        content.seek(0)
+        self.client.upload_fileobj(
+            content, self.bucket, name, ExtraArgs=self._extra_args(name), Config=self.transfer_config
+        )
+        return name
+
+    def _open(self, name, mode='rb'):
+        # Spooled so PIL and Django can seek in it
+        spool = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+        self.client.download_fileobj(self.bucket, name, spool, Config=self.transfer_config)
+        spool.seek(0)
+        return File(spool, name=name)
+
+    def _head(self, name):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=name)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def exists(self, name):
+        return self._head(name) is not None
+
+    def size(self, name):
+        head = self._head(name)
+        if head is None:
+            raise FileNotFoundError(name)
+        return head['ContentLength']
+
+    def get_modified_time(self, name):
+        head = self._head(name)
+        if head is None:
+            raise FileNotFoundError(name)
+        return head['LastModified']
+
+    def url(self, name):
+        if self.public_url:
+            return f'{self.public_url}/{name}'
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': name}, ExpiresIn=3600
+        )
+
+    def listdir(self, path):
+        prefix = f"{path.strip('/')}/" if path.strip('/') else ''
+        dirs, files = [], []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter='/'):
+            dirs.extend(p['Prefix'][len(prefix):].rstrip('/') for p in page.get('CommonPrefixes', []))
+            files.extend(obj['Key'][len(prefix):] for obj in page.get('Contents', []))
+        return dirs, files
+
+    def list_dirs(self, prefix):
+        return self.listdir(prefix)[0]
+
+    @contextmanager
+    def local_file(self, name, write_back=()):
+        """
+        Download a file to a temporary directory
+        On success the file is uploaded again if it was modified, and so is
+        every name in write_back (stored next to it) that was created.
+        """
+        with tempfile.TemporaryDirectory(dir=settings.FILE_UPLOAD_TEMP_DIR) as tmpdir:
+            path = os.path.join(tmpdir, os.path.basename(name))
+            self.client.download_file(self.bucket, name, path, Config=self.transfer_config)
+            before = os.stat(path)
+            yield path
+
+            after = os.stat(path)
+            if (after.st_ino, after.st_mtime_ns, after.st_size) != (before.st_ino, before.st_mtime_ns, before.st_size):
+                self._upload_path(path, name)
+            for extra in write_back:
+                extra_path = os.path.join(tmpdir, os.path.basename(extra))
+                if os.path.exists(extra_path):
+                    self._upload_path(extra_path, extra)
+
+    def _upload_path(self, path, name):
+        self.client.upload_file(
+            path, self.bucket, name, ExtraArgs=self._extra_args(name), Config=self.transfer_config
+        )
+
+    def stream(self, name):
+        """
+        Read an object in chunks without buffering it
+        Returns:
+            (iterator of chunks, object size)
+        """
+        obj = self.client.get_object(Bucket=self.bucket, Key=name)
+        return obj['Body'].iter_chunks(STREAM_CHUNK_SIZE), obj['ContentLength']
+
+    def move(self, name, new_name):
+        """Copy an object to new_name with that name's headers, then delete it"""
+        self.client.copy(
+            {'Bucket': self.bucket, 'Key': name}, self.bucket, new_name,
+            ExtraArgs={**self._extra_args(new_name), 'MetadataDirective': 'REPLACE'},
+            Config=self.transfer_config,
+        )
+        self.delete(name)
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=name)
+
+    def delete_many(self, names):
+        """Queue files for removal on the background delete threads, returns how many were queued"""
+        names = list(names)
+        for start in range(0, len(names), S3_DELETE_BATCH):
+            self._get_delete_pool().submit(self._delete_batch, names[start:start + S3_DELETE_BATCH])
+        return len(names)
+
+    def _get_delete_pool(self):
+        with self._lock:
+            if self._delete_pool is None:
+                self._delete_pool = ThreadPoolExecutor(
+                    max_workers=settings.S3_DELETE_WORKERS, thread_name_prefix='s3-delete'
+                )
+                # Commands like cleanup_expired_images must finish their deletes before exiting
+                atexit.register(self._delete_pool.shutdown, wait=True)
+            return self._delete_pool
+
+    def _delete_batch(self, names):
+        try:
+            response = self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={'Objects': [{'Key': name} for name in names], 'Quiet': True},
+            )
+            for error in response.get('Errors', []):
+                logger.warning('Could not delete %s: %s', error.get('Key'), error.get('Message'))
+        except Exception:
+            logger.exception('Deleting %d objects failed', len(names))
+
+    def delete_prefix(self, prefix):
+        """Queue every object under prefix for removal, returns how many"""
+        prefix = f"{prefix.strip('/')}/"
+        names = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            names.extend(obj['Key'] for obj in page.get('Contents', []))
+        return self.delete_many(names)
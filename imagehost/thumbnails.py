@@ -0,0 +1,152 @@
+"""
+Resized image variants for gallery and profile pages
+Thumbnails are generated on first request and cached on disk as
+THUMBNAIL_ROOT/<size>/<image name>.<jpg|png>, the path of their URL
+/t/<size>/<image name>, so nginx serves cached ones without reaching
+Django (see nginx/conf.d/images.locations). Images sharing a stored file
+share its name, and so its thumbnails.
+The cache is capped by the prune_thumbnails command (least recently used
+files go first; hits served by nginx do not count as uses) and cleaned
+when an image is deleted. It always lives on local disk, also when
+originals are in S3 (see imagehost/storage.py).
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from PIL import Image as PILImage
+
+from .processing import current_name
+
+# A cache hit refreshes the file's mtime at most this often (seconds)
+TOUCH_INTERVAL = 3600
+
+
+def thumbnail_path(name, size, ext):
+    """Path of the thumbnail of the stored file `name`, relative to MEDIA_ROOT"""
+    thumb_dir = os.path.relpath(settings.THUMBNAIL_ROOT, settings.MEDIA_ROOT)
+    return os.path.join(thumb_dir, str(size), f'{name}.{ext}')
+
+
+def thumbnail_format(mime_type):
+    """(PIL format, extension, mime type) used for thumbnails of an image"""
+    if mime_type in ['image/jpeg', 'image/jpg']:
+        return 'JPEG', 'jpg', 'image/jpeg'
+    return 'PNG', 'png', 'image/png'
+
+
+def render_thumbnail(source, size, img_format):
+    """
+    Resize an image to fit in size x size, returns a PIL image ready to save
+    Args:
+        source: Path or file-like object of the original
+    """
+    img = PILImage.open(source)
+    if img.format == 'JPEG':
+        # Decode at reduced scale straight away
+        img.draft('RGB', (size, size))
+    # Decode now: thumbnail() is a no-op for small images and the source may be closed before saving
+    img.load()
+    img.thumbnail((size, size), PILImage.Resampling.LANCZOS)
+
+    if img_format == 'JPEG' and img.mode != 'RGB':
+        img = img.convert('RGB')
+    elif img_format == 'PNG' and img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        img = img.convert('RGBA')
+    return img
+
+
+def get_or_create_thumbnail(image, size):
+    """
+    Get the cached thumbnail of an image, generating it if needed
+    Returns:
+        (path relative to MEDIA_ROOT, mime type)
+    """
+    img_format, ext, mime_type = thumbnail_format(image.mime_type)
+    relative_path = thumbnail_path(image.image.name, size, ext)
+    full_path = os.path.join(settings.MEDIA_ROOT, relative_path)
+
+    try:
+        # Cache hit: refresh the LRU timestamp now and then
+        mtime = os.stat(full_path).st_mtime
+        if time.time() - mtime > TOUCH_INTERVAL:
+            os.utime(full_path)
+        return relative_path, mime_type
+    except FileNotFoundError:
+        pass
+
+    with default_storage.open(current_name(image)) as source:
+        thumb = render_thumbnail(source, size, img_format)
+
+    # Concurrent requests may render the same thumbnail, the rename is atomic
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(full_path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            thumb.save(tmp, format=img_format, quality=settings.THUMBNAIL_QUALITY, optimize=True)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, full_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return relative_path, mime_type
+
+
+def delete_thumbnails(name):
+    """Remove every cached size of the stored file `name`"""
+    removed = 0
+    for size in settings.THUMBNAIL_SIZES:
+        for ext in ('jpg', 'png'):
+            path = os.path.join(settings.MEDIA_ROOT, thumbnail_path(name, size, ext))
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+def delete_thumbnail_prefix(prefix):
+    """Remove the cached thumbnails of every stored file under a directory"""
+    for size in settings.THUMBNAIL_SIZES:
+        shutil.rmtree(os.path.join(settings.THUMBNAIL_ROOT, str(size), prefix), ignore_errors=True)
+
+
+def prune_thumbnails(max_bytes):
+    """
+    Evict least recently used thumbnails until the cache fits in max_bytes
+    Returns:
+        (files removed, bytes freed, bytes remaining)
+    """
+    entries = []
+    total = 0
+    for root, _, files in os.walk(settings.THUMBNAIL_ROOT):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+    removed = freed = 0
+    if total > max_bytes:
+        entries.sort()
+        for _, file_size, path in entries:
+            if total - freed <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+            freed += file_size
+
+    return removed, freed, total - freed
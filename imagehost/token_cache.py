@@ -0,0 +1,131 @@
+"""
+Cached API token resolution and buffered token usage
+
+Tokens are resolved from the Django cache named by TOKEN_CACHE_BACKEND if
+configured, otherwise from a per-process TTL LRU, and only then from the
+database. Saving or deleting a token invalidates it through signals. The
+shared cache is the only copy, so that reaches every worker at once; with
+the per-process LRU other workers may keep a stale entry for up to
+TOKEN_CACHE_TTL seconds.
+
+upload_count / last_used are accumulated in memory and flushed in batches.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F
+from django.utils import timezone
+
+from .models import UploadToken
+from .view_counts import CounterBuffer, UPDATE_BATCH_SIZE
+
+# Unknown tokens are remembered for a short time to absorb guessing
+NEGATIVE_TTL = 10
+
+_MISSING = object()
+
+
+class TokenCache:
+    """Thread-safe TTL LRU of token string -> token fields (or None if invalid)"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return _MISSING
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[token]
+                return _MISSING
+            self._entries.move_to_end(token)
+            return value
+
+    def set(self, token, value, ttl):
+        with self._lock:
+            self._entries[token] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+
+
+_local_cache = TokenCache(settings.TOKEN_CACHE_SIZE, settings.TOKEN_CACHE_TTL)
+
+
+def _shared_cache():
+    if settings.TOKEN_CACHE_BACKEND:
+        return caches[settings.TOKEN_CACHE_BACKEND]
+    return None
+
+
+def _cache_key(token):
+    return f'imagehost:token:{token}'
+
+
+def resolve_token(token):
+    """
+    Get the active UploadToken for a token string, or None
+    The returned instance only carries id, token and name.
+    """
+    shared = _shared_cache()
+    # Not kept in the per-process LRU as well, other workers could not invalidate it
+    fields = shared.get(_cache_key(token), _MISSING) if shared else _local_cache.get(token)
+    if fields is _MISSING:
+        fields = UploadToken.objects.filter(token=token, is_active=True).values('id', 'token', 'name').first()
+        ttl = settings.TOKEN_CACHE_TTL if fields else NEGATIVE_TTL
+        if shared:
+            shared.set(_cache_key(token), fields, ttl)
+        else:
+            _local_cache.set(token, fields, ttl)
+
+    if fields is None:
+        return None
+    return UploadToken(is_active=True, **fields)
+
+
+def invalidate_token(token):
+    """Forget a token after it was changed or deleted"""
+    shared = _shared_cache()
+    if shared:
+        shared.delete(_cache_key(token))
+    else:
+        _local_cache.delete(token)
+
+
+def apply_token_uses(counts):
+    """Persist buffered upload counts, counts maps token id -> uploads"""
+    now = timezone.now()
+    by_increment = {}
+    for token_id, count in counts.items():
+        by_increment.setdefault(count, []).append(token_id)
+    for count, token_ids in by_increment.items():
+        for start in range(0, len(token_ids), UPDATE_BATCH_SIZE):
+            UploadToken.objects.filter(id__in=token_ids[start:start + UPDATE_BATCH_SIZE]).update(
+                upload_count=F('upload_count') + count, last_used=now
+            )
+
+
+_usage_buffer = CounterBuffer(
+    apply_token_uses,
+    flush_interval=settings.TOKEN_USAGE_FLUSH_INTERVAL,
+    max_buffer=settings.VIEW_COUNT_MAX_BUFFER,
+    name='token-usage-flusher',
+)
+
+
+def record_token_use(token, count=1):
+    """Count uploads made with a token without writing to its row"""
+    _usage_buffer.add(token.id, count)
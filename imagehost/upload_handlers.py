@@ -0,0 +1,70 @@
+"""
+Upload handler that hashes files while they are received
+"""
+
+import hashlib
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+
+class HashedUploadedFile(UploadedFile):
+    """
+    Uploaded file with its SHA256 computed during upload
+    Small files stay in memory, larger ones are spooled to a temporary file.
+    hash_seconds is the time spent hashing, reported as its own stage.
+    """
+
+    def __init__(self, file, name, content_type, size, charset, sha256, content_type_extra=None, hash_seconds=0.0):
+        super().__init__(file, name, content_type, size, charset, content_type_extra)
+        self.sha256 = sha256
+        self.hash_seconds = hash_seconds
+
+
+class HashingUploadHandler(FileUploadHandler):
+    """
+    Compute SHA256 chunk by chunk and stop storing data past MAX_UPLOAD_SIZE
+    The reported size keeps counting so views can still reject the file with
+    a proper error, but an oversized body never occupies memory or disk.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.hasher = hashlib.sha256()
+        self.hash_seconds = 0.0
+        self.size = 0
+        self.discarding = False
+        self.file = tempfile.SpooledTemporaryFile(
+            max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE,
+            dir=settings.FILE_UPLOAD_TEMP_DIR,
+        )
+
+    def receive_data_chunk(self, raw_data, start):
+        self.size += len(raw_data)
+        if self.size <= settings.MAX_UPLOAD_SIZE:
+            started = time.perf_counter()
+            self.hasher.update(raw_data)
+            self.hash_seconds += time.perf_counter() - started
+            self.file.write(raw_data)
+        elif not self.discarding:
+            # Over the limit: drop what we have and discard the rest
+            self.discarding = True
+            self.file.close()
+            self.file = tempfile.SpooledTemporaryFile()
+        return None
+
+    def file_complete(self, file_size):
+        self.file.seek(0)
+        return HashedUploadedFile(
+            file=self.file,
+            name=self.file_name,
+            content_type=self.content_type,
+            size=self.size,
+            charset=self.charset,
+            sha256=self.hasher.hexdigest(),
+            content_type_extra=self.content_type_extra,
+            hash_seconds=self.hash_seconds,
+        )
@@ -0,0 +1,306 @@
+"""
+Steps of an upload request, shared by the sync and async upload views
+Each step is either CPU work on the uploaded files (check_files,
+reuse_near_duplicates, compress_new_uploads), storage I/O
+(store_new_files) or database work (find_duplicates, save_images), so the
+async view can run each one where it belongs: on the image executor, in a
+thread, or with the async ORM.
+"""
+
+import os
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+
+from . import metrics
+from .blobs import afind_blobs, attach_blob, find_blobs, share_blob
+from .image_probe import probe_image
+from .models import PENDING_DIR, Image, pending_name
+from .page_cache import invalidate as invalidate_pages
+from .perceptual import dhash, hash_fields, near_duplicate
+from .processing import compress_uploads, enqueue
+from .usage import record_uploads
+from .variants import enabled_formats
+
+
+def check_files(uploaded_files, errors, timer):
+    """
+    Validate every file from its header and the hash computed during upload
+    Returns:
+        List of (uploaded file, ImageInfo, file hash) of the accepted files
+    """
+    accepted = []
+    for image_file in uploaded_files:
+        if image_file.size > settings.MAX_UPLOAD_SIZE:
+            max_mb = settings.MAX_UPLOAD_SIZE / (1024 * 1024)
+            errors.append(f"{image_file.name}: File too large (max {max_mb}MB)")
+            continue
+        try:
+            with timer.stage('probe'):
+                info = probe_image(image_file)
+            with timer.stage('hash'):
+                file_hash = Image.calculate_file_hash(image_file)
+        except Exception as e:
+            errors.append(f"{image_file.name}: {str(e)}")
+            continue
+        accepted.append((image_file, info, file_hash))
+    return accepted
+
+
+def find_duplicates(accepted, user):
+    """
+    Look up the accepted files among stored ones
+    Returns:
+        ({file hash: the user's own image}, {file hash: (Blob, Image)})
+    """
+    hashes = [file_hash for _, _, file_hash in accepted]
+    existing = {}
+    if user is not None:
+        existing = {img.file_hash: img for img in Image.objects.filter(user=user, file_hash__in=hashes)}
+    return existing, find_blobs(hashes)
+
+
+async def afind_duplicates(accepted, user):
+    """find_duplicates with the async ORM"""
+    hashes = [file_hash for _, _, file_hash in accepted]
+    existing = {}
+    if user is not None:
+        existing = {img.file_hash: img async for img in Image.objects.filter(user=user, file_hash__in=hashes)}
+    return existing, await afind_blobs(hashes)
+
+
+def split_uploads(accepted, existing, stored):
+    """
+    A user uploading a file they already have gets their image back;
+    anyone else gets a new image sharing the stored file
+    Returns:
+        (new uploads as (file, info, hash), shared uploads as (file, hash))
+    """
+    new_uploads = []
+    shared_uploads = []
+    seen = set()
+    for image_file, info, file_hash in accepted:
+        if file_hash in existing or file_hash in seen:
+            continue
+        seen.add(file_hash)
+        if file_hash in stored:
+            shared_uploads.append((image_file, file_hash))
+        else:
+            new_uploads.append((image_file, info, file_hash))
+    return new_uploads, shared_uploads
+
+
+def reuse_near_duplicates(new_uploads, user, existing, stored, shared_uploads, timer):
+    """
+    Treat visually identical files (re-encoded, resized) as duplicates too
+    Matches are moved to existing / stored and shared_uploads.
+    Returns:
+        (remaining new uploads, {file hash: perceptual hash}, hashes of the near-duplicates)
+    """
+    phashes = perceptual_hashes(new_uploads, timer)
+    distinct_uploads, near_duplicates = match_near_duplicates(
+        new_uploads, phashes, user, existing, stored, shared_uploads, timer
+    )
+    return distinct_uploads, phashes, near_duplicates
+
+
+def perceptual_hashes(new_uploads, timer):
+    """
+    Decode the uploads to hash them, the PIL half of reuse_near_duplicates
+    Returns:
+        Dict of file hash -> perceptual hash, without the files PIL can't hash
+    """
+    phashes = {}
+    for image_file, info, file_hash in new_uploads:
+        try:
+            with timer.stage('phash'):
+                phashes[file_hash] = dhash(image_file)
+        except Exception:
+            continue
+        finally:
+            image_file.seek(0)
+    return phashes
+
+
+def match_near_duplicates(new_uploads, phashes, user, existing, stored, shared_uploads, timer):
+    """
+    Look up the perceptual hashes, the database half of reuse_near_duplicates
+    Returns:
+        (remaining new uploads, hashes of the near-duplicates)
+    """
+    near_duplicates = set()
+    distinct_uploads = []
+    for image_file, info, file_hash in new_uploads:
+        if file_hash not in phashes:
+            distinct_uploads.append((image_file, info, file_hash))
+            continue
+        with timer.stage('phash'):
+            match = near_duplicate(phashes[file_hash], user)
+        if match is None:
+            distinct_uploads.append((image_file, info, file_hash))
+            continue
+        near_duplicates.add(file_hash)
+        if user is not None and match.user_id == user.id:
+            existing[file_hash] = match
+        else:
+            stored[file_hash] = (match.blob, match)
+            shared_uploads.append((image_file, file_hash))
+    return distinct_uploads, near_duplicates
+
+
+def record_dedup(accepted, new_uploads, shared_uploads, near_duplicates):
+    """
+    Count upload outcomes: new (stored), shared (same content as another
+    user's file), duplicate (the user's own file again), near_duplicate
+    (reused a similar image)
+    """
+    near_shared = sum(1 for _, file_hash in shared_uploads if file_hash in near_duplicates)
+    metrics.inc('imagehost_dedup_total', len(new_uploads), result='new')
+    metrics.inc('imagehost_dedup_total', len(shared_uploads) - near_shared, result='shared')
+    metrics.inc('imagehost_dedup_total', len(near_duplicates), result='near_duplicate')
+    metrics.inc(
+        'imagehost_dedup_total',
+        len(accepted) - len(new_uploads) - len(shared_uploads) - (len(near_duplicates) - near_shared),
+        result='duplicate',
+    )
+
+
+def process_later():
+    """Whether uploads are stored as received and compressed by the worker"""
+    return settings.ENABLE_IMAGE_COMPRESSION and settings.IMAGE_PROCESSING_MODE == 'async'
+
+
+def compress_new_uploads(new_uploads, timer):
+    """
+    Compress image if enabled, now (in parallel for several files) or in the background worker
+    Returns:
+        One compress_uploads outcome per upload, None when not compressed now
+    """
+    if not settings.ENABLE_IMAGE_COMPRESSION or process_later():
+        return [None] * len(new_uploads)
+
+    # decode/encode are summed over files, which may run in parallel
+    timings = {}
+    compressed = compress_uploads(
+        [(image_file, info.mime_type) for image_file, info, _ in new_uploads], timings=timings
+    )
+    for stage, seconds in timings.items():
+        timer.add(stage, seconds)
+    return compressed
+
+
+def store_new_files(new_uploads, compressed, phashes, user, upload_ip, errors, timer):
+    """
+    Write files first so the database transaction stays short
+    Returns:
+        List of (file hash, unsaved Image)
+    """
+    later = process_later()
+    new_images = []
+    for (image_file, info, file_hash), outcome in zip(new_uploads, compressed):
+        try:
+            if isinstance(outcome, Exception):
+                raise outcome
+            if later:
+                # Store the upload as-is under the extension it will have once compressed
+                ext = Image.compressed_format(info.mime_type).lower()
+                stored_file = File(image_file, name=f"{os.path.splitext(image_file.name)[0]}.{ext}")
+                width, height, mime_type = info.width, info.height, info.mime_type
+            elif outcome is not None:
+                stored_file, width, height, mime_type = outcome
+                metrics.record_compression(info.mime_type, image_file.size, stored_file.size)
+            else:
+                stored_file = image_file
+                width, height, mime_type = info.width, info.height, info.mime_type
+
+            image = Image(
+                original_filename=image_file.name,
+                file_size=stored_file.size,
+                file_hash=file_hash,
+                width=width,
+                height=height,
+                mime_type=mime_type,
+                upload_ip=upload_ip,
+                user=user,
+                processing_state=Image.STATE_PENDING if later else Image.STATE_READY
+            )
+            if file_hash in phashes:
+                for field, value in hash_fields(phashes[file_hash]).items():
+                    setattr(image, field, value)
+            # Set as temporary if uploaded by guest
+            if user is None:
+                image.set_as_temporary(hours=24, save=False)
+            with timer.stage('storage'):
+                if later:
+                    # Staged until the worker moves the compressed file to its final name
+                    name = image.image.field.generate_filename(image, stored_file.name)
+                    staged = default_storage.save(pending_name(name), stored_file)
+                    image.image.name = staged[len(PENDING_DIR) + 1:]
+                else:
+                    image.image.save(stored_file.name, stored_file, save=False)
+            new_images.append((file_hash, image))
+        except Exception as e:
+            errors.append(f"{image_file.name}: {str(e)}")
+    return new_images
+
+
+def share_stored_files(shared_uploads, stored, user, upload_ip):
+    """Files already stored are shared, nothing is written or compressed"""
+    new_images = []
+    for image_file, file_hash in shared_uploads:
+        image = Image(
+            original_filename=image_file.name,
+            file_hash=file_hash,
+            upload_ip=upload_ip,
+            user=user,
+        )
+        share_blob(image, *stored[file_hash])
+        if user is None:
+            image.set_as_temporary(hours=24, save=False)
+        new_images.append((file_hash, image))
+    return new_images
+
+
+def save_images(new_images, existing, errors):
+    """
+    Create all records in one transaction
+    Returns:
+        {file hash: created Image}; images lost to a concurrent upload of the
+        same file by the same user are added to existing instead
+    """
+    created = {}
+    to_process = []
+    with transaction.atomic():
+        for file_hash, image in new_images:
+            stored_new_file = image.blob_id is None
+            try:
+                with transaction.atomic():
+                    attach_blob(image)
+                    image.save()
+                created[file_hash] = image
+                if stored_new_file:
+                    to_process.append(image)
+            except IntegrityError:
+                # Same file uploaded concurrently by this user in another request
+                if stored_new_file:
+                    default_storage.delete(image.stored_name)
+                existing[file_hash] = Image.objects.get(user=image.user, file_hash=image.file_hash)
+            except ValueError as e:
+                errors.append(f"{image.original_filename}: {str(e)}")
+
+        # The worker compresses async uploads, generates format variants and
+        # perceptual hashes (shared files were processed with the image that stored them)
+        later = process_later()
+        to_process = [
+            image for image in to_process
+            if later or enabled_formats() or (settings.PERCEPTUAL_HASH_ENABLED and image.phash is None)
+        ]
+        if to_process:
+            enqueue(to_process)
+
+        record_uploads(created.values())
+        if created:
+            invalidate_pages()
+    return created
@@ -1,5 +1,9 @@
+from django.conf import settings
 from django.urls import path
-from . import views, auth_views
+from . import views, auth_views, async_views
+
+# Upload, list and serve can run as native async views under ASGI
+api_views = async_views if settings.ASYNC_VIEWS else views
 
 app_name = 'imagehost'
 
@@ -17,10 +21,15 @@ urlpatterns = [
     path('profile/', auth_views.user_profile, name='profile'),
 
     # API endpoints
-    path('api/upload/', views.upload_image, name='upload'),
-    path('api/images/', views.list_images, name='list_images'),
+    path('api/upload/', api_views.upload_image, name='upload'),
+    path('api/images/', api_views.list_images, name='list_images'),
     path('api/images/<int:image_id>/delete/', views.delete_image, name='delete_image'),
+    path('api/images/<int:image_id>/similar/', views.similar_images, name='similar_images'),
 
     # Image serving (with view count)
-    path('i/<path:image_path>', views.serve_image, name='serve_image'),
+    path('i/<path:image_path>', api_views.serve_image, name='serve_image'),
+    path('t/<int:size>/<path:image_path>', views.serve_thumbnail, name='serve_thumbnail'),
+
+    # Monitoring
+    path('metrics', views.metrics_view, name='metrics'),
 ]
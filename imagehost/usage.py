@@ -0,0 +1,139 @@
+"""
+Per-user and global usage counters
+UsageStats rows are adjusted with F() updates in the same transaction as
+the change they describe:
+- uploads: record_uploads, called by upload_image
+- deletes: record_deletes, called from the post_delete signal so admin,
+  cascade and cleanup deletions are all covered
+- views: record_views, called when buffered view counts are flushed
+- compression: record_resize, called when the worker shrinks a file
+The reconcile_usage command rebuilds everything from the Image table.
+"""
+
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+
+from .models import Image, UsageStats
+
+# Maximum number of ids in a single lookup query
+LOOKUP_BATCH_SIZE = 500
+
+
+def apply_usage(deltas, create=True):
+    """
+    Apply counter deltas
+    Args:
+        deltas: Mapping of user id (None for guests) -> (images, bytes, views)
+        create: Create missing rows. Deletions pass False since the user may
+            be going away in the same transaction.
+    The global row receives the sum of all deltas.
+    """
+    totals = [0, 0, 0]
+    for user_id, delta in deltas.items():
+        for i, value in enumerate(delta):
+            totals[i] += value
+        if user_id is not None:
+            _apply_row(user_id, delta, create)
+    if any(totals):
+        _apply_row(None, totals, create=True)
+
+
+def _apply_row(user_id, delta, create):
+    images, size, views = delta
+    if not (images or size or views):
+        return
+    update = dict(
+        image_count=F('image_count') + images,
+        total_size=F('total_size') + size,
+        total_views=F('total_views') + views,
+    )
+    if UsageStats.objects.filter(user_id=user_id).update(**update) or not create:
+        return
+    try:
+        with transaction.atomic():
+            UsageStats.objects.create(user_id=user_id, image_count=images, total_size=size, total_views=views)
+    except IntegrityError:
+        # Created concurrently, the row exists now
+        UsageStats.objects.filter(user_id=user_id).update(**update)
+
+
+def record_uploads(images):
+    """Count newly created images"""
+    deltas = defaultdict(lambda: [0, 0, 0])
+    for image in images:
+        deltas[image.user_id][0] += 1
+        deltas[image.user_id][1] += image.file_size
+    apply_usage(deltas)
+
+
+def record_deletes(images):
+    """Subtract deleted images"""
+    deltas = defaultdict(lambda: [0, 0, 0])
+    for image in images:
+        deltas[image.user_id][0] -= 1
+        deltas[image.user_id][1] -= image.file_size
+        deltas[image.user_id][2] -= image.view_count
+    apply_usage(deltas, create=False)
+
+
+def record_views(counts):
+    """Add flushed view counts, counts maps image id -> new views"""
+    deltas = defaultdict(lambda: [0, 0, 0])
+    image_ids = list(counts)
+    for start in range(0, len(image_ids), LOOKUP_BATCH_SIZE):
+        owners = Image.objects.filter(
+            id__in=image_ids[start:start + LOOKUP_BATCH_SIZE]
+        ).values_list('id', 'user_id')
+        for image_id, user_id in owners:
+            deltas[user_id][2] += counts[image_id]
+    apply_usage(deltas)
+
+
+def record_resize(image, new_size):
+    """Adjust total size after an image file was replaced"""
+    apply_usage({image.user_id: (0, new_size - image.file_size, 0)})
+
+
+def usage_for(user):
+    """Stats row of a user, unsaved and empty if they have none yet"""
+    return UsageStats.objects.filter(user=user).first() or UsageStats(user=user)
+
+
+@transaction.atomic
+def reconcile():
+    """
+    Rebuild all usage rows from the Image table
+    Returns:
+        Number of rows written
+    """
+    rows = {
+        row['user_id']: row
+        for row in Image.objects.values('user_id').annotate(
+            images=Count('id'), size=Sum('file_size'), views=Sum('view_count')
+        ).order_by()
+    }
+    totals = {
+        'images': sum(row['images'] for row in rows.values()),
+        'size': sum(row['size'] or 0 for row in rows.values()),
+        'views': sum(row['views'] or 0 for row in rows.values()),
+    }
+
+    UsageStats.objects.exclude(user_id__in=[user_id for user_id in rows if user_id is not None]).filter(
+        user__isnull=False
+    ).delete()
+
+    written = 0
+    targets = [(user_id, row) for user_id, row in rows.items() if user_id is not None] + [(None, totals)]
+    for user_id, row in targets:
+        UsageStats.objects.update_or_create(
+            user_id=user_id,
+            defaults={
+                'image_count': row['images'],
+                'total_size': row['size'] or 0,
+                'total_views': row['views'] or 0,
+            }
+        )
+        written += 1
+    return written
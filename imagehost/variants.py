@@ -0,0 +1,128 @@
+"""
+Modern-format variants of stored images (WebP, AVIF)
+Variants are written next to the stored file as <name>.<format> by the
+process_images worker, so nginx can pick one from the Accept header with a
+plain try_files (see nginx/conf.d/image-variants.conf) and serve_image can
+do the same on the Django path.
+"""
+
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from PIL import Image as PILImage
+from PIL import features
+
+VARIANT_MIME_TYPES = {
+    'avif': 'image/avif',
+    'webp': 'image/webp',
+}
+
+# Order variants are tried in, the same as the try_files of the nginx /i/
+# location (images.locations): AVIF, then WebP, then the original
+VARIANT_ORDER = ('avif', 'webp')
+
+
+def enabled_formats():
+    """Configured variant formats that this Pillow build can encode"""
+    return [
+        fmt for fmt in settings.IMAGE_VARIANT_FORMATS
+        if fmt in VARIANT_MIME_TYPES and features.check(fmt)
+    ]
+
+
+def variant_name(name, fmt):
+    """Storage name of a variant"""
+    return f"{name}.{fmt}"
+
+
+def generate_variants(path, formats, quality):
+    """
+    Encode the image at path in each format
+    Runs in a worker process. Clients get the first stored variant they
+    accept in VARIANT_ORDER (see choose_variant), so a variant is only kept
+    if it is smaller than the source file and than every variant kept after
+    it in that order; the variant served is then always the smallest one
+    the client accepts.
+    Returns:
+        Dict of format -> size in bytes, or None when no variant was kept
+    """
+    source_size = os.path.getsize(path)
+    encoded = {}
+
+    try:
+        with PILImage.open(path) as img:
+            animated = getattr(img, 'is_animated', False)
+            if not animated:
+                img.load()
+                if img.mode not in ('RGB', 'RGBA'):
+                    img = img.convert('RGBA' if 'transparency' in img.info or img.mode in ('LA', 'PA') else 'RGB')
+
+            for fmt in formats:
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+                encoded[fmt] = tmp_path
+                with os.fdopen(fd, 'wb') as tmp:
+                    img.save(tmp, format=fmt.upper(), quality=quality, save_all=animated)
+
+        sizes = {}
+        limit = source_size
+        for fmt in reversed([fmt for fmt in VARIANT_ORDER if fmt in encoded]):
+            tmp_path = encoded.pop(fmt)
+            size = os.path.getsize(tmp_path)
+            if size < limit:
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, variant_name(path, fmt))
+                sizes[fmt] = limit = size
+            else:
+                os.remove(tmp_path)
+                # A variant left from an earlier run would be served first
+                if os.path.exists(variant_name(path, fmt)):
+                    os.remove(variant_name(path, fmt))
+                sizes[fmt] = None
+        return sizes
+    finally:
+        for tmp_path in encoded.values():
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def parse_accept(accept_header):
+    """Set of media types accepted with a non-zero quality"""
+    accepted = set()
+    for item in accept_header.split(','):
+        media_type, *params = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if media_type and quality > 0:
+            accepted.add(media_type.lower())
+    return accepted
+
+
+def choose_variant(image, accept_header):
+    """
+    Pick the first stored variant in VARIANT_ORDER the client accepts
+    generate_variants only keeps variants smaller than those after them,
+    so this is also the smallest one.
+    Returns:
+        Format name, or None to serve the original
+    """
+    if not accept_header:
+        return None
+    accepted = parse_accept(accept_header)
+
+    formats = enabled_formats()
+    for fmt in VARIANT_ORDER:
+        if fmt in formats and image.variant_size(fmt) and VARIANT_MIME_TYPES[fmt] in accepted:
+            return fmt
+    return None
+
+
+def delete_variants(name):
+    """Remove the variant files of the stored file `name`"""
+    default_storage.delete_many([variant_name(name, fmt) for fmt in VARIANT_MIME_TYPES])
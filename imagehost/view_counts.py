@@ -0,0 +1,164 @@
+"""
+Buffered view counting
+
+Image hits are accumulated in a per-process buffer and written back in
+batches by a background thread, so serving an image never waits on a
+database write.
+"""
+
+import atexit
+import logging
+import os
+import threading
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F, Min
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of ids in a single UPDATE ... WHERE id IN (...)
+UPDATE_BATCH_SIZE = 500
+
+
+def apply_view_counts(counts):
+    """
+    Apply pending view counts to the database
+    Args:
+        counts: Mapping of image id -> number of new views
+    Images with the same increment share one atomic F() update; the
+    owners' usage counters are updated in the same transaction.
+    """
+    from .models import Image
+    from .usage import record_views
+
+    by_increment = defaultdict(list)
+    for image_id, count in counts.items():
+        if count > 0:
+            by_increment[count].append(image_id)
+
+    with transaction.atomic():
+        for count, image_ids in by_increment.items():
+            for start in range(0, len(image_ids), UPDATE_BATCH_SIZE):
+                Image.objects.filter(
+                    id__in=image_ids[start:start + UPDATE_BATCH_SIZE]
+                ).update(view_count=F('view_count') + count)
+        record_views(counts)
+
+
+class CounterBuffer:
+    """
+    In-process buffer of counters with a background flusher
+    Args:
+        apply: Called with a Counter of key -> increment to persist a batch
+        flush_interval: Seconds between flushes
+        max_buffer: Number of pending keys that triggers an early flush
+    """
+
+    def __init__(self, apply, flush_interval=10, max_buffer=1000, name='counter-flusher'):
+        self.apply = apply
+        self.name = name
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """Start from an empty buffer (also used in forked gunicorn workers)"""
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = Counter()
+        self._thread = None
+
+    def add(self, key, count=1):
+        """Count without touching the database"""
+        with self._lock:
+            self._pending[key] += count
+            full = len(self._pending) >= self.max_buffer
+        self._ensure_flusher()
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        """Write all pending counts to the database, returns the total flushed"""
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+        if not pending:
+            return 0
+
+        try:
+            self.apply(pending)
+        except Exception:
+            # Put the counts back so the next flush retries them
+            with self._lock:
+                self._pending.update(pending)
+            raise
+        return sum(pending.values())
+
+    def _ensure_flusher(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name=self.name, daemon=True
+            )
+            self._thread.start()
+        atexit.register(self._flush_quietly)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._flush_quietly()
+
+    def _flush_quietly(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('%s: flush failed', self.name)
+        finally:
+            connections.close_all()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    """Get the process-wide view count buffer"""
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = CounterBuffer(
+                    apply_view_counts,
+                    flush_interval=settings.VIEW_COUNT_FLUSH_INTERVAL,
+                    max_buffer=settings.VIEW_COUNT_MAX_BUFFER,
+                    name='view-count-flusher',
+                )
+    return _buffer
+
+
+def viewed_images(names):
+    """
+    The image credited with the views of each stored file
+    Images sharing a stored file (see blobs) share its URL; a view goes to
+    the first of them, the upload that stored the file, whichever path
+    (serve_image or ingest_access_logs) counts it.
+    Returns:
+        Queryset of (name, image id)
+    """
+    from .models import Image
+
+    return (
+        Image.objects.filter(image__in=names).order_by()
+        .values('image').annotate(first_id=Min('id')).values_list('image', 'first_id')
+    )
+
+
+def record_view(image_id):
+    """Count one view of an image"""
+    get_buffer().add(image_id)
@@ -1,11 +1,29 @@
+import hmac
 import os
+from urllib.parse import quote
 from django.shortcuts import render, get_object_or_404
-from django.http import JsonResponse, FileResponse, Http404, HttpResponseForbidden
+from django.http import (
+    JsonResponse, FileResponse, Http404, HttpResponse, HttpResponseForbidden, HttpResponseRedirect,
+    StreamingHttpResponse,
+)
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_vary_headers
 from django.core.paginator import Paginator
-from .models import Image, UploadToken
+from django.core.files.storage import default_storage
+from .models import Image
+from .perceptual import find_similar, stored_hash
+from .view_counts import record_view
+from .processing import current_name
+from .thumbnails import get_or_create_thumbnail
+from .token_cache import record_token_use, resolve_token
+from .pagination import cached_image_count, keyset_page
+from .page_cache import cached_page, page_key, store_page
+from .variants import VARIANT_MIME_TYPES, choose_variant, enabled_formats, variant_name
+from .http_utils import image_etag, if_range_matches, parse_range_header, range_response, set_validators
+from . import metrics, uploads
+from .admission import admission_control, busy_response, compression_slot
 from functools import wraps
 
 
@@ -42,31 +60,43 @@ def get_full_url(request, path, use_image_domain=False):
     return f"{scheme}://{domain}{path}"
 
 
-def token_required(view_func):
-    """Decorator to check API token authentication or user login"""
-    @wraps(view_func)
-    def wrapper(request, *args, **kwargs):
-        # If user is authenticated, allow access
-        if request.user.is_authenticated:
-            return view_func(request, *args, **kwargs)
+def check_api_access(request):
+    """
+    Check API token authentication or user login
+    Returns:
+        None if the request may go on (request.upload_token is set when a
+        token was used), else the error response
+    """
+    # If user is authenticated, allow access
+    if request.user.is_authenticated:
+        return None
 
-        # If guest uploads are allowed and no auth required, allow access
-        if not settings.REQUIRE_AUTH and getattr(settings, 'ALLOW_GUEST_UPLOAD', True):
-            return view_func(request, *args, **kwargs)
+    # If guest uploads are allowed and no auth required, allow access
+    if not settings.REQUIRE_AUTH and getattr(settings, 'ALLOW_GUEST_UPLOAD', True):
+        return None
 
-        # Check for token in header or query parameter
-        token = request.headers.get('X-API-Token') or request.GET.get('token') or request.POST.get('token')
+    # Check for token in header or query parameter
+    token = request.headers.get('X-API-Token') or request.GET.get('token') or request.POST.get('token')
 
-        if not token:
-            return JsonResponse({'error': 'Authentication required'}, status=401)
+    if not token:
+        return JsonResponse({'error': 'Authentication required'}, status=401)
 
-        # Validate token
-        try:
-            upload_token = UploadToken.objects.get(token=token, is_active=True)
-            request.upload_token = upload_token
-            return view_func(request, *args, **kwargs)
-        except UploadToken.DoesNotExist:
-            return JsonResponse({'error': 'Invalid token'}, status=403)
+    # Validate token (cached, see token_cache)
+    upload_token = resolve_token(token)
+    if upload_token is None:
+        return JsonResponse({'error': 'Invalid token'}, status=403)
+    request.upload_token = upload_token
+    return None
+
+
+def token_required(view_func):
+    """Decorator to check API token authentication or user login"""
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        error = check_api_access(request)
+        if error is not None:
+            return error
+        return view_func(request, *args, **kwargs)
 
     return wrapper
 
@@ -89,165 +119,248 @@ def gallery(request):
         token = request.GET.get('token')
         if not token:
             return HttpResponseForbidden('Token required')
-        try:
-            UploadToken.objects.get(token=token, is_active=True)
-        except UploadToken.DoesNotExist:
+        if resolve_token(token) is None:
             return HttpResponseForbidden('Invalid token')
 
-    images = Image.objects.all()
-    paginator = Paginator(images, 24)  # 24 images per page
-    page_number = request.GET.get('page', 1)
-    page_obj = paginator.get_page(page_number)
+    # The token is repeated in the pagination links
+    key = page_key('gallery', request, ('after', 'before', 'token'))
+    response = cached_page(request, key)
+    if response is not None:
+        return response
 
-    return render(request, 'gallery.html', {
+    # 24 images per page, addressed by cursor so deep pages stay cheap
+    try:
+        page_obj = keyset_page(
+            Image.objects.all(), 24,
+            after=request.GET.get('after'), before=request.GET.get('before')
+        )
+    except ValueError:
+        page_obj = keyset_page(Image.objects.all(), 24)
+
+    return store_page(request, key, render(request, 'gallery.html', {
         'page_obj': page_obj,
-        'total_images': images.count()
-    })
+        'total_images': cached_image_count()
+    }))
+
+
+def read_upload_files(request, files):
+    """
+    The uploaded images of a request, or an error response
+    Hashing happens while the body is received (see upload_handlers), its
+    time is moved from the 'read' stage to 'hash'. A form token makes
+    check_api_access parse the body before the 'read' stage, which then
+    holds little or none of it.
+    """
+    uploaded_files = files.getlist('images') if 'images' in files else []
+    if not uploaded_files:
+        return None, JsonResponse({'error': 'No image file provided'}, status=400)
+    hash_seconds = sum(getattr(image_file, 'hash_seconds', 0.0) for image_file in uploaded_files)
+    request.timer.split('read', 'hash', hash_seconds)
+    metrics.inc('imagehost_received_bytes_total', sum(image_file.size for image_file in uploaded_files))
+    return uploaded_files, None
+
+
+def upload_response(request, accepted, new_uploads, shared_uploads, created, existing, near_duplicates, errors):
+    """Build per-file results in upload order"""
+    results = []
+    first_uploads = {id(image_file) for image_file, _, _ in new_uploads}
+    first_uploads.update(id(image_file) for image_file, _ in shared_uploads)
+    for image_file, info, file_hash in accepted:
+        if id(image_file) in first_uploads and file_hash in created:
+            image = created[file_hash]
+            results.append({
+                'filename': image_file.name,
+                'url': get_full_url(request, image.url, use_image_domain=True),
+                'size': image.size_kb,
+                'dimensions': f"{image.width}x{image.height}",
+                'duplicate': False
+            })
+            if file_hash in near_duplicates:
+                results[-1]['near_duplicate'] = True
+            continue
+
+        existing_image = existing.get(file_hash) or created.get(file_hash)
+        if existing_image:
+            results.append({
+                'filename': image_file.name,
+                'url': get_full_url(request, existing_image.url, use_image_domain=True),
+                'size': existing_image.size_kb,
+                'duplicate': True
+            })
+            if file_hash in near_duplicates:
+                results[-1]['near_duplicate'] = True
+
+    response_data = {'results': results}
+    if errors:
+        response_data['errors'] = errors
+
+    status_code = 200 if results else 400
+    return JsonResponse(response_data, status=status_code)
 
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@metrics.timed('upload')
 @token_required
+@admission_control
 def upload_image(request):
-    """Handle image upload"""
+    """Handle image upload (see uploads for the steps)"""
+    timer = request.timer
     try:
-        # Check if files were uploaded
-        if 'images' not in request.FILES:
-            return JsonResponse({'error': 'No image file provided'}, status=400)
-
-        uploaded_files = request.FILES.getlist('images')
-        if not uploaded_files:
-            return JsonResponse({'error': 'No image file provided'}, status=400)
+        with timer.stage('read'):
+            files = request.FILES
+        uploaded_files, error = read_upload_files(request, files)
+        if error:
+            return error
 
-        results = []
         errors = []
-
-        for image_file in uploaded_files:
-            try:
-                # Validate file type
-                if image_file.content_type not in settings.ALLOWED_IMAGE_TYPES:
-                    errors.append(f"{image_file.name}: Invalid file type")
-                    continue
-
-                # Validate file size
-                if image_file.size > settings.MAX_UPLOAD_SIZE:
-                    max_mb = settings.MAX_UPLOAD_SIZE / (1024 * 1024)
-                    errors.append(f"{image_file.name}: File too large (max {max_mb}MB)")
-                    continue
-
-                # Read file content for hash calculation
-                image_file.seek(0)
-                file_content = image_file.read()
-                image_file.seek(0)
-
-                # Calculate hash to check for duplicates
-                file_hash = Image.calculate_hash(file_content)
-
-                # Check if image already exists
-                existing_image = Image.objects.filter(file_hash=file_hash).first()
-                if existing_image:
-                    results.append({
-                        'filename': image_file.name,
-                        'url': get_full_url(request, existing_image.url, use_image_domain=True),
-                        'size': existing_image.size_kb,
-                        'duplicate': True
-                    })
-                    continue
-
-                # Compress image if enabled
-                if settings.ENABLE_IMAGE_COMPRESSION:
-                    compressed_file, dimensions = Image.compress_image(
-                        image_file,
-                        quality=settings.COMPRESSION_QUALITY,
-                        max_dimension=settings.MAX_IMAGE_DIMENSION
-                    )
-                    width, height = dimensions
-                else:
-                    from PIL import Image as PILImage
-                    img = PILImage.open(image_file)
-                    width, height = img.size
-                    compressed_file = image_file
-                    image_file.seek(0)
-
-                # Create image record
-                image = Image(
-                    image=compressed_file,
-                    original_filename=image_file.name,
-                    file_size=compressed_file.size if hasattr(compressed_file, 'size') else image_file.size,
-                    file_hash=file_hash,
-                    width=width,
-                    height=height,
-                    mime_type=image_file.content_type,
-                    upload_ip=get_client_ip(request),
-                    user=request.user if request.user.is_authenticated else None
-                )
-                image.save()
-
-                # Set as temporary if uploaded by guest
-                if not request.user.is_authenticated:
-                    image.set_as_temporary(hours=24)
-
-                # Record token usage
-                if hasattr(request, 'upload_token'):
-                    request.upload_token.record_use()
-
-                results.append({
-                    'filename': image_file.name,
-                    'url': get_full_url(request, image.url, use_image_domain=True),
-                    'size': image.size_kb,
-                    'dimensions': f"{width}x{height}",
-                    'duplicate': False
-                })
-
-            except Exception as e:
-                errors.append(f"{image_file.name}: {str(e)}")
-
-        response_data = {'results': results}
-        if errors:
-            response_data['errors'] = errors
-
-        status_code = 200 if results else 400
-        return JsonResponse(response_data, status=status_code)
+        user = request.user if request.user.is_authenticated else None
+        upload_ip = get_client_ip(request)
+        accepted = uploads.check_files(uploaded_files, errors, timer)
+
+        with timer.stage('dedup'):
+            existing, stored = uploads.find_duplicates(accepted, user)
+        new_uploads, shared_uploads = uploads.split_uploads(accepted, existing, stored)
+        phashes, near_duplicates = {}, set()
+        if settings.NEAR_DUPLICATE_UPLOADS == 'reuse' and new_uploads:
+            new_uploads, phashes, near_duplicates = uploads.reuse_near_duplicates(
+                new_uploads, user, existing, stored, shared_uploads, timer
+            )
+        uploads.record_dedup(accepted, new_uploads, shared_uploads, near_duplicates)
+
+        with compression_slot(new_uploads) as admitted:
+            if not admitted:
+                return busy_response()
+            compressed = uploads.compress_new_uploads(new_uploads, timer)
+            new_images = uploads.store_new_files(new_uploads, compressed, phashes, user, upload_ip, errors, timer)
+        new_images += uploads.share_stored_files(shared_uploads, stored, user, upload_ip)
+        with timer.stage('db'):
+            created = uploads.save_images(new_images, existing, errors)
+
+        # Record token usage, buffered so uploads don't serialize on the token row
+        if created and hasattr(request, 'upload_token'):
+            with timer.stage('token'):
+                record_token_use(request.upload_token, count=len(created))
+
+        return upload_response(
+            request, accepted, new_uploads, shared_uploads, created, existing, near_duplicates, errors
+        )
 
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
 
+# Query parameters a list_images response depends on
+LIST_PARAMS = ('page', 'per_page', 'cursor', 'include_total')
+
+
+def list_entry(request, img):
+    """One image in a list_images response"""
+    return {
+        'id': img.id,
+        'filename': img.original_filename,
+        'url': get_full_url(request, img.url, use_image_domain=True),
+        'size': img.size_kb,
+        'dimensions': f"{img.width}x{img.height}",
+        'views': img.view_count,
+        'created_at': img.created_at.isoformat()
+    }
+
+
 @require_http_methods(["GET"])
 @token_required
 def list_images(request):
-    """List all uploaded images with pagination"""
-    try:
-        page = int(request.GET.get('page', 1))
-        per_page = int(request.GET.get('per_page', 20))
+    """
+    List all uploaded images with pagination
+    Pass cursor (empty for the first page) for keyset pagination; the
+    response then carries next_cursor and, with include_total=1, a cached
+    total. Without cursor the page-number mode is used.
+    """
+    # Every caller passing token_required sees the same listing
+    key = page_key('list_images', request, LIST_PARAMS)
+    response = cached_page(request, key)
+    if response is not None:
+        return response
 
+    try:
+        per_page = min(max(int(request.GET.get('per_page', 20)), 1), settings.API_MAX_PER_PAGE)
         images = Image.objects.all()
-        paginator = Paginator(images, per_page)
-        page_obj = paginator.get_page(page)
+
+        if 'cursor' in request.GET:
+            try:
+                page_obj = keyset_page(images, per_page, after=request.GET.get('cursor'))
+            except ValueError as e:
+                return JsonResponse({'error': str(e)}, status=400)
+            pagination = {
+                'per_page': per_page,
+                'next_cursor': page_obj.next_cursor,
+                'has_more': page_obj.has_next,
+            }
+            if request.GET.get('include_total') in ('1', 'true'):
+                pagination['total'] = cached_image_count()
+        else:
+            page = int(request.GET.get('page', 1))
+            paginator = Paginator(images, per_page)
+            paginator.count = cached_image_count()
+            page_obj = paginator.get_page(page)
+            pagination = {
+                'page': page,
+                'per_page': per_page,
+                'total': paginator.count,
+                'pages': paginator.num_pages
+            }
 
         data = {
-            'images': [
+            'images': [list_entry(request, img) for img in page_obj],
+            'pagination': pagination
+        }
+
+        return store_page(request, key, JsonResponse(data))
+
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+
+@require_http_methods(["GET"])
+@token_required
+def similar_images(request, image_id):
+    """
+    List images that look like the given one (perceptual hash distance)
+    Query parameters: max_distance (bits, default NEAR_DUPLICATE_MAX_DISTANCE)
+    and limit (default 20).
+    """
+    try:
+        image = get_object_or_404(Image, id=image_id)
+        value = stored_hash(image)
+        if value is None:
+            return JsonResponse({'error': 'Perceptual hash not computed yet'}, status=409)
+
+        try:
+            max_distance = int(request.GET.get('max_distance', settings.NEAR_DUPLICATE_MAX_DISTANCE))
+            limit = int(request.GET.get('limit', 20))
+        except ValueError:
+            return JsonResponse({'error': 'Invalid max_distance or limit'}, status=400)
+        max_distance = max(0, min(max_distance, 16))
+        limit = max(1, min(limit, settings.API_MAX_PER_PAGE))
+
+        matches = find_similar(value, max_distance, Image.objects.exclude(id=image.id), limit)
+        return JsonResponse({
+            'id': image.id,
+            'results': [
                 {
                     'id': img.id,
                     'filename': img.original_filename,
                     'url': get_full_url(request, img.url, use_image_domain=True),
-                    'size': img.size_kb,
+                    'distance': distance,
                     'dimensions': f"{img.width}x{img.height}",
-                    'views': img.view_count,
                     'created_at': img.created_at.isoformat()
                 }
-                for img in page_obj
-            ],
-            'pagination': {
-                'page': page,
-                'per_page': per_page,
-                'total': paginator.count,
-                'pages': paginator.num_pages
-            }
-        }
-
-        return JsonResponse(data)
+                for distance, img in matches
+            ]
+        })
 
+    except Http404:
+        raise
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
@@ -260,11 +373,7 @@ def delete_image(request, image_id):
     try:
         image = get_object_or_404(Image, id=image_id)
 
-        # Delete physical file
-        if image.image and os.path.exists(image.image.path):
-            os.remove(image.image.path)
-
-        # Delete database record
+        # Delete database record, the file goes with the last image using it
         image.delete()
 
         return JsonResponse({'message': 'Image deleted successfully'})
@@ -273,28 +382,181 @@ def delete_image(request, image_id):
         return JsonResponse({'error': str(e)}, status=500)
 
 
+def send_file(request, relative_path, content_type, etag, last_modified):
+    """
+    Build the response for a file under MEDIA_ROOT
+    Handles conditional requests, then either streams the file (with Range
+    support) or offloads it to the proxy according to IMAGE_SERVE_MODE.
+    """
+    # Revalidation (If-None-Match / If-Modified-Since) never touches the file
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    mode = settings.IMAGE_SERVE_MODE
+    if response is not None:
+        pass
+    elif mode == 'x-accel':
+        # nginx streams the file from its internal location (and handles Range)
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.IMAGE_ACCEL_PREFIX + quote(relative_path)
+    elif mode == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = os.path.abspath(os.path.join(settings.MEDIA_ROOT, relative_path))
+    else:
+        file_obj = open(os.path.join(settings.MEDIA_ROOT, relative_path), 'rb')
+        size = os.fstat(file_obj.fileno()).st_size
+
+        ranges = None
+        range_header = request.META.get('HTTP_RANGE')
+        if request.method == 'GET' and range_header and if_range_matches(request, etag, last_modified):
+            ranges = parse_range_header(range_header, size)
+
+        if ranges is not None:
+            response = range_response(file_obj, ranges, content_type, size)
+        else:
+            response = FileResponse(file_obj, content_type=content_type)
+        response['Accept-Ranges'] = 'bytes'
+
+    return set_validators(response, etag, last_modified)
+
+
+def send_stored_file(request, name, content_type, etag, last_modified):
+    """
+    Build the response for a stored image
+    Filesystem storage goes through send_file. Remote storage redirects to
+    S3_PUBLIC_URL when set, otherwise the object is streamed through Django
+    (Range requests download it first, images are small).
+    """
+    if default_storage.is_local:
+        return send_file(request, name, content_type, etag, last_modified)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        pass
+    elif default_storage.public_url:
+        response = HttpResponseRedirect(default_storage.url(name))
+    else:
+        range_header = request.META.get('HTTP_RANGE')
+        if request.method == 'GET' and range_header and if_range_matches(request, etag, last_modified):
+            file_obj = default_storage.open(name)
+            ranges = parse_range_header(range_header, file_obj.size)
+            if ranges is not None:
+                response = range_response(file_obj, ranges, content_type, file_obj.size)
+            else:
+                response = FileResponse(file_obj, content_type=content_type)
+        else:
+            chunks, size = default_storage.stream(name)
+            response = StreamingHttpResponse(chunks, content_type=content_type)
+            response['Content-Length'] = size
+        response['Accept-Ranges'] = 'bytes'
+
+    return set_validators(response, etag, last_modified)
+
+
+def image_response(request, image, image_path):
+    """Response serving a looked up image (or its best variant), counts the view"""
+    timer = request.timer
+    # Serve file (a missing S3 object fails when it is fetched)
+    with timer.stage('storage'):
+        if image.processing_state == Image.STATE_PENDING:
+            image_path = current_name(image)
+        if default_storage.is_local and not default_storage.exists(image_path):
+            raise Http404("Image file not found")
+
+    # Buffer the view, it is written to the database in the background
+    if settings.VIEW_COUNT_SOURCE == 'django':
+        record_view(image.id)
+
+    etag = image_etag(image)
+    last_modified = int(image.created_at.timestamp())
+
+    # Serve the smallest WebP/AVIF variant the client accepts
+    variant = choose_variant(image, request.headers.get('Accept', ''))
+    with timer.stage('send'):
+        if variant:
+            etag = f'{etag[:-1]}-{variant}"'
+            response = send_stored_file(
+                request, variant_name(image_path, variant), VARIANT_MIME_TYPES[variant], etag, last_modified
+            )
+        else:
+            response = send_stored_file(request, image_path, image.mime_type, etag, last_modified)
+    metrics.inc('imagehost_sent_bytes_total', sent_bytes(response, image, variant), view='serve')
+    if enabled_formats():
+        patch_vary_headers(response, ['Accept'])
+    if image.processing_state == Image.STATE_PENDING:
+        # The compressed version will be served under the same URL
+        response['Cache-Control'] = 'no-cache'
+    else:
+        response['Cache-Control'] = 'public, max-age=31536000'  # Cache for 1 year
+    return response
+
+
+@metrics.timed('serve')
 def serve_image(request, image_path):
     """Serve image file and increment view count"""
     try:
         # Get image from database
-        image = Image.objects.filter(image=image_path).first()
+        with request.timer.stage('lookup'):
+            # Credited to the same image as in view_counts.viewed_images
+            image = Image.objects.filter(image=image_path).order_by('id').first()
 
         if not image:
             raise Http404("Image not found")
 
-        # Increment view count
-        image.increment_view_count()
+        return image_response(request, image, image_path)
 
-        # Serve file
-        file_path = os.path.join(settings.MEDIA_ROOT, image_path)
-        if not os.path.exists(file_path):
-            raise Http404("Image file not found")
+    except Exception as e:
+        raise Http404(str(e))
+
+
+def sent_bytes(response, image, variant=None):
+    """Size of the body of an image response (offloaded ones included)"""
+    if response.status_code not in (200, 206):
+        return 0
+    if response.has_header('Content-Length'):
+        return int(response['Content-Length'])
+    if response.has_header('X-Accel-Redirect') or response.has_header('X-Sendfile'):
+        return (getattr(image, f'{variant}_size') if variant else None) or image.file_size or 0
+    return 0
 
-        response = FileResponse(open(file_path, 'rb'))
-        response['Content-Type'] = image.mime_type
-        response['Cache-Control'] = 'public, max-age=31536000'  # Cache for 1 year
 
+def serve_thumbnail(request, size, image_path):
+    """Serve a resized variant of an image, generating it on first request"""
+    try:
+        if size not in settings.THUMBNAIL_SIZES:
+            raise Http404("Thumbnail size not allowed")
+
+        image = Image.objects.filter(image=image_path).first()
+        if not image:
+            raise Http404("Image not found")
+
+        relative_path, content_type = get_or_create_thumbnail(image, size)
+
+        etag = f'"{image.file_hash[:32]}-t{size}"'
+        last_modified = int(image.created_at.timestamp())
+        response = send_file(request, relative_path, content_type, etag, last_modified)
+        response['Cache-Control'] = 'public, max-age=31536000'  # Cache for 1 year
         return response
 
     except Exception as e:
         raise Http404(str(e))
+
+
+def metrics_view(request):
+    """
+    Prometheus metrics of all workers
+    Requires Authorization: Bearer METRICS_TOKEN, or a staff session.
+    """
+    if not settings.METRICS_ENABLED:
+        raise Http404("Metrics are disabled")
+
+    authorization = request.headers.get('Authorization', '')
+    token = authorization[7:] if authorization.startswith('Bearer ') else ''
+    allowed = (
+        (settings.METRICS_TOKEN and hmac.compare_digest(token.encode(), settings.METRICS_TOKEN.encode()))
+        or request.user.is_staff
+    )
+    if not allowed:
+        return HttpResponseForbidden('Metrics token required')
+
+    response = HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+    response['Cache-Control'] = 'no-store'
+    return response
@@ -1,11 +1,12 @@
 #!/bin/bash
 
-# Setup cron job for cleaning up expired temporary images
+# Setup cron jobs for cleaning up expired temporary images, pruning the
+# thumbnail cache and, with VIEW_COUNT_SOURCE=access_log, counting views
 # This script should be run once during deployment
 
 set -e
 
-echo "Setting up cron job for expired image cleanup..."
+echo "Setting up cron jobs for expired image cleanup and thumbnail pruning..."
 
 # Get the project directory
 PROJECT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
@@ -16,22 +17,46 @@ CRON_FILE="/tmp/imagebed_cron"
 # Get existing cron jobs
 crontab -l > "$CRON_FILE" 2>/dev/null || true
 
-# Check if cron job already exists
-if grep -q "cleanup_expired_images" "$CRON_FILE"; then
-    echo "Cron job already exists. Updating..."
-    # Remove old cron job
-    grep -v "cleanup_expired_images" "$CRON_FILE" > "${CRON_FILE}.tmp" || true
-    mv "${CRON_FILE}.tmp" "$CRON_FILE"
+# Read VIEW_COUNT_SOURCE from the environment, or from .env
+if [ -z "$VIEW_COUNT_SOURCE" ] && [ -f "$PROJECT_DIR/.env" ]; then
+    VIEW_COUNT_SOURCE=$(grep "^VIEW_COUNT_SOURCE=" "$PROJECT_DIR/.env" | cut -d'=' -f2 || true)
 fi
 
-# Add new cron job (runs every hour)
+# Add a cron job running a management command, replacing an existing one
+# (an optional fourth argument is put in front of the command, e.g. flock)
 # Note: Adjust the path if you're using Docker
-if [ -f "/.dockerenv" ]; then
-    # Running in Docker
-    echo "0 * * * * cd /app && docker compose exec -T web python manage.py cleanup_expired_images >> /var/log/image_bed_cleanup.log 2>&1" >> "$CRON_FILE"
+add_job() {
+    local schedule="$1" command="$2" log="$3" prefix="$4"
+    if grep -q "$command" "$CRON_FILE"; then
+        echo "Cron job for $command already exists. Updating..."
+        remove_job "$command"
+    fi
+    if [ -f "/.dockerenv" ]; then
+        # Running in Docker
+        echo "$schedule cd /app && ${prefix:+$prefix }docker compose exec -T web python manage.py $command >> $log 2>&1" >> "$CRON_FILE"
+    else
+        # Running directly on host
+        echo "$schedule cd $PROJECT_DIR && ${prefix:+$prefix }python manage.py $command >> $log 2>&1" >> "$CRON_FILE"
+    fi
+}
+
+remove_job() {
+    grep -v "$1" "$CRON_FILE" > "${CRON_FILE}.tmp" || true
+    mv "${CRON_FILE}.tmp" "$CRON_FILE"
+}
+
+# Expired images: every minute; each run is time-boxed and skips if one is still running
+add_job "* * * * *" cleanup_expired_images /var/log/image_bed_cleanup.log
+
+# Thumbnail cache: hourly, trims it to THUMBNAIL_CACHE_MAX_BYTES
+add_job "17 * * * *" prune_thumbnails /var/log/image_bed_thumbnails.log
+
+# View counts from the nginx access log, only with VIEW_COUNT_SOURCE=access_log
+# (runs do not overlap: flock skips a run while the previous one is reading)
+if [ "$VIEW_COUNT_SOURCE" = "access_log" ]; then
+    add_job "* * * * *" ingest_access_logs /var/log/image_bed_views.log "flock -n /tmp/image_bed_ingest.lock"
 else
-    # Running directly on host
-    echo "0 * * * * cd $PROJECT_DIR && python manage.py cleanup_expired_images >> /var/log/image_bed_cleanup.log 2>&1" >> "$CRON_FILE"
+    remove_job ingest_access_logs
 fi
 
 # Install the cron job
@@ -41,8 +66,12 @@ crontab "$CRON_FILE"
 rm "$CRON_FILE"
 
 echo "✅ Cron job installed successfully!"
-echo "The cleanup task will run every hour at minute 0"
+echo "The cleanup task will run every minute"
 echo "Logs will be written to: /var/log/image_bed_cleanup.log"
+echo "The thumbnail cache is pruned hourly, logs: /var/log/image_bed_thumbnails.log"
+if [ "$VIEW_COUNT_SOURCE" = "access_log" ]; then
+    echo "Views are counted from the nginx access log every minute, logs: /var/log/image_bed_views.log"
+fi
 echo ""
 echo "To view the cron job: crontab -l"
 echo "To remove the cron job: crontab -e (then delete the line)"